@@ -0,0 +1,331 @@
+"""
+Admission control and load shedding for the analyze endpoints
+
+Each server process runs at most MAX_ACTIVE analyses at once (the CPU
+threads it has for them). Further requests wait in a bounded queue per
+endpoint instead of piling up unboundedly in the thread pool or the
+listen backlog:
+
+- when a slot frees up it goes to the highest-priority waiter, so
+  symptom-only requests (sub-millisecond) are never stuck behind image
+  work, and requests of the same priority go first come, first served;
+- a request whose endpoint queue is full is rejected at once with 429;
+- a request still queued after QUEUE_TIMEOUT seconds gets 503.
+
+Both rejections carry Retry-After, estimated from the recent service
+time and the current backlog. Slots are handed to the next waiter
+directly on release, so a new arrival never overtakes queued requests.
+
+Admission only has something to manage in a process that accepts
+requests while it is busy (uvicorn workers under SERVER_MODE=asgi, or a
+threaded server). A sync gunicorn worker takes one request at a time, so
+nothing ever queues inside it; the backlog waits in the listen socket.
+
+Every process publishes its state as gauges, and the readiness view
+reports the whole server from the METRICS_DIR snapshots (server_snapshot).
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+from typing import Dict
+
+from django.conf import settings
+
+from .metrics import (
+    ADMISSION_ACTIVE,
+    ADMISSION_PROCESSES,
+    ADMISSION_QUEUED,
+    ADMISSION_REJECTED,
+    ADMISSION_SATURATED,
+    ADMISSION_WAIT_SECONDS,
+    REGISTRY,
+    merge_snapshots,
+)
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first; endpoints not listed share the default priority
+PRIORITIES = {'analyze_symptoms': 0}
+DEFAULT_PRIORITY = 1
+
+# Weight of the latest request in the service time average
+SERVICE_TIME_SMOOTHING = 0.2
+
+MAX_RETRY_AFTER = 120
+
+
+class Rejected(Exception):
+    """A request the service has no capacity for"""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ('endpoint', 'granted', 'cancelled', 'event', 'future', 'loop')
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.granted = False
+        self.cancelled = False
+        self.event = None
+        self.future = None
+        self.loop = None
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(True)
+
+
+class AdmissionController:
+    """
+    Concurrency limit with bounded per-endpoint priority queues
+    """
+
+    def __init__(self, max_active: int, queue_limits: Dict[str, int], queue_timeout: float = 30.0):
+        """
+        Args:
+            max_active: Analyses allowed to run at once
+            queue_limits: Endpoint name -> requests allowed to wait (endpoints
+                not listed are not admission-controlled)
+            queue_timeout: Longest wait for a slot, in seconds
+        """
+        self.max_active = max(1, max_active)
+        self.queue_limits = dict(queue_limits)
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        self._heap = []
+        self._queued = {endpoint: 0 for endpoint in self.queue_limits}
+        self._service_time = {}
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def controls(self, endpoint: str) -> bool:
+        return endpoint in self.queue_limits
+
+    @contextmanager
+    def admit(self, endpoint: str):
+        """
+        Hold a slot for the duration of a request (blocking)
+
+        Raises Rejected when the endpoint's queue is full or the wait for
+        a slot times out.
+        """
+        waiter = _Waiter(endpoint)
+        waiter.event = threading.Event()
+        if self._enter(waiter):
+            start = time.perf_counter()
+            waiter.event.wait(self.queue_timeout)
+            self._settle(waiter, start)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(endpoint, time.perf_counter() - start)
+
+    @asynccontextmanager
+    async def admit_async(self, endpoint: str):
+        """Async form of admit(); waits without blocking the event loop"""
+        waiter = _Waiter(endpoint)
+        waiter.loop = asyncio.get_running_loop()
+        waiter.future = waiter.loop.create_future()
+        if self._enter(waiter):
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                # Client went away while queued: give back a slot granted meanwhile
+                with self._lock:
+                    granted = waiter.granted
+                    if not granted:
+                        self._cancel(waiter)
+                if granted:
+                    self._release(endpoint, None)
+                raise
+            self._settle(waiter, start)
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._release(endpoint, time.perf_counter() - start)
+
+    def snapshot(self) -> Dict:
+        """Slots in use and queue depth per endpoint (this process)"""
+        with self._lock:
+            queued = dict(self._queued)
+            active = self._active
+            saturated = self._saturated()
+            self._publish()
+        return {
+            'active': active,
+            'max_active': self.max_active,
+            'queued': queued,
+            'queue_limits': dict(self.queue_limits),
+            'saturated': saturated,
+        }
+
+    def _saturated(self) -> bool:
+        # Lock held
+        return self._active >= self.max_active and any(
+            self._queued[endpoint] >= limit for endpoint, limit in self.queue_limits.items()
+        )
+
+    def _publish(self):
+        """
+        Export slots in use and saturation for the server-wide view (lock held)
+
+        Only processes that serve requests publish, so neither the gunicorn
+        master nor processes forked from it count as server processes.
+        """
+        ADMISSION_PROCESSES.set(1)
+        ADMISSION_ACTIVE.set(self._active)
+        ADMISSION_SATURATED.set(1 if self._saturated() else 0)
+
+    def _enter(self, waiter: _Waiter) -> bool:
+        """
+        Take a free slot (returns False) or a place in the queue (returns True)
+
+        Both happen under one lock acquisition, so a slot released in
+        between always goes to a waiter that is already in the heap.
+        """
+        endpoint = waiter.endpoint
+        with self._lock:
+            if self._active < self.max_active:
+                self._active += 1
+                self._publish()
+                return False
+            if self._queued[endpoint] < self.queue_limits[endpoint]:
+                self._queued[endpoint] += 1
+                heapq.heappush(self._heap, (
+                    PRIORITIES.get(endpoint, DEFAULT_PRIORITY), next(self._sequence), waiter
+                ))
+                ADMISSION_QUEUED.inc(endpoint=endpoint)
+                self._publish()
+                return True
+            retry_after = self._retry_after()
+
+        ADMISSION_REJECTED.inc(endpoint=endpoint, reason='queue_full')
+        raise Rejected(429, 'queue_full', retry_after)
+
+    def _settle(self, waiter: _Waiter, start: float):
+        """After waiting: keep the slot handed over, or give up the place in the queue"""
+        with self._lock:
+            granted = waiter.granted
+            if not granted:
+                self._cancel(waiter)
+                retry_after = self._retry_after()
+
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, endpoint=waiter.endpoint)
+        if not granted:
+            ADMISSION_REJECTED.inc(endpoint=waiter.endpoint, reason='queue_timeout')
+            raise Rejected(503, 'queue_timeout', retry_after)
+
+    def _cancel(self, waiter: _Waiter):
+        # Lock held; the heap entry is skipped when it comes up
+        waiter.cancelled = True
+        self._queued[waiter.endpoint] -= 1
+        ADMISSION_QUEUED.dec(endpoint=waiter.endpoint)
+        self._publish()
+
+    def _release(self, endpoint: str, elapsed: float = None):
+        """Hand the slot to the next waiter, or free it"""
+        with self._lock:
+            if elapsed is not None:
+                previous = self._service_time.get(endpoint)
+                self._service_time[endpoint] = elapsed if previous is None else (
+                    previous + SERVICE_TIME_SMOOTHING * (elapsed - previous)
+                )
+
+            while self._heap:
+                _, _, waiter = heapq.heappop(self._heap)
+                if waiter.cancelled:
+                    continue
+                waiter.granted = True
+                self._queued[waiter.endpoint] -= 1
+                ADMISSION_QUEUED.dec(endpoint=waiter.endpoint)
+                self._publish()
+                waiter.wake()
+                return
+            self._active -= 1
+            self._publish()
+
+    def _retry_after(self) -> int:
+        """Seconds until the current backlog should have drained (lock held)"""
+        if not self._service_time:
+            return 1
+        service_time = max(self._service_time.values())
+        backlog = self._active + sum(self._queued.values())
+        return min(MAX_RETRY_AFTER, max(1, math.ceil(backlog * service_time / self.max_active)))
+
+
+def build_admission_controller(config: Dict = None):
+    """
+    Admission controller described by settings.ADMISSION
+
+    Args:
+        config: Admission configuration (defaults to settings.ADMISSION)
+
+    Returns:
+        AdmissionController, or None when admission control is disabled
+    """
+    config = config if config is not None else settings.ADMISSION
+    if not config['ENABLED']:
+        return None
+    if settings.SERVER_MODE != 'asgi':
+        logger.warning(
+            f'Admission control is enabled with SERVER_MODE={settings.SERVER_MODE}; sync workers '
+            f'take one request at a time, so requests only queue (and can be shed) under a threaded server'
+        )
+    return AdmissionController(config['MAX_ACTIVE'], config['QUEUES'], config['QUEUE_TIMEOUT'])
+
+
+def server_snapshot() -> Dict:
+    """
+    Admission state summed over every live server process
+
+    Read from the METRICS_DIR snapshots (refreshed every few seconds;
+    this process's own state is current).
+
+    Returns:
+        processes, active, queued and saturated (every process is saturated),
+        or None without METRICS_DIR
+    """
+    directory = settings.METRICS_DIR
+    if not directory:
+        return None
+    REGISTRY.write_snapshot()
+    families = merge_snapshots(directory)
+
+    def total(name: str) -> float:
+        return sum(value for _, value in families.get(name, {}).get('samples', []))
+
+    processes = int(total(ADMISSION_PROCESSES.name))
+    return {
+        'processes': processes,
+        'active': int(total(ADMISSION_ACTIVE.name)),
+        'queued': int(total(ADMISSION_QUEUED.name)),
+        'saturated': processes > 0 and total(ADMISSION_SATURATED.name) >= processes,
+    }
+
+
+admission_controller = build_admission_controller()
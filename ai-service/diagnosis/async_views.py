@@ -0,0 +1,151 @@
+"""
+Native async (ASGI) versions of the diagnosis endpoints
+
+Served when settings.ASYNC_VIEWS is enabled. The event loop only awaits
+the request body and hands decoding, inference and disk writes to a
+bounded thread pool, so a single process can hold many in-flight uploads
+while CPU work stays capped at ASYNC_CPU_WORKERS threads.
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from rest_framework import status
+
+from .pipeline import (
+    run_image_analysis,
+    run_symptom_analysis,
+    run_combined_analysis,
+    run_batch_analysis
+)
+from .profiling import run_profiled
+from .renderers import json_response
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Bounded pool for decoding, preprocessing, inference and file writes
+cpu_executor = ThreadPoolExecutor(
+    max_workers=settings.ASYNC_CPU_WORKERS,
+    thread_name_prefix='diagnosis-cpu'
+)
+
+
+async def _run_blocking(func, *args):
+    """Run blocking pipeline work on the bounded executor"""
+    loop = asyncio.get_running_loop()
+    # Carry the request context (e.g. an active profile) into the thread
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(cpu_executor, context.run, partial(run_profiled, func, *args))
+
+
+def _csrf_exempt(view):
+    # django.views.decorators.csrf.csrf_exempt hides coroutine functions
+    # from Django 4.2's async detection, so set the flag directly
+    view.csrf_exempt = True
+    return view
+
+
+def _method_not_allowed(request):
+    return json_response(request, {
+        'detail': f'Method "{request.method}" not allowed.'
+    }, status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+def _symptoms_field(request):
+    """Symptoms from a JSON body or a multipart/form field"""
+    if request.content_type == 'application/json':
+        body = json.loads(request.body or b'{}')
+        return body.get('symptoms') if isinstance(body, dict) else None
+    return request.POST.get('symptoms')
+
+
+def _invalid_json(error: ValueError):
+    # Same payload as DRF's JSONParser
+    return {'detail': f'JSON parse error - {str(error)}'}, status.HTTP_400_BAD_REQUEST
+
+
+def _image_request(request):
+    return run_image_analysis(request.FILES.get('image'))
+
+
+def _symptom_request(request):
+    try:
+        symptoms_data = _symptoms_field(request) or {}
+    except ValueError as e:
+        return _invalid_json(e)
+    return run_symptom_analysis(symptoms_data)
+
+
+def _combined_request(request):
+    try:
+        symptoms_raw = _symptoms_field(request)
+    except ValueError as e:
+        return _invalid_json(e)
+    return run_combined_analysis(request.FILES.get('image'), symptoms_raw)
+
+
+def _batch_request(request):
+    try:
+        symptoms_raw = _symptoms_field(request)
+    except ValueError as e:
+        return _invalid_json(e)
+    return run_batch_analysis(request.FILES.getlist('images'), symptoms_raw)
+
+
+@_csrf_exempt
+async def analyze_image(request):
+    """
+    Analyze skin lesion from uploaded image (async)
+    Same input and output as views.analyze_image
+    """
+    if request.method != 'POST':
+        return _method_not_allowed(request)
+
+    # Multipart parsing touches the spooled body, so it runs off-loop too
+    payload, status_code = await _run_blocking(_image_request, request)
+    return json_response(request, payload, status_code)
+
+
+@_csrf_exempt
+async def analyze_symptoms(request):
+    """
+    Analyze based on symptom questionnaire responses (async)
+    Same input and output as views.analyze_symptoms
+    """
+    if request.method != 'POST':
+        return _method_not_allowed(request)
+
+    payload, status_code = await _run_blocking(_symptom_request, request)
+    return json_response(request, payload, status_code)
+
+
+@_csrf_exempt
+async def analyze_combined(request):
+    """
+    Perform combined analysis using both image and symptoms (async)
+    Same input and output as views.analyze_combined
+    """
+    if request.method != 'POST':
+        return _method_not_allowed(request)
+
+    payload, status_code = await _run_blocking(_combined_request, request)
+    return json_response(request, payload, status_code)
+
+
+@_csrf_exempt
+async def analyze_batch(request):
+    """
+    Analyze a batch of skin lesion images in a single request (async)
+    Same input and output as views.analyze_batch
+    """
+    if request.method != 'POST':
+        return _method_not_allowed(request)
+
+    payload, status_code = await _run_blocking(_batch_request, request)
+    return json_response(request, payload, status_code)
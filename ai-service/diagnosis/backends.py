@@ -0,0 +1,258 @@
+"""
+Inference backends for the image ensemble
+
+ModelRegistry loads every ensemble member through the backend selected by
+settings.INFERENCE_BACKEND['NAME']:
+
+- 'mock': MockMember, a NumPy stand-in for the CNNs (the default)
+- 'onnxruntime': OnnxMember, the exported networks under ONNX Runtime's
+  CPU execution provider, with graph optimization, tunable intra-/inter-op
+  thread pools and optional int8-quantized weights
+- the dotted path of any other EnsembleMember subclass
+
+Every backend takes preprocessed NHWC float32 batches with values in
+[0, 1] (see utils.preprocess_image) and returns (N, num_classes) float32
+class probabilities, so switching backends is a configuration change.
+"""
+
+import logging
+import os
+import zlib
+from typing import Dict
+
+import numpy as np
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Per-channel statistics the torchvision/timm ImageNet models were trained with
+IMAGENET_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+IMAGENET_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+    logits = logits - logits.max(axis=1, keepdims=True)
+    probabilities = np.exp(logits)
+    return (probabilities / probabilities.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+class EnsembleMember:
+    """
+    One CNN of the image ensemble
+
+    Subclasses implement load() and predict(). FORK_SAFE tells the
+    registry whether a member loaded before a fork (gunicorn preload, the
+    inference pool supervisor) can be used in the child, or has to be
+    loaded again there.
+    """
+
+    FORK_SAFE = True
+
+    def __init__(self, name: str, key: str, cost: float):
+        self.name = name
+        self.key = key
+        self.cost = cost
+
+    @classmethod
+    def load(cls, name: str, key: str, cost: float, model_path, num_classes: int,
+             input_shape: tuple = (224, 224, 3), config: Dict = None) -> 'EnsembleMember':
+        """
+        Load a member
+
+        Args:
+            name: Display name (e.g. 'ResNet50')
+            key: File stem of the model under model_path
+            cost: Relative inference cost
+            model_path: Directory holding the model files
+            num_classes: Number of output classes
+            input_shape: Model input shape (H, W, C)
+            config: Backend options (settings.INFERENCE_BACKEND)
+
+        Returns:
+            EnsembleMember instance
+        """
+        raise NotImplementedError
+
+    def predict(self, image_batch: np.ndarray) -> np.ndarray:
+        """
+        Class probabilities for a batch of preprocessed images
+
+        Args:
+            image_batch: Array of shape (N, H, W, C) with values in [0, 1]
+
+        Returns:
+            float32 array of shape (N, num_classes)
+        """
+        raise NotImplementedError
+
+
+class MockMember(EnsembleMember):
+    """
+    NumPy stand-in for a CNN
+
+    The mock network pools the input into a coarse colour grid and applies
+    a linear classifier. Its weights come from <MODEL_PATH>/<key>.npy when
+    present, otherwise they are generated deterministically from the name.
+    """
+
+    GRID = 7
+
+    def __init__(self, name: str, key: str, cost: float, weights: np.ndarray):
+        super().__init__(name, key, cost)
+        self.weights = weights
+
+    @classmethod
+    def load(cls, name: str, key: str, cost: float, model_path, num_classes: int,
+             input_shape: tuple = (224, 224, 3), config: Dict = None) -> 'MockMember':
+        num_features = cls.GRID * cls.GRID * input_shape[2]
+        weights_file = os.path.join(model_path, f"{key}.npy")
+
+        if os.path.exists(weights_file):
+            # Memory-mapped so every worker shares the same physical pages
+            weights = np.load(weights_file, mmap_mode='r')
+            if weights.shape != (num_features, num_classes):
+                raise ValueError(
+                    f"{weights_file} has shape {weights.shape}, expected {(num_features, num_classes)}"
+                )
+        else:
+            rng = np.random.default_rng(zlib.crc32(key.encode('utf-8')))
+            weights = rng.normal(0.0, 4.0, (num_features, num_classes)).astype(np.float32)
+            weights.setflags(write=False)
+
+        return cls(name, key, cost, weights)
+
+    def predict(self, image_batch: np.ndarray) -> np.ndarray:
+        n, height, width, channels = image_batch.shape
+        pooled = image_batch.reshape(
+            n, self.GRID, height // self.GRID, self.GRID, width // self.GRID, channels
+        ).mean(axis=(2, 4))
+        features = pooled.reshape(n, -1) - np.float32(0.5)
+        return softmax(features @ self.weights)
+
+
+class OnnxMember(EnsembleMember):
+    """
+    An exported CNN run by ONNX Runtime on the CPU
+
+    Loads <MODEL_PATH>/<key>.onnx, or <key>.int8.onnx with QUANTIZED (see
+    `manage.py quantize_models`). Models may take NCHW or NHWC input (read
+    from the graph); INPUT_NORMALIZATION and OUTPUTS describe how they
+    were exported.
+    """
+
+    # ONNX Runtime's thread pools do not survive fork()
+    FORK_SAFE = False
+
+    GRAPH_OPTIMIZATION_LEVELS = {
+        'disable': 'ORT_DISABLE_ALL',
+        'basic': 'ORT_ENABLE_BASIC',
+        'extended': 'ORT_ENABLE_EXTENDED',
+        'all': 'ORT_ENABLE_ALL',
+    }
+
+    def __init__(self, name: str, key: str, cost: float, session, channels_first: bool,
+                 normalization: str, outputs: str):
+        super().__init__(name, key, cost)
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+        self.channels_first = channels_first
+        self.normalization = normalization
+        self.outputs = outputs
+
+    @staticmethod
+    def model_file(model_path, key: str, quantized: bool) -> str:
+        return os.path.join(model_path, f"{key}.int8.onnx" if quantized else f"{key}.onnx")
+
+    @classmethod
+    def session_options(cls, config: Dict):
+        """ONNX Runtime session options for the configured optimization and threads"""
+        ort = _onnxruntime()
+        level = cls.GRAPH_OPTIMIZATION_LEVELS.get(config['GRAPH_OPTIMIZATION'])
+        if level is None:
+            raise ImproperlyConfigured(
+                f"INFERENCE_GRAPH_OPTIMIZATION must be one of {', '.join(cls.GRAPH_OPTIMIZATION_LEVELS)}"
+            )
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, level)
+        # 0 lets ONNX Runtime use one thread per physical core
+        options.intra_op_num_threads = config['INTRA_OP_THREADS']
+        options.inter_op_num_threads = config['INTER_OP_THREADS']
+        options.execution_mode = (
+            ort.ExecutionMode.ORT_PARALLEL if config['INTER_OP_THREADS'] > 1
+            else ort.ExecutionMode.ORT_SEQUENTIAL
+        )
+        return options
+
+    @classmethod
+    def load(cls, name: str, key: str, cost: float, model_path, num_classes: int,
+             input_shape: tuple = (224, 224, 3), config: Dict = None) -> 'OnnxMember':
+        ort = _onnxruntime()
+        model_file = cls.model_file(model_path, key, config['QUANTIZED'])
+        if not os.path.exists(model_file):
+            raise FileNotFoundError(f"{name} model not found at {model_file}")
+
+        session = ort.InferenceSession(
+            model_file, sess_options=cls.session_options(config), providers=['CPUExecutionProvider']
+        )
+
+        model_input = session.get_inputs()[0].shape
+        if len(model_input) != 4:
+            raise ValueError(f"{model_file} takes a rank {len(model_input)} input, expected 4")
+        channels_first = model_input[1] == input_shape[2]
+
+        model_output = session.get_outputs()[0].shape
+        if isinstance(model_output[-1], int) and model_output[-1] != num_classes:
+            raise ValueError(f"{model_file} outputs {model_output[-1]} classes, expected {num_classes}")
+
+        if config['INPUT_NORMALIZATION'] not in ('imagenet', 'none'):
+            raise ImproperlyConfigured("INFERENCE_INPUT_NORMALIZATION must be 'imagenet' or 'none'")
+        if config['OUTPUTS'] not in ('logits', 'probabilities'):
+            raise ImproperlyConfigured("INFERENCE_OUTPUTS must be 'logits' or 'probabilities'")
+
+        return cls(name, key, cost, session, channels_first, config['INPUT_NORMALIZATION'], config['OUTPUTS'])
+
+    def prepare(self, image_batch: np.ndarray) -> np.ndarray:
+        """Model input for a preprocessed NHWC batch"""
+        batch = image_batch.astype(np.float32, copy=False)
+        if self.normalization == 'imagenet':
+            batch = (batch - IMAGENET_MEAN) / IMAGENET_STD
+        if self.channels_first:
+            batch = batch.transpose(0, 3, 1, 2)
+        return np.ascontiguousarray(batch)
+
+    def predict(self, image_batch: np.ndarray) -> np.ndarray:
+        output = self.session.run(None, {self.input_name: self.prepare(image_batch)})[0]
+        if self.outputs == 'logits':
+            return softmax(output)
+        return output.astype(np.float32, copy=False)
+
+
+BACKENDS = {
+    'mock': MockMember,
+    'onnxruntime': OnnxMember,
+}
+
+
+def _onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise ImproperlyConfigured(
+            "INFERENCE_BACKEND=onnxruntime requires the onnxruntime package (pip install onnxruntime)"
+        )
+    return onnxruntime
+
+
+def get_backend(name: str):
+    """EnsembleMember class for a backend name or dotted path"""
+    backend = BACKENDS.get(name)
+    if backend is None:
+        try:
+            backend = import_string(name)
+        except ImportError:
+            raise ImproperlyConfigured(
+                f"Unknown INFERENCE_BACKEND {name!r}; use {', '.join(BACKENDS)} or a dotted class path"
+            )
+    return backend
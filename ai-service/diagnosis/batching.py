@@ -0,0 +1,125 @@
+"""
+Dynamic micro-batching of concurrent inference calls
+
+Clients mostly send one image per request, but a server process handling
+requests concurrently (uvicorn workers, or threads) can run the models on
+several of them at once for little more than the cost of one. MicroBatcher
+collects concurrent single-item calls into one batch:
+
+- the first caller to arrive opens a batch and waits up to max_wait_ms
+  for others to join (or until max_batch_size items are queued),
+- it then runs the whole batch with one run_batch call on its own thread,
+- every caller gets its own result (or exception) back.
+
+There is no dispatcher thread: whichever request opened a batch runs it,
+so several batches can be in flight at once and nothing has to be
+restarted after gunicorn forks a worker.
+"""
+
+import logging
+import threading
+import time
+from typing import Callable, List
+
+from .metrics import MICRO_BATCH_SIZE, MICRO_BATCH_WAIT_SECONDS, MICRO_BATCHES
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    __slots__ = ('items', 'results', 'opened', 'full', 'done')
+
+    def __init__(self):
+        self.items = []
+        self.results = None
+        self.opened = time.perf_counter()
+        self.full = threading.Event()
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Collects concurrent single-item calls into batched calls
+    """
+
+    def __init__(self, run_batch: Callable[[List], List], max_batch_size: int = 16,
+                 max_wait_ms: float = 5.0, name: str = 'default'):
+        """
+        Args:
+            run_batch: Processes a list of items, returning one result per item
+            max_batch_size: Largest batch (1 disables batching)
+            max_wait_ms: Longest time the first item waits for others
+            name: Label of this batcher's metrics
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self.name = name
+        self._open = None
+        self._lock = threading.Lock()
+
+    def submit(self, item):
+        """
+        Process one item as part of the next batch
+
+        Blocks until the batch it joined has run.
+
+        Args:
+            item: One input of run_batch
+
+        Returns:
+            The result run_batch produced for this item; raises what
+            processing it raised
+        """
+        with self._lock:
+            batch = self._open
+            leader = batch is None
+            if leader:
+                batch = self._open = _Batch()
+            index = len(batch.items)
+            batch.items.append(item)
+            if len(batch.items) >= self.max_batch_size:
+                self._open = None
+                batch.full.set()
+
+        if leader:
+            filled = batch.full.wait(self.max_wait)
+            with self._lock:
+                if self._open is batch:
+                    self._open = None
+            self._run(batch, 'full' if filled else 'timeout')
+        else:
+            batch.done.wait()
+
+        result = batch.results[index]
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+    def _run(self, batch: _Batch, reason: str):
+        size = len(batch.items)
+        MICRO_BATCHES.inc(batcher=self.name, reason=reason)
+        MICRO_BATCH_SIZE.observe(size, batcher=self.name)
+        MICRO_BATCH_WAIT_SECONDS.observe(time.perf_counter() - batch.opened, batcher=self.name)
+
+        try:
+            batch.results = self._process(batch.items)
+        finally:
+            if batch.results is None:
+                batch.results = [RuntimeError('Batch was not processed')] * size
+            batch.done.set()
+
+    def _process(self, items: List) -> List:
+        try:
+            results = self.run_batch(items)
+        except Exception as e:
+            if len(items) == 1:
+                return [e]
+            # Retry one by one so a bad item only fails its own request
+            logger.warning(f'Batch of {len(items)} failed ({str(e)}); retrying items individually')
+            return [self._process([item])[0] for item in items]
+
+        if len(results) != len(items):
+            error = RuntimeError(f'Batch of {len(items)} items returned {len(results)} results')
+            return [error] * len(items)
+        return list(results)
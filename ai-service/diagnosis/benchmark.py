@@ -0,0 +1,419 @@
+"""
+Benchmark harness for the diagnosis API
+
+Builds a deterministic synthetic image corpus, times each pipeline stage
+in-process, drives the analyze endpoints at several concurrency levels
+(in-process through the Django test client, or over HTTP against a
+running server) and compares the report with a stored baseline.
+
+Run it through the management command:
+    python manage.py benchmark --output report.json
+"""
+
+import json
+import os
+import platform
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import cv2
+import numpy as np
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from .renderers import FastJSONRenderer
+from .uploads import ImageUploadHandler
+from .utils import (
+    generate_attention_map,
+    generate_gradcam_heatmap,
+    preprocess_image,
+    save_uploaded_image,
+    validate_image
+)
+
+# Named resolutions (width, height)
+RESOLUTIONS = {
+    '256px': (256, 256),
+    '1080p': (1920, 1080),
+    '12mp': (4000, 3000),
+}
+
+FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', [cv2.IMWRITE_JPEG_QUALITY, 90]),
+    'png': ('.png', 'image/png', []),
+}
+
+STAGES = ('save', 'validate', 'preprocess', 'inference', 'heatmap', 'serialize')
+
+ENDPOINTS = ('image', 'symptoms', 'combined')
+
+SYMPTOM_SAMPLES = [
+    {'lesion_color': 'dark brown', 'lesion_shape': 'irregular', 'size_change': 'growing', 'bleeding': 'yes'},
+    {'lesion_color': 'pink', 'texture': 'pearly with visible vessels', 'bleeding': 'occasionally'},
+    {'lesion_color': 'brown', 'texture': 'waxy, stuck-on', 'itching': 'sometimes'},
+    {'texture': 'rough and scaly', 'sun_exposure': 'frequent', 'itching': 'no'},
+    {'lesion_color': 'tan', 'lesion_shape': 'round and symmetric', 'size_change': 'stable'},
+    {'texture': 'firm nodule', 'location': 'leg', 'itching': 'no'},
+]
+
+
+def synthetic_image(width: int, height: int, image_format: str, seed: int = 0) -> bytes:
+    """
+    Encode a deterministic lesion-like test image
+
+    A dark elliptical lesion on a skin-toned background with low-frequency
+    texture, so PNGs compress like photographs rather than like noise.
+
+    Args:
+        width: Image width in pixels
+        height: Image height in pixels
+        image_format: Key of FORMATS ('jpeg' or 'png')
+        seed: Seed for the lesion shape and texture
+
+    Returns:
+        Encoded image bytes
+    """
+    rng = np.random.default_rng(seed)
+
+    y, x = np.ogrid[0:height, 0:width]
+    center_x, center_y = rng.uniform(0.35, 0.65, 2) * (width, height)
+    radius = rng.uniform(0.15, 0.3) * min(width, height)
+    distance = np.sqrt((x - center_x) ** 2 + ((y - center_y) * rng.uniform(0.7, 1.3)) ** 2) / radius
+    lesion = np.clip(1.2 - distance, 0, 1).astype(np.float32)[..., np.newaxis]
+
+    skin = np.array([150, 180, 225], dtype=np.float32)  # BGR
+    dark = np.array([40, 60, 100], dtype=np.float32)
+    texture = cv2.resize(
+        rng.normal(0, 6, (max(height // 8, 1), max(width // 8, 1))).astype(np.float32),
+        (width, height), interpolation=cv2.INTER_LINEAR
+    )[..., np.newaxis]
+
+    pixels = np.clip(skin * (1 - lesion) + dark * lesion + texture, 0, 255).astype(np.uint8)
+
+    extension, _, params = FORMATS[image_format]
+    ok, encoded = cv2.imencode(extension, pixels, params)
+    if not ok:
+        raise ValueError(f'Could not encode {image_format} test image')
+    return encoded.tobytes()
+
+
+def build_corpus(resolutions=None, formats=None, seed: int = 0) -> List[Dict]:
+    """
+    One synthetic image per (resolution, format) case
+
+    Args:
+        resolutions: Keys of RESOLUTIONS (defaults to all)
+        formats: Keys of FORMATS (defaults to all)
+        seed: Corpus seed
+
+    Returns:
+        List of {'case', 'name', 'content_type', 'data'} dictionaries
+    """
+    corpus = []
+    for resolution in resolutions or RESOLUTIONS:
+        width, height = RESOLUTIONS[resolution]
+        for image_format in formats or FORMATS:
+            extension, content_type, _ = FORMATS[image_format]
+            corpus.append({
+                'case': f'{resolution}-{image_format}',
+                'name': f'{resolution}{extension}',
+                'content_type': content_type,
+                'data': synthetic_image(width, height, image_format, seed),
+            })
+    return corpus
+
+
+def unique_variant(item: Dict, counter: int) -> bytes:
+    """
+    Image bytes with a trailer after the end-of-image marker
+
+    Decoders ignore the trailer, but the digest changes, so repeated
+    requests miss the result cache and measure the full pipeline.
+    """
+    return item['data'] + b'\0benchmark' + counter.to_bytes(8, 'little')
+
+
+def summarize(samples: List[float]) -> Dict:
+    """Latency summary in milliseconds for samples given in seconds"""
+    if not samples:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'p50_ms': round(ordered[len(ordered) // 2] * 1000, 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident set size of this process so far (None if unavailable)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if platform.system() == 'Darwin' else 1024), 1)
+
+
+def environment() -> Dict:
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def _stream_upload(item: Dict, data: bytes):
+    """Feed bytes through the upload handler the way a request body arrives"""
+    handler = ImageUploadHandler()
+    handler.new_file('image', item['name'], item['content_type'], len(data))
+    for offset in range(0, len(data), handler.chunk_size):
+        handler.receive_data_chunk(data[offset:offset + handler.chunk_size], offset)
+    return handler.file_complete(len(data))
+
+
+def time_stages(item: Dict, service, repeats: int = 5) -> Dict:
+    """
+    Time each pipeline stage for one corpus image
+
+    Stages: save (streaming hash and store), validate (decode),
+    preprocess, inference, heatmap (Grad-CAM and attention rendering)
+    and serialize (JSON rendering of the response).
+
+    Args:
+        item: Corpus entry from build_corpus
+        service: MockMLService instance
+        repeats: Measured runs (after one warm-up run)
+
+    Returns:
+        {stage: latency summary}
+    """
+    timings = {stage: [] for stage in STAGES}
+    renderer = FastJSONRenderer()
+
+    for run in range(repeats + 1):
+        data = unique_variant(item, run)
+        marks = [time.perf_counter()]
+
+        upload = _stream_upload(item, data)
+        marks.append(time.perf_counter())
+
+        # Decoding moves the streamed upload into the store
+        image = validate_image(upload)
+        image_path = save_uploaded_image(upload)
+        marks.append(time.perf_counter())
+
+        image_array = preprocess_image(image)
+        marks.append(time.perf_counter())
+
+        results = service.analyze_image(image_path, image_array)
+        marks.append(time.perf_counter())
+
+        generate_gradcam_heatmap(image_path, image)
+        generate_attention_map(image_path, image)
+        marks.append(time.perf_counter())
+
+        renderer.render({'success': True, 'diagnosis': results})
+        marks.append(time.perf_counter())
+
+        if run == 0:
+            continue
+        for stage, start, end in zip(STAGES, marks, marks[1:]):
+            timings[stage].append(end - start)
+
+    return {stage: summarize(samples) for stage, samples in timings.items()}
+
+
+class InProcessTransport:
+    """Sends requests through the Django test client (one per thread)"""
+
+    name = 'in-process'
+
+    def __init__(self, prefix: str = '/api'):
+        self.prefix = prefix
+        self._local = threading.local()
+
+    def _client(self):
+        if not hasattr(self._local, 'client'):
+            from django.test import Client
+            self._local.client = Client()
+        return self._local.client
+
+    def post(self, path: str, files: Dict = None, fields: Dict = None, json_body: Dict = None) -> int:
+        client = self._client()
+        if json_body is not None:
+            response = client.post(self.prefix + path, json.dumps(json_body), content_type='application/json')
+        else:
+            data = dict(fields or {})
+            for field, (name, content_type, content) in (files or {}).items():
+                data[field] = SimpleUploadedFile(name, content, content_type=content_type)
+            response = client.post(self.prefix + path, data)
+        return response.status_code
+
+
+class HttpTransport:
+    """Sends requests to a running server with urllib"""
+
+    def __init__(self, base_url: str, timeout: float = 120):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.name = self.base_url
+
+    def post(self, path: str, files: Dict = None, fields: Dict = None, json_body: Dict = None) -> int:
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            body, content_type = _encode_multipart(fields or {}, files or {})
+
+        request = urllib.request.Request(
+            self.base_url + path, data=body, method='POST',
+            headers={'Content-Type': content_type}
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+
+def _encode_multipart(fields: Dict, files: Dict):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8')
+        )
+    for name, (filename, content_type, content) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: {content_type}\r\n\r\n'.encode('utf-8') + content + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def send_request(transport, endpoint: str, item: Dict, counter: int) -> int:
+    """
+    Send one analyze request with cache-busting content
+
+    Args:
+        transport: InProcessTransport or HttpTransport
+        endpoint: 'image', 'symptoms' or 'combined'
+        item: Corpus entry (unused for 'symptoms')
+        counter: Request number, used to make the content unique
+
+    Returns:
+        HTTP status code
+    """
+    symptoms = dict(SYMPTOM_SAMPLES[counter % len(SYMPTOM_SAMPLES)], benchmark_request=counter)
+
+    if endpoint == 'symptoms':
+        return transport.post('/analyze/symptoms', json_body={'symptoms': symptoms})
+
+    files = {'image': (item['name'], item['content_type'], unique_variant(item, counter))}
+    if endpoint == 'image':
+        return transport.post('/analyze/image', files=files)
+    return transport.post('/analyze/combined', files=files, fields={'symptoms': json.dumps(symptoms)})
+
+
+def run_load(transport, endpoint: str, corpus: List[Dict], concurrency: int,
+             total_requests: int, counter_offset: int = 0) -> Dict:
+    """
+    Send total_requests requests from `concurrency` threads
+
+    Args:
+        transport: InProcessTransport or HttpTransport
+        endpoint: 'image', 'symptoms' or 'combined'
+        corpus: Images cycled through by the requests
+        concurrency: Number of client threads
+        total_requests: Requests to send
+        counter_offset: First request number (keeps content unique across runs)
+
+    Returns:
+        Throughput, error count and latency summary
+    """
+    def timed(counter):
+        start = time.perf_counter()
+        try:
+            status_code = send_request(transport, endpoint, corpus[counter % len(corpus)], counter)
+        except Exception:
+            status_code = None
+        return status_code, time.perf_counter() - start
+
+    counters = range(counter_offset, counter_offset + total_requests)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(timed, counters))
+    wall = time.perf_counter() - start
+
+    latencies = [elapsed for status_code, elapsed in outcomes if status_code == 200]
+    return {
+        'concurrency': concurrency,
+        'requests': total_requests,
+        'errors': total_requests - len(latencies),
+        'throughput_rps': round(len(latencies) / wall, 3) if wall > 0 else 0.0,
+        **summarize(latencies),
+    }
+
+
+def compare(report: Dict, baseline: Dict, tolerance: float = 0.10) -> List[Dict]:
+    """
+    Compare a report with a baseline report
+
+    Stage and request latencies (p50, p95) and peak RSS regress when they
+    grow by more than `tolerance`; throughput regresses when it drops by
+    more than `tolerance`. Metrics missing from either report are skipped.
+
+    Args:
+        report: Current benchmark report
+        baseline: Stored baseline report
+        tolerance: Allowed relative change (0.10 = 10%)
+
+    Returns:
+        One row per compared metric
+    """
+    rows = []
+
+    def add(metric, base_value, value, higher_is_better=False):
+        if not base_value or value is None:
+            return
+        change = (value - base_value) / base_value
+        worse = -change if higher_is_better else change
+        rows.append({
+            'metric': metric,
+            'baseline': base_value,
+            'current': value,
+            'change': round(change, 4),
+            'regression': worse > tolerance,
+        })
+
+    for case, stages in report.get('stages', {}).items():
+        for stage, summary in stages.items():
+            base = baseline.get('stages', {}).get(case, {}).get(stage, {})
+            add(f'stage {case} {stage} p50_ms', base.get('p50_ms'), summary.get('p50_ms'))
+
+    for endpoint, levels in report.get('load', {}).items():
+        for concurrency, summary in levels.items():
+            base = baseline.get('load', {}).get(endpoint, {}).get(concurrency, {})
+            prefix = f'load {endpoint} c={concurrency}'
+            add(f'{prefix} throughput_rps', base.get('throughput_rps'), summary.get('throughput_rps'),
+                higher_is_better=True)
+            add(f'{prefix} p50_ms', base.get('p50_ms'), summary.get('p50_ms'))
+            add(f'{prefix} p95_ms', base.get('p95_ms'), summary.get('p95_ms'))
+
+    add('peak_rss_mb', baseline.get('peak_rss_mb'), report.get('peak_rss_mb'))
+    return rows
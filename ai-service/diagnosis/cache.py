@@ -0,0 +1,230 @@
+"""
+Content-addressed cache for diagnosis results
+
+Results are keyed by a digest of the uploaded image bytes plus a
+canonicalized symptoms payload, so retries of the same photo and
+questionnaire skip the whole pipeline (save, heatmap and inference).
+Equivalent questionnaires share an entry, so results are stored without
+the echoed matched_symptoms and a hit echoes the current request's own.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import replace
+from typing import Dict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .metrics import CACHE_LOOKUPS
+
+logger = logging.getLogger(__name__)
+
+
+def canonicalize_symptoms(symptoms_data) -> str:
+    """
+    Serialize symptoms so equivalent payloads produce the same string
+
+    Keys are sorted and string values are lowercased and stripped.
+
+    Args:
+        symptoms_data: Symptom dictionary (or None)
+
+    Returns:
+        Canonical JSON string
+    """
+    def normalize(value):
+        if isinstance(value, dict):
+            return {str(k): normalize(v) for k, v in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        if isinstance(value, str):
+            return value.strip().lower()
+        return value
+
+    return json.dumps(normalize(symptoms_data or {}), sort_keys=True, separators=(',', ':'))
+
+
+class LocalMemoryBackend:
+    """
+    In-process LRU cache with per-entry TTL
+    Each worker process keeps its own copy
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: int = 3600, **kwargs):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCacheBackend:
+    """
+    Cache backed by a Django cache alias, shared between workers
+
+    Point the alias at Redis in production; the default local-memory
+    Django cache works as a stand-in for development. Eviction beyond
+    the TTL is left to the store (e.g. Redis maxmemory-policy).
+    """
+
+    def __init__(self, alias: str = 'default', ttl: int = 3600, **kwargs):
+        from django.core.cache import caches
+
+        self.cache = caches[alias]
+        self.ttl = ttl
+
+    def get(self, key: str):
+        return self.cache.get(key)
+
+    def set(self, key: str, value):
+        self.cache.set(key, value, timeout=self.ttl or None)
+
+    def clear(self):
+        self.cache.clear()
+
+
+BACKENDS = {
+    'local': LocalMemoryBackend,
+    'django': DjangoCacheBackend,
+}
+
+
+class ResultCache:
+    """
+    Diagnosis result cache in front of the analysis pipeline
+
+    Lookups never raise: a failing backend is logged and treated as a miss,
+    so an unavailable shared store only costs a recomputation.
+    """
+
+    # Versioned with the stored result type (results.Diagnosis)
+    KEY_PREFIX = 'healio:diagnosis:v2'
+
+    def __init__(self, backend=None):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.backend is not None
+
+    def make_key(self, namespace: str, image_digest: str = None, symptoms_data: Dict = None) -> str:
+        """
+        Build the cache key for an analysis request
+
+        Args:
+            namespace: Analysis type ('image', 'symptoms' or 'combined')
+            image_digest: Hex digest of the uploaded image bytes
+            symptoms_data: Symptom dictionary
+
+        Returns:
+            Cache key string
+        """
+        payload = f"{image_digest or ''}|{canonicalize_symptoms(symptoms_data)}"
+        digest = hashlib.sha256(payload.encode('utf-8')).hexdigest()
+        return f"{self.KEY_PREFIX}:{namespace}:{digest}"
+
+    def get(self, key: str, symptoms_data: Dict = None):
+        """
+        Stored result for a key, or None on a miss
+
+        Args:
+            key: Key from make_key
+            symptoms_data: The current request's symptoms, echoed as the
+                result's matched_symptoms (the stored result may come
+                from a differently spelled equivalent questionnaire)
+
+        Returns:
+            The result (a copy when symptoms_data is given), or None
+        """
+        if not self.enabled:
+            return None
+
+        try:
+            value = self.backend.get(key)
+        except Exception as e:
+            logger.error(f'Result cache lookup failed: {str(e)}', exc_info=True)
+            value = None
+
+        # Keys look like '<KEY_PREFIX>:<namespace>:<digest>'
+        namespace = key[len(self.KEY_PREFIX) + 1:].split(':', 1)[0]
+        if value is None:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(namespace=namespace, result='miss')
+        else:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(namespace=namespace, result='hit')
+            if symptoms_data:
+                value = replace(value, matched_symptoms=symptoms_data)
+        return value
+
+    def set(self, key: str, value):
+        """Store a result for a key (without its matched_symptoms)"""
+        if not self.enabled:
+            return
+        if getattr(value, 'matched_symptoms', None) is not None:
+            value = replace(value, matched_symptoms=None)
+
+        try:
+            self.backend.set(key, value)
+        except Exception as e:
+            logger.error(f'Result cache store failed: {str(e)}', exc_info=True)
+
+
+def build_result_cache(config: Dict = None) -> ResultCache:
+    """
+    Create the result cache described by settings.RESULT_CACHE
+
+    BACKEND may be 'local', 'django', 'none', or the dotted path of a class
+    implementing get/set/clear.
+
+    Args:
+        config: Cache configuration (defaults to settings.RESULT_CACHE)
+
+    Returns:
+        ResultCache instance
+    """
+    config = dict(config if config is not None else settings.RESULT_CACHE)
+    backend_name = config.pop('BACKEND', 'local')
+
+    if not backend_name or backend_name == 'none':
+        return ResultCache()
+
+    backend_class = BACKENDS.get(backend_name) or import_string(backend_name)
+    backend = backend_class(
+        max_entries=config.get('MAX_ENTRIES', 1024),
+        ttl=config.get('TTL', 3600),
+        alias=config.get('CACHE_ALIAS', 'default'),
+    )
+    return ResultCache(backend)
@@ -0,0 +1,393 @@
+"""
+Dedicated inference worker processes
+
+With INFERENCE_POOL['WORKERS'] > 0 the ensemble runs in a separate pool of
+processes instead of inside every request worker, so HTTP concurrency
+(gunicorn workers) and CPU-bound inference (pool workers) scale
+independently and only the pool holds the models.
+
+    request worker                         inference pool
+    --------------                         --------------
+    preprocess -> tensor
+    copy into its SharedMemory segment
+    connect to SOCKET, send header  ---->  one idle worker accepts
+      {"op": "predict", "shm": name,       attaches the segment by name
+       "shape": [...], "dtype": ...,       runs registry.predict on it in
+       ["cascade": {...}]}                 place (predict_cascade with "cascade")
+    read probabilities             <----   replies with the raw bytes
+
+Tensors never go through pickle or the socket: each request thread keeps
+one shared memory segment (grown as needed) and only its name travels.
+Every call uses a fresh connection, so calls are picked up by whichever
+workers are idle. `manage.py inference_pool` runs the pool (gunicorn
+starts it as a child process, see gunicorn.conf.py); its supervisor
+loads and warms the models once and forks the workers, which share the
+weights copy-on-write and are restarted if they die. Backends that are
+not fork-safe (ONNX Runtime) are never loaded in the supervisor; every
+worker loads its own copy.
+
+The socket is created readable by its owner only, and both ends prove
+they know INFERENCE_POOL['AUTHKEY'] (HMAC challenge, see
+multiprocessing.connection) before any request is read.
+"""
+
+import atexit
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from multiprocessing import AuthenticationError, get_context, resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener, answer_challenge, deliver_challenge
+from typing import Dict, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from .metrics import REGISTRY, stage, timed
+from .registry import ModelRegistry
+
+logger = logging.getLogger(__name__)
+
+# Shared memory segments are allocated in multiples of this
+SEGMENT_ALIGNMENT = 1024 * 1024
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    """Open a segment created by a request worker without taking ownership"""
+    segment = shared_memory.SharedMemory(name=name)
+    # The creator unlinks it; keep this process's resource tracker from
+    # unlinking it too when this process exits (Python < 3.13 registers
+    # every attached segment)
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+
+def _handle(connection, registry: ModelRegistry):
+    request = json.loads(connection.recv_bytes())
+    op = request.get('op')
+
+    if op == 'status':
+        connection.send_bytes(json.dumps({
+            'pid': os.getpid(),
+            'members': [member.name for member in registry.members],
+            'backend': registry.backend_config['NAME'],
+            'warm': registry.warm,
+        }).encode('utf-8'))
+        return
+
+    if op != 'predict':
+        raise ValueError(f'Unknown operation {op!r}')
+
+    segment = _attach(request['shm'])
+    try:
+        image_batch = np.ndarray(tuple(request['shape']), dtype=request['dtype'], buffer=segment.buf)
+        cascade = request.get('cascade')
+        with stage('inference_pool.predict'):
+            if cascade is None:
+                probabilities, models_run = registry.predict(image_batch), None
+            else:
+                probabilities, models_run = registry.predict_cascade(image_batch, **cascade)
+            probabilities = np.ascontiguousarray(probabilities, dtype=np.float32)
+        # Drop the view before closing the segment it points into
+        del image_batch
+    finally:
+        segment.close()
+
+    header = {'shape': probabilities.shape, 'dtype': 'float32'}
+    if models_run is not None:
+        header['models_run'] = models_run.tolist()
+    connection.send_bytes(json.dumps(header).encode('utf-8'))
+    connection.send_bytes(probabilities)
+
+
+def _exit_with_parent(parent_pid: int):
+    """Stop a worker whose supervisor died without terminating it"""
+    while os.getppid() == parent_pid:
+        time.sleep(1.0)
+    os._exit(0)
+
+
+def _serve(listener: Listener, registry: ModelRegistry, parent_pid: int):
+    """Worker loop: accept one call at a time while idle"""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    threading.Thread(target=_exit_with_parent, args=(parent_pid,), daemon=True).start()
+    REGISTRY.ensure_snapshot_writer()
+    if not registry.warm:
+        registry.warm_up()
+
+    while True:
+        try:
+            connection = listener.accept()
+        except AuthenticationError as e:
+            logger.warning(f'Inference worker rejected a connection: {str(e)}')
+            continue
+        except (OSError, EOFError) as e:
+            logger.warning(f'Inference worker could not accept a connection: {str(e)}')
+            time.sleep(0.1)
+            continue
+
+        with connection:
+            try:
+                _handle(connection, registry)
+            except (EOFError, ConnectionError):
+                pass
+            except Exception as e:
+                logger.error(f'Inference call failed: {str(e)}', exc_info=True)
+                try:
+                    connection.send_bytes(json.dumps({'error': str(e)}).encode('utf-8'))
+                except OSError:
+                    pass
+
+
+class InferencePool:
+    """
+    Supervisor of the inference worker processes
+    """
+
+    def __init__(self, address: str, workers: int, registry: ModelRegistry, authkey: bytes):
+        """
+        Args:
+            address: Unix socket path the workers listen on
+            workers: Number of worker processes
+            registry: Model registry to load and serve
+            authkey: Shared secret clients must prove they know
+        """
+        self.address = address
+        self.workers = workers
+        self.registry = registry
+        self.authkey = authkey
+        self._processes = []
+        self._stopping = False
+
+    def serve_forever(self):
+        """Load the models, start the workers and restart any that die until SIGTERM"""
+        if self.registry.backend.FORK_SAFE:
+            self.registry.load()
+            self.registry.warm_up()
+
+        if os.path.exists(self.address):
+            os.remove(self.address)
+        # Bind with the socket already owner-only (a chmod afterwards would
+        # leave it open to other users in between)
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(self.address, family='AF_UNIX', backlog=128, authkey=self.authkey)
+        finally:
+            os.umask(umask)
+
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        context = get_context('fork')
+        self._processes = [self._start_worker(context, listener, index) for index in range(self.workers)]
+        logger.info(f'Inference pool serving {self.address} with {self.workers} workers')
+
+        try:
+            while not self._stopping:
+                time.sleep(1.0)
+                for index, process in enumerate(self._processes):
+                    if not process.is_alive() and not self._stopping:
+                        logger.warning(f'Inference worker {process.pid} exited with {process.exitcode}; restarting')
+                        self._processes[index] = self._start_worker(context, listener, index)
+        finally:
+            for process in self._processes:
+                process.terminate()
+            for process in self._processes:
+                process.join(timeout=5)
+            listener.close()
+            logger.info('Inference pool stopped')
+
+    def _start_worker(self, context, listener: Listener, index: int):
+        process = context.Process(
+            target=_serve, args=(listener, self.registry, os.getpid()), name=f'inference-{index}', daemon=True
+        )
+        process.start()
+        return process
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+
+class InferencePoolClient:
+    """
+    Stand-in for ModelRegistry that runs the ensemble in the inference pool
+
+    Pass it to MockMLService as the registry; predict() has the same
+    signature and results as ModelRegistry.predict.
+    """
+
+    def __init__(self, address: str, authkey: bytes, timeout: float = 30.0):
+        """
+        Args:
+            address: Unix socket path of the pool
+            authkey: Shared secret of the pool
+            timeout: Seconds to wait for the pool to accept and answer a call
+        """
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self._local = threading.local()
+        self._segments = []
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    @property
+    def loaded(self) -> bool:
+        try:
+            return bool(self.status()['members'])
+        except Exception:
+            return False
+
+    @property
+    def warm(self) -> bool:
+        try:
+            return self.status()['warm']
+        except Exception:
+            return False
+
+    def status(self, timeout: float = None) -> Dict:
+        """
+        Ensemble members and warm-up state reported by a pool worker
+
+        Args:
+            timeout: Seconds to wait for the pool (defaults to the client timeout)
+        """
+        return json.loads(self._call({'op': 'status'}, timeout))
+
+    def predict(self, image_batch: np.ndarray) -> np.ndarray:
+        """
+        Ensemble class probabilities computed by a pool worker
+
+        Args:
+            image_batch: Array of shape (N, H, W, C)
+
+        Returns:
+            float32 array of shape (N, num_classes)
+        """
+        return self._predict(image_batch)[0]
+
+    def predict_cascade(self, image_batch: np.ndarray, threshold: float, margin: float,
+                        severe_classes: Sequence[int] = (),
+                        severe_min_probability: float = 1.0) -> Tuple[np.ndarray, np.ndarray]:
+        """Early-exit ensemble probabilities computed by a pool worker (see ModelRegistry.predict_cascade)"""
+        probabilities, header = self._predict(image_batch, {
+            'threshold': threshold,
+            'margin': margin,
+            'severe_classes': [int(index) for index in severe_classes],
+            'severe_min_probability': severe_min_probability,
+        })
+        return probabilities, np.asarray(header['models_run'], dtype=np.int64)
+
+    @timed('inference_pool.call')
+    def _predict(self, image_batch: np.ndarray, cascade: Dict = None) -> Tuple[np.ndarray, Dict]:
+        image_batch = np.asarray(image_batch)
+        dtype = np.float32 if image_batch.dtype == np.float64 else image_batch.dtype
+        segment = self._segment(image_batch.size * np.dtype(dtype).itemsize)
+        shared = np.ndarray(image_batch.shape, dtype=dtype, buffer=segment.buf)
+        shared[...] = image_batch
+        del shared
+
+        with self._connect() as connection:
+            request = {
+                'op': 'predict',
+                'shm': segment.name,
+                'shape': image_batch.shape,
+                'dtype': np.dtype(dtype).name,
+            }
+            if cascade is not None:
+                request['cascade'] = cascade
+            connection.send_bytes(json.dumps(request).encode('utf-8'))
+            header = json.loads(self._receive(connection))
+            if 'error' in header:
+                raise RuntimeError(f"Inference pool error: {header['error']}")
+            data = self._receive(connection)
+
+        return np.frombuffer(data, dtype=header['dtype']).reshape(header['shape']), header
+
+    def close(self):
+        """Unlink the shared memory segments created by this process"""
+        with self._lock:
+            segments, self._segments = self._segments, []
+        for pid, segment in segments:
+            if pid != os.getpid():
+                continue
+            segment.close()
+            try:
+                segment.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _segment(self, nbytes: int) -> shared_memory.SharedMemory:
+        """This thread's segment, replaced by a larger one when needed"""
+        segment = getattr(self._local, 'segment', None)
+        if segment is not None and getattr(self._local, 'pid', None) == os.getpid() and segment.size >= nbytes:
+            return segment
+
+        size = max(SEGMENT_ALIGNMENT, -(-nbytes // SEGMENT_ALIGNMENT) * SEGMENT_ALIGNMENT)
+        new_segment = shared_memory.SharedMemory(create=True, size=size)
+        with self._lock:
+            if segment is not None and getattr(self._local, 'pid', None) == os.getpid():
+                self._segments = [entry for entry in self._segments if entry[1] is not segment]
+                segment.close()
+                segment.unlink()
+            self._segments.append((os.getpid(), new_segment))
+        self._local.segment = new_segment
+        self._local.pid = os.getpid()
+        return new_segment
+
+    def _connect(self, timeout: float = None):
+        """Connect to the pool, waiting for it to come up within the timeout"""
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        delay = 0.05
+        while True:
+            try:
+                connection = Client(self.address, family='AF_UNIX')
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() >= deadline:
+                    raise ConnectionError(f'Inference pool is not available at {self.address}')
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+
+        # The handshake Client(authkey=...) would run, but the challenge
+        # only comes once a worker is free, so wait for it within the timeout
+        try:
+            if not connection.poll(max(0.0, deadline - time.monotonic())):
+                raise TimeoutError('Inference pool did not accept the connection in time')
+            answer_challenge(connection, self.authkey)
+            deliver_challenge(connection, self.authkey)
+        except BaseException:
+            connection.close()
+            raise
+        return connection
+
+    def _receive(self, connection, timeout: float = None) -> bytes:
+        timeout = self.timeout if timeout is None else timeout
+        if not connection.poll(timeout):
+            raise TimeoutError(f'Inference pool did not answer within {timeout:.0f}s')
+        return connection.recv_bytes()
+
+    def _call(self, request: Dict, timeout: float = None) -> bytes:
+        with self._connect(timeout) as connection:
+            connection.send_bytes(json.dumps(request).encode('utf-8'))
+            return self._receive(connection, timeout)
+
+
+def build_inference_client(config: Dict = None):
+    """
+    Registry for MockMLService according to settings.INFERENCE_POOL
+
+    Args:
+        config: Pool configuration (defaults to settings.INFERENCE_POOL)
+
+    Returns:
+        InferencePoolClient when the pool is enabled, otherwise None (the
+        service then uses the in-process registry)
+    """
+    config = config if config is not None else settings.INFERENCE_POOL
+    if config['WORKERS'] <= 0:
+        return None
+    return InferencePoolClient(config['SOCKET'], config['AUTHKEY'].encode('utf-8'), timeout=config['TIMEOUT'])
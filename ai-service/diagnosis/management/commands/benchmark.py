@@ -0,0 +1,174 @@
+"""
+Benchmark and load test for the diagnosis API
+
+Times each pipeline stage on a synthetic corpus (256px, 1080p and 12MP,
+JPEG and PNG), measures throughput and latency of the analyze endpoints
+at several concurrency levels, reports peak RSS, and optionally compares
+everything with a stored baseline report.
+
+Usage:
+    python manage.py benchmark --output baseline.json
+    python manage.py benchmark --baseline baseline.json --fail-on-regression
+    python manage.py benchmark --url http://localhost:8001/api --skip-stages
+
+In-process runs write uploads and overlays to a temporary directory.
+With --url every request is a new upload stored by that server.
+"""
+
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from diagnosis.benchmark import (
+    ENDPOINTS,
+    FORMATS,
+    RESOLUTIONS,
+    HttpTransport,
+    InProcessTransport,
+    build_corpus,
+    compare,
+    environment,
+    peak_rss_mb,
+    run_load,
+    time_stages
+)
+
+
+def _choices(value, allowed, option):
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    unknown = [item for item in items if item not in allowed]
+    if unknown:
+        raise CommandError(f'Unknown {option}: {", ".join(unknown)} (choose from {", ".join(allowed)})')
+    return items
+
+
+class Command(BaseCommand):
+    help = 'Benchmark pipeline stages and load-test the analyze endpoints'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--resolutions', default=','.join(RESOLUTIONS),
+                            help='Comma-separated corpus resolutions')
+        parser.add_argument('--formats', default=','.join(FORMATS), help='Comma-separated corpus formats')
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='Comma-separated endpoints to load')
+        parser.add_argument('--repeats', type=int, default=5, help='Measured runs per stage timing case')
+        parser.add_argument('--concurrency', default='1,4,16', help='Comma-separated client thread counts')
+        parser.add_argument('--requests', type=int, default=32, help='Requests per endpoint and concurrency level')
+        parser.add_argument('--url', help='Base URL of a running service (default: in-process test client)')
+        parser.add_argument('--skip-stages', action='store_true', help='Skip per-stage timings')
+        parser.add_argument('--skip-load', action='store_true', help='Skip the endpoint load test')
+        parser.add_argument('--seed', type=int, default=0, help='Corpus seed')
+        parser.add_argument('--output', help='Write the JSON report to this file')
+        parser.add_argument('--baseline', help='Compare with a previously written report')
+        parser.add_argument('--tolerance', type=float, default=0.10,
+                            help='Relative change counted as a regression (default 0.10)')
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help='Exit with an error if any metric regressed')
+
+    def handle(self, *args, **options):
+        resolutions = _choices(options['resolutions'], list(RESOLUTIONS), 'resolution')
+        formats = _choices(options['formats'], list(FORMATS), 'format')
+        endpoints = _choices(options['endpoints'], list(ENDPOINTS), 'endpoint')
+        try:
+            levels = [int(level) for level in options['concurrency'].split(',') if level.strip()]
+        except ValueError:
+            raise CommandError('--concurrency must be a comma-separated list of integers')
+
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = json.loads(Path(options['baseline']).read_text())
+            except (OSError, ValueError) as e:
+                raise CommandError(f'Cannot read baseline {options["baseline"]}: {e}')
+
+        self.stderr.write('Building synthetic corpus...')
+        corpus = build_corpus(resolutions, formats, options['seed'])
+
+        report = {
+            'environment': environment(),
+            'config': {
+                'transport': options['url'] or InProcessTransport.name,
+                'cases': [item['case'] for item in corpus],
+                'bytes': {item['case']: len(item['data']) for item in corpus},
+                'repeats': options['repeats'],
+                'requests': options['requests'],
+            },
+            'stages': {},
+            'load': {},
+        }
+
+        media_root = Path(tempfile.mkdtemp(prefix='healio-benchmark-'))
+        try:
+            with override_settings(
+                MEDIA_ROOT=media_root,
+                UPLOAD_PATH=media_root / 'uploads',
+                HEATMAP_PATH=media_root / 'heatmaps'
+            ):
+                (media_root / 'uploads').mkdir()
+                (media_root / 'heatmaps').mkdir()
+                self._run(report, corpus, endpoints, levels, options)
+        finally:
+            shutil.rmtree(media_root, ignore_errors=True)
+
+        report['peak_rss_mb'] = peak_rss_mb()
+        self.stdout.write(f'Peak RSS: {report["peak_rss_mb"]} MB')
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(report, indent=2))
+            self.stderr.write(f'Report written to {options["output"]}')
+
+        if baseline is not None:
+            self._report_comparison(report, baseline, options)
+
+    def _run(self, report, corpus, endpoints, levels, options):
+        # Imported here: importing the pipeline creates the service singletons
+        from diagnosis.pipeline import heatmap_renderer, ml_service
+
+        if not options['skip_stages']:
+            self.stdout.write('Stage timings (p50 / p95 ms):')
+            for item in corpus:
+                stages = time_stages(item, ml_service, options['repeats'])
+                report['stages'][item['case']] = stages
+                self.stdout.write(f'  {item["case"]:<12} ' + '  '.join(
+                    f'{stage} {summary["p50_ms"]:.1f}/{summary["p95_ms"]:.1f}'
+                    for stage, summary in stages.items()
+                ))
+
+        if not options['skip_load']:
+            transport = HttpTransport(options['url']) if options['url'] else InProcessTransport()
+            self.stdout.write(f'Load test ({transport.name}, {options["requests"]} requests per level):')
+
+            counter = int(time.time() * 1000) << 20
+            for endpoint in endpoints:
+                report['load'][endpoint] = {}
+                for level in levels:
+                    result = run_load(transport, endpoint, corpus, level, options['requests'], counter)
+                    counter += options['requests']
+                    report['load'][endpoint][str(level)] = result
+                    self.stdout.write(
+                        f'  {endpoint:<9} c={level:<3} {result["throughput_rps"]:8.2f} req/s  '
+                        f'p50 {result.get("p50_ms", 0):8.1f} ms  p95 {result.get("p95_ms", 0):8.1f} ms  '
+                        f'errors {result["errors"]}'
+                    )
+
+        # Let queued overlay renders finish before the media directory goes away
+        heatmap_renderer.shutdown(wait=True)
+
+    def _report_comparison(self, report, baseline, options):
+        rows = compare(report, baseline, options['tolerance'])
+        regressions = [row for row in rows if row['regression']]
+
+        self.stdout.write(f'Compared {len(rows)} metrics with {options["baseline"]}:')
+        for row in rows:
+            marker = 'REGRESSION' if row['regression'] else ''
+            self.stdout.write(
+                f'  {row["metric"]:<45} {row["baseline"]:>10} -> {row["current"]:>10} '
+                f'({row["change"]:+.1%}) {marker}'
+            )
+
+        if regressions and options['fail_on_regression']:
+            raise CommandError(f'{len(regressions)} metric(s) regressed by more than {options["tolerance"]:.0%}')
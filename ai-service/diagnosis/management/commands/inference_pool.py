@@ -0,0 +1,36 @@
+"""
+Run the dedicated inference worker pool
+
+Loads and warms the ensemble once (in every worker for backends that are
+not fork-safe), then serves it to the request workers from
+INFERENCE_POOL_WORKERS processes on INFERENCE_POOL_SOCKET until SIGTERM. gunicorn starts this command itself (see gunicorn.conf.py)
+unless INFERENCE_POOL_START=False.
+
+Usage:
+    python manage.py inference_pool [--workers 4] [--socket /tmp/healio-inference.sock]
+"""
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from diagnosis.inference_pool import InferencePool
+from diagnosis.registry import get_registry
+
+
+class Command(BaseCommand):
+    help = 'Serve ensemble inference to the request workers from dedicated processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.INFERENCE_POOL['WORKERS'],
+                            help='Inference worker processes')
+        parser.add_argument('--socket', default=settings.INFERENCE_POOL['SOCKET'],
+                            help='Unix socket the workers listen on')
+
+    def handle(self, *args, **options):
+        if options['workers'] <= 0:
+            raise CommandError('Set INFERENCE_POOL_WORKERS (or --workers) to at least 1')
+
+        InferencePool(
+            options['socket'], options['workers'], get_registry(),
+            authkey=settings.INFERENCE_POOL['AUTHKEY'].encode('utf-8'),
+        ).serve_forever()
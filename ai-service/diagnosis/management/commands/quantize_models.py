@@ -0,0 +1,97 @@
+"""
+Quantize the ONNX ensemble members to int8
+
+Writes <MODEL_PATH>/<key>.int8.onnx next to every <key>.onnx, which the
+onnxruntime backend loads with INFERENCE_QUANTIZED=True. Without
+--calibration the weights are quantized dynamically (activations are
+quantized at run time). With a directory of representative images, the
+activation ranges are calibrated on them and the models are quantized
+statically, which is usually faster for CNNs on CPUs with VNNI/AVX512.
+
+Usage:
+    python manage.py quantize_models [--calibration images/] [--limit 200] [--members resnet50 ...]
+"""
+
+import os
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from diagnosis.backends import OnnxMember, _onnxruntime
+from diagnosis.ml_service import MockMLService
+from diagnosis.registry import ModelRegistry
+from diagnosis.utils import preprocess_image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+class _CalibrationReader:
+    """Feeds calibration images to the quantizer in the model's input format"""
+
+    def __init__(self, member: OnnxMember, paths, input_shape: tuple):
+        self.member = member
+        self.paths = iter(paths)
+        self.target_size = input_shape[:2]
+
+    def get_next(self):
+        path = next(self.paths, None)
+        if path is None:
+            return None
+        image_batch = preprocess_image(path, self.target_size)[np.newaxis]
+        return {self.member.input_name: self.member.prepare(image_batch)}
+
+
+class Command(BaseCommand):
+    help = 'Write int8-quantized copies of the ONNX ensemble members'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calibration', help='Directory of representative images (static quantization)')
+        parser.add_argument('--limit', type=int, default=200, help='Calibration images to use')
+        parser.add_argument('--members', nargs='+', help='Model file stems to quantize (default: all)')
+
+    def handle(self, *args, **options):
+        _onnxruntime()
+        from onnxruntime.quantization import QuantFormat, QuantType, quantize_dynamic, quantize_static
+
+        model_path = settings.MODEL_PATH
+        keys = options['members'] or [key for _, key, _ in ModelRegistry.MEMBERS]
+        input_shape = (224, 224, 3)
+
+        calibration = []
+        if options['calibration']:
+            if not os.path.isdir(options['calibration']):
+                raise CommandError(f"{options['calibration']} is not a directory")
+            calibration = sorted(
+                os.path.join(options['calibration'], filename)
+                for filename in os.listdir(options['calibration'])
+                if filename.lower().endswith(IMAGE_EXTENSIONS)
+            )[:options['limit']]
+            if not calibration:
+                raise CommandError(f"No images in {options['calibration']}")
+
+        config = dict(settings.INFERENCE_BACKEND, QUANTIZED=False)
+        for name, key, cost in ModelRegistry.MEMBERS:
+            if key not in keys:
+                continue
+            source = OnnxMember.model_file(model_path, key, quantized=False)
+            target = OnnxMember.model_file(model_path, key, quantized=True)
+            if not os.path.exists(source):
+                raise CommandError(f'{name} model not found at {source}')
+
+            if calibration:
+                member = OnnxMember.load(
+                    name, key, cost, model_path, len(MockMLService.DISEASES), input_shape, config
+                )
+                quantize_static(
+                    source, target, _CalibrationReader(member, calibration, input_shape),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                )
+            else:
+                quantize_dynamic(source, target, weight_type=QuantType.QInt8)
+
+            self.stdout.write(
+                f'{name}: {os.path.getsize(source) / 1e6:.1f} MB -> {os.path.getsize(target) / 1e6:.1f} MB '
+                f'({"static" if calibration else "dynamic"})'
+            )
@@ -0,0 +1,91 @@
+"""
+Bulk re-scoring of stored symptom questionnaires
+
+Reads JSON lines, scores them in chunks with one sparse matrix multiply
+per chunk, and writes the top-k diseases per questionnaire as JSON lines.
+
+Usage:
+    python manage.py rescore_symptoms questionnaires.jsonl --output scores.jsonl
+
+Each input line is either {"id": ..., "symptoms": {...}} or a bare
+symptom dictionary (the line number is used as its id).
+"""
+
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from diagnosis.ml_service import MockMLService
+
+
+class Command(BaseCommand):
+    help = 'Re-score symptom questionnaires in bulk against the current keyword rules'
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='JSON lines file of questionnaires ("-" for stdin)')
+        parser.add_argument('--output', default='-', help='JSON lines output file ("-" for stdout)')
+        parser.add_argument('--top-k', type=int, default=3, help='Diseases to keep per questionnaire')
+        parser.add_argument('--chunk-size', type=int, default=10000, help='Questionnaires per scoring batch')
+
+    def handle(self, *args, **options):
+        service = MockMLService()
+        names = [disease['name'] for disease in service.DISEASES]
+
+        source = sys.stdin if options['input'] == '-' else open(options['input'])
+        target = sys.stdout if options['output'] == '-' else open(options['output'], 'w')
+
+        start = time.perf_counter()
+        total = 0
+        try:
+            ids, chunk = [], []
+            for line_number, line in enumerate(source, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    raise CommandError(f'Line {line_number} is not valid JSON')
+
+                if isinstance(record, dict) and isinstance(record.get('symptoms'), dict):
+                    ids.append(record.get('id', line_number))
+                    chunk.append(record['symptoms'])
+                elif isinstance(record, dict):
+                    ids.append(line_number)
+                    chunk.append(record)
+                else:
+                    raise CommandError(f'Line {line_number} is not a questionnaire object')
+
+                if len(chunk) >= options['chunk_size']:
+                    total += self._write_chunk(service, names, ids, chunk, options['top_k'], target)
+                    ids, chunk = [], []
+
+            if chunk:
+                total += self._write_chunk(service, names, ids, chunk, options['top_k'], target)
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if target is not sys.stdout:
+                target.close()
+
+        elapsed = time.perf_counter() - start
+        self.stderr.write(f'Re-scored {total} questionnaires in {elapsed:.1f}s')
+
+    def _write_chunk(self, service, names, ids, chunk, top_k, target) -> int:
+        indices, scores = service.rank_symptoms(chunk, top_k)
+
+        for record_id, row_indices, row_scores in zip(ids, indices.tolist(), scores.tolist()):
+            ranked = [
+                {'disease': names[index], 'score': score}
+                for index, score in zip(row_indices, row_scores)
+                if score > 0
+            ]
+            target.write(json.dumps({
+                'id': record_id,
+                'disease': ranked[0]['disease'] if ranked else None,
+                'top': ranked
+            }) + '\n')
+
+        return len(chunk)
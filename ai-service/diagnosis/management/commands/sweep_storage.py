@@ -0,0 +1,36 @@
+"""
+One-off sweep of the content-addressed media store
+
+Runs the same retention, quota and cleanup pass as the background sweeper
+(useful under runserver, or from cron with STORAGE_SWEEP_INTERVAL=0).
+
+Usage:
+    python manage.py sweep_storage [--migrate]
+
+--migrate first moves uploads and heatmaps stored directly in the media
+directories (the layout before sharding) into their shard directories.
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from diagnosis.storage import sweeper
+
+
+class Command(BaseCommand):
+    help = 'Apply media retention and quotas, and remove orphaned and partial files'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--migrate', action='store_true',
+                            help='Move files from the flat layout into shard directories first')
+
+    def handle(self, *args, **options):
+        if options['migrate']:
+            moved = sweeper.migrate_flat()
+            self.stderr.write(f'Moved {moved} files into shard directories')
+
+        stats = sweeper.sweep()
+        if stats is None:
+            raise CommandError('Another process is sweeping the media store; try again later')
+        self.stdout.write(json.dumps(stats))
@@ -0,0 +1,189 @@
+"""
+Compiled symptom keyword matcher
+
+Disease keywords (and optional synonyms) are compiled once into a token
+index. Questionnaire text is tokenized and scanned in a single pass, so
+matching cost depends on the length of the text rather than the size of
+the vocabulary, and keywords only match whole words ('red' no longer
+matches inside 'bored').
+
+Scoring is a sparse matrix product: questionnaires x features (matched
+keywords) times features x diseases, so a whole batch of questionnaires
+is scored with one multiply.
+"""
+
+import re
+from typing import Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+from scipy import sparse
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _normalize_token(token: str) -> str:
+    # Light plural folding applied to both keywords and input text,
+    # so 'nodules' matches 'nodule' and 'bumps' matches 'bump'
+    if len(token) > 3 and token.endswith('s') and not token.endswith('ss'):
+        return token[:-1]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Split text into normalized word tokens
+
+    Hyphens and punctuation separate tokens, so 'stuck-on' and 'stuck on'
+    produce the same tokens.
+
+    Args:
+        text: Free text
+
+    Returns:
+        List of lowercase tokens
+    """
+    return [_normalize_token(token) for token in _TOKEN_RE.findall(text.lower())]
+
+
+class SymptomMatcher:
+    """
+    Token index over disease keywords
+
+    Each distinct keyword phrase becomes a feature. The index maps a
+    phrase's first token to the phrases starting with it, so one scan of
+    the input finds every matched feature.
+    """
+
+    def __init__(self, diseases: List[Dict]):
+        """
+        Compile the matcher
+
+        Args:
+            diseases: Disease records with 'keywords' and optional 'synonyms'
+        """
+        self.num_diseases = len(diseases)
+        self.phrases: List[Tuple[str, ...]] = []
+        self.feature_diseases: List[Tuple[int, ...]] = []
+        self._index: Dict[str, List[Tuple[Tuple[str, ...], int]]] = {}
+
+        feature_ids = {}
+        owners: List[Set[int]] = []
+        for disease_index, disease in enumerate(diseases):
+            for keyword in list(disease['keywords']) + list(disease.get('synonyms', ())):
+                phrase = tuple(tokenize(keyword))
+                if not phrase:
+                    continue
+                if phrase not in feature_ids:
+                    feature_ids[phrase] = len(self.phrases)
+                    self.phrases.append(phrase)
+                    owners.append(set())
+                owners[feature_ids[phrase]].add(disease_index)
+
+        self.feature_diseases = [tuple(sorted(diseases_set)) for diseases_set in owners]
+        for feature, phrase in enumerate(self.phrases):
+            self._index.setdefault(phrase[0], []).append((phrase, feature))
+
+        # Sparse features x diseases incidence matrix
+        rows = [feature for feature, owned in enumerate(self.feature_diseases) for _ in owned]
+        cols = [disease for owned in self.feature_diseases for disease in owned]
+        self.feature_matrix = sparse.csr_matrix(
+            (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+            shape=(self.num_features, self.num_diseases)
+        )
+
+    @property
+    def num_features(self) -> int:
+        return len(self.phrases)
+
+    def match(self, values: Iterable) -> Set[int]:
+        """
+        Find the keyword features present in questionnaire answers
+
+        Args:
+            values: Answer values (converted with str())
+
+        Returns:
+            Set of matched feature ids
+        """
+        tokens = tokenize(' '.join(str(v) for v in values))
+        index = self._index
+        matched = set()
+
+        for position, token in enumerate(tokens):
+            for phrase, feature in index.get(token, ()):
+                if len(phrase) == 1 or tuple(tokens[position:position + len(phrase)]) == phrase:
+                    matched.add(feature)
+
+        return matched
+
+    def match_matrix(self, questionnaires: Iterable[Iterable]) -> sparse.csr_matrix:
+        """
+        Binary questionnaires x features matrix of matched keywords
+
+        Args:
+            questionnaires: One iterable of answer values per questionnaire
+
+        Returns:
+            CSR matrix of shape (Q, num_features)
+        """
+        indptr = [0]
+        indices = []
+        for values in questionnaires:
+            indices.extend(self.match(values))
+            indptr.append(len(indices))
+
+        return sparse.csr_matrix(
+            (np.ones(len(indices), dtype=np.int32), indices, indptr),
+            shape=(len(indptr) - 1, self.num_features)
+        )
+
+    def score_batch(self, questionnaires: Iterable[Iterable]) -> np.ndarray:
+        """
+        Per-disease count of distinct matched keywords for many questionnaires
+
+        Args:
+            questionnaires: One iterable of answer values per questionnaire
+
+        Returns:
+            int array of shape (Q, num_diseases)
+        """
+        return (self.match_matrix(questionnaires) @ self.feature_matrix).toarray()
+
+    def score(self, values: Iterable) -> np.ndarray:
+        """
+        Per-disease count of distinct matched keywords
+
+        Args:
+            values: Answer values (converted with str())
+
+        Returns:
+            int array of shape (num_diseases,)
+        """
+        return self.score_batch([values])[0]
+
+    @staticmethod
+    def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+        """
+        Indices of the k highest scores per row, best first
+
+        Only the k candidates from argpartition are sorted. Equal scores
+        are ordered by index; which tied entries make the cut at the k-th
+        position is unspecified.
+
+        Args:
+            scores: Array of shape (Q, num_diseases)
+            k: Number of results per row
+
+        Returns:
+            int array of shape (Q, min(k, num_diseases))
+        """
+        num_rows, num_columns = scores.shape
+        k = min(k, num_columns)
+        if k < num_columns:
+            candidates = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        else:
+            candidates = np.broadcast_to(np.arange(num_columns), (num_rows, num_columns))
+
+        candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+        order = np.lexsort((candidates, -candidate_scores))
+        return np.take_along_axis(candidates, order, axis=1)
@@ -0,0 +1,520 @@
+"""
+Prometheus metrics for the diagnosis service
+
+A small in-process registry of counters, gauges and histograms rendered
+in the Prometheus text exposition format by the /api/metrics view.
+
+Under gunicorn every worker keeps its own series. When METRICS_DIR is
+set, each process also writes a snapshot there every few seconds and the
+metrics view merges all snapshots, so a scrape that lands on any worker
+reports the whole server. Snapshots are named after the process id and
+start time, so a reused pid never overwrites an exited worker's series.
+Counters and histograms of exited workers are folded into a persistent
+aggregate (and their snapshots removed); gauges are only reported for
+live processes.
+
+Pipeline code times its stages with `stage('name')` (or the `timed`
+decorator). The stages currently running in each thread are tracked so
+gunicorn's worker_abort hook can log where a timed-out request was stuck.
+"""
+
+import bisect
+import fcntl
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers sub-millisecond steps up to the gunicorn timeout
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def _key(self, labels: Dict) -> Tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self) -> Dict:
+        """Snapshot of this metric family (JSON-serializable)"""
+        with self._lock:
+            samples = [[list(key), self._sample(value)] for key, value in self._values.items()]
+        return {
+            'type': self.type,
+            'help': self.documentation,
+            'labelnames': list(self.labelnames),
+            'samples': samples,
+        }
+
+    def _sample(self, value):
+        return value
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that goes up and down"""
+
+    type = 'gauge'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """Distribution of observations over fixed buckets"""
+
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def collect(self) -> Dict:
+        family = super().collect()
+        family['buckets'] = list(self.buckets)
+        return family
+
+    def _sample(self, value):
+        counts, total = value
+        return [list(counts), total]
+
+
+class MetricsRegistry:
+    """Metric families of this process, with optional cross-process snapshots"""
+
+    SNAPSHOT_INTERVAL = 5.0
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._writer_pid = None
+        self._snapshot_pid = None
+        self._snapshot_name = None
+
+    def register(self, metric: _Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+
+    def collect(self) -> Dict[str, Dict]:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {metric.name: metric.collect() for metric in metrics}
+
+    def render(self) -> str:
+        """Prometheus text exposition of this process (or all, with METRICS_DIR)"""
+        families = self.collect()
+        directory = settings.METRICS_DIR
+        if directory:
+            self.write_snapshot(families)
+            families = merge_snapshots(directory)
+        return render_families(families)
+
+    def ensure_snapshot_writer(self):
+        """Start the snapshot thread in this process (after a fork, again)"""
+        if not settings.METRICS_DIR or self._writer_pid == os.getpid():
+            return
+        with self._lock:
+            if self._writer_pid == os.getpid():
+                return
+            self._writer_pid = os.getpid()
+        threading.Thread(target=self._write_periodically, name='metrics-snapshot', daemon=True).start()
+
+    def write_snapshot(self, families: Dict = None):
+        directory = settings.METRICS_DIR
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, self._own_snapshot())
+        temporary = f'{path}.tmp'
+        with open(temporary, 'w') as handle:
+            json.dump(families if families is not None else self.collect(), handle)
+        os.replace(temporary, path)
+
+    def _own_snapshot(self) -> str:
+        """Snapshot file name of this process, '<pid>-<start time>.json'"""
+        pid = os.getpid()
+        if self._snapshot_pid != pid:
+            start = _process_start(pid)
+            # Without /proc, any value unique to this process will do
+            self._snapshot_name = f'{pid}-{start if start is not None else time.time_ns()}.json'
+            self._snapshot_pid = pid
+        return self._snapshot_name
+
+    def _write_periodically(self):
+        pid = os.getpid()
+        while self._writer_pid == pid:
+            try:
+                self.write_snapshot()
+            except Exception as e:
+                logger.warning(f'Could not write metrics snapshot: {str(e)}')
+            time.sleep(self.SNAPSHOT_INTERVAL)
+
+
+# Counters and histograms of exited processes, and the merge lock
+AGGREGATE_FILE = 'exited.json'
+LOCK_FILE = '.merge.lock'
+
+
+def _process_start(pid: int) -> Optional[int]:
+    """Start time of a process in clock ticks since boot (None without /proc)"""
+    try:
+        with open(f'/proc/{pid}/stat') as handle:
+            stat = handle.read()
+    except OSError:
+        return None
+    # Fields after the parenthesized command name; starttime is field 22
+    return int(stat.rsplit(')', 1)[1].split()[19])
+
+
+def _process_alive(pid: int, start: Optional[int]) -> bool:
+    """Whether the process that wrote a snapshot is still running"""
+    current = _process_start(pid)
+    if current is not None:
+        return start is None or current == start
+    if os.path.isdir('/proc'):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _parse_snapshot_name(filename: str) -> Optional[Tuple[int, Optional[int]]]:
+    """(pid, start time) of a snapshot file name, or None for other files"""
+    if not filename.endswith('.json') or filename == AGGREGATE_FILE:
+        return None
+    pid, _, start = filename[:-5].partition('-')
+    try:
+        return int(pid), int(start) if start else None
+    except ValueError:
+        return None
+
+
+def _add_families(merged: Dict, families: Dict, include_gauges: bool = True):
+    """Add snapshot families into merged ({name: family with samples keyed by label tuple})"""
+    for name, family in families.items():
+        if family['type'] == 'gauge' and not include_gauges:
+            continue
+        target = merged.setdefault(name, dict(family, samples={}))
+        for labels, value in family['samples']:
+            key = tuple(labels)
+            current = target['samples'].get(key)
+            if current is None:
+                target['samples'][key] = value
+            elif family['type'] == 'histogram':
+                target['samples'][key] = [
+                    [a + b for a, b in zip(current[0], value[0])], current[1] + value[1]
+                ]
+            else:
+                target['samples'][key] = current + value
+
+
+def _listed_samples(merged: Dict) -> Dict:
+    for family in merged.values():
+        family['samples'] = [[list(key), value] for key, value in family['samples'].items()]
+    return merged
+
+
+def _read_json(path: str):
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except FileNotFoundError:
+        return None
+
+
+def _fold_exited(directory: str, exited: List[str]) -> Dict:
+    """
+    Move the counters and histograms of exited processes into the aggregate
+
+    The aggregate records the snapshots it already holds, so a fold that
+    was interrupted before removing them does not count them twice.
+
+    Args:
+        directory: METRICS_DIR (merge lock held)
+        exited: Snapshot file names of processes that are gone
+
+    Returns:
+        The aggregate: {'families': ..., 'folded': [snapshot file names]}
+    """
+    aggregate = _read_json(os.path.join(directory, AGGREGATE_FILE)) or {'families': {}, 'folded': []}
+    folded = set(aggregate['folded'])
+    pending = [filename for filename in exited if filename not in folded]
+
+    if pending:
+        # Names only matter until their snapshot is removed below
+        folded &= set(exited)
+        merged = {}
+        _add_families(merged, aggregate['families'])
+        for filename in pending:
+            try:
+                families = _read_json(os.path.join(directory, filename))
+            except ValueError:
+                families = None
+            if families:
+                _add_families(merged, families, include_gauges=False)
+        aggregate = {'families': _listed_samples(merged), 'folded': sorted(folded | set(pending))}
+        path = os.path.join(directory, AGGREGATE_FILE)
+        with open(f'{path}.tmp', 'w') as handle:
+            json.dump(aggregate, handle)
+        os.replace(f'{path}.tmp', path)
+
+    for filename in exited:
+        try:
+            os.remove(os.path.join(directory, filename))
+        except FileNotFoundError:
+            pass
+    return aggregate
+
+
+def merge_snapshots(directory: str) -> Dict[str, Dict]:
+    """
+    Sum the snapshots written by every process into one set of families
+
+    Snapshots of exited processes are folded into the aggregate first.
+
+    Args:
+        directory: METRICS_DIR
+
+    Returns:
+        Families in the same shape as MetricsRegistry.collect()
+    """
+    with open(os.path.join(directory, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            live, exited = [], []
+            for filename in sorted(os.listdir(directory)):
+                parsed = _parse_snapshot_name(filename)
+                if parsed is not None:
+                    (live if _process_alive(*parsed) else exited).append(filename)
+
+            aggregate = _fold_exited(directory, exited)
+            merged = {}
+            _add_families(merged, aggregate['families'])
+            for filename in live:
+                try:
+                    families = _read_json(os.path.join(directory, filename))
+                except ValueError:
+                    continue
+                if families:
+                    _add_families(merged, families)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return _listed_samples(merged)
+
+
+def render_families(families: Dict[str, Dict]) -> str:
+    """Prometheus text format (version 0.0.4) for collected families"""
+    lines = []
+    for name in sorted(families):
+        family = families[name]
+        names = family['labelnames']
+        lines.append(f'# HELP {name} {family["help"]}')
+        lines.append(f'# TYPE {name} {family["type"]}')
+
+        for labels, value in sorted(family['samples']):
+            if family['type'] != 'histogram':
+                lines.append(f'{name}{_format_labels(names, labels)} {_format_value(value)}')
+                continue
+
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(list(family['buckets']) + [float('inf')], counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                lines.append(f'{name}_bucket{_format_labels(names, labels, le)} {cumulative}')
+            lines.append(f'{name}_sum{_format_labels(names, labels)} {_format_value(total)}')
+            lines.append(f'{name}_count{_format_labels(names, labels)} {cumulative}')
+
+    return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = Counter(
+    'healio_requests_total', 'HTTP requests by endpoint and status code', ['endpoint', 'status']
+)
+REQUEST_SECONDS = Histogram(
+    'healio_request_duration_seconds', 'End-to-end request latency', ['endpoint']
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    'healio_requests_in_flight', 'Requests currently being handled', ['endpoint']
+)
+STAGE_SECONDS = Histogram(
+    'healio_stage_duration_seconds', 'Time spent in each pipeline stage', ['stage']
+)
+STAGE_ERRORS = Counter(
+    'healio_stage_errors_total', 'Pipeline stages that raised', ['stage']
+)
+CACHE_LOOKUPS = Counter(
+    'healio_result_cache_lookups_total', 'Result cache lookups by namespace and outcome',
+    ['namespace', 'result']
+)
+IMAGE_BYTES = Histogram(
+    'healio_image_size_bytes', 'Encoded size of accepted images', [],
+    buckets=(64 * 1024, 256 * 1024, 512 * 1024, 1024 ** 2, 2 * 1024 ** 2,
+             4 * 1024 ** 2, 6 * 1024 ** 2, 8 * 1024 ** 2, 10 * 1024 ** 2)
+)
+IMAGE_MEGAPIXELS = Histogram(
+    'healio_image_megapixels', 'Decoded resolution of accepted images', [],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 4, 8, 12, 16, 24, 40)
+)
+ADMISSION_PROCESSES = Gauge(
+    'healio_admission_processes', 'Server processes running admission control'
+)
+ADMISSION_ACTIVE = Gauge(
+    'healio_admission_active', 'Analyses holding a slot'
+)
+ADMISSION_SATURATED = Gauge(
+    'healio_admission_saturated', 'Processes with every slot busy and an endpoint queue full'
+)
+ADMISSION_QUEUED = Gauge(
+    'healio_admission_queued', 'Requests waiting for an analysis slot', ['endpoint']
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    'healio_admission_wait_seconds', 'Time queued requests waited for an analysis slot', ['endpoint']
+)
+ADMISSION_REJECTED = Counter(
+    'healio_admission_rejected_total', 'Requests shed by admission control', ['endpoint', 'reason']
+)
+MICRO_BATCHES = Counter(
+    'healio_micro_batches_total', 'Micro-batches run, by why they were dispatched', ['batcher', 'reason']
+)
+MICRO_BATCH_SIZE = Histogram(
+    'healio_micro_batch_size', 'Requests per micro-batch', ['batcher'],
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+MICRO_BATCH_WAIT_SECONDS = Histogram(
+    'healio_micro_batch_wait_seconds', 'Time a micro-batch stayed open collecting requests', ['batcher']
+)
+ENSEMBLE_MODEL_RUNS = Counter(
+    'healio_ensemble_model_runs_total', 'Images run through each ensemble member', ['model']
+)
+ENSEMBLE_COST = Counter(
+    'healio_ensemble_cost_total', 'Relative ensemble inference cost spent and saved by early exit', ['outcome']
+)
+STORAGE_BYTES = Gauge(
+    'healio_storage_bytes', 'Bytes in the media store at the last sweep', ['area']
+)
+STORAGE_REMOVED = Counter(
+    'healio_storage_removed_total', 'Stored objects removed by the storage sweeper', ['reason']
+)
+
+# Stages currently running: thread id -> list of (stage, start time)
+_active = {}
+
+
+@contextmanager
+def stage(name: str):
+    """
+    Time a pipeline stage
+
+    Records the duration in healio_stage_duration_seconds (and a failure
+    in healio_stage_errors_total) and marks the stage as running for
+    active_stages().
+    """
+    thread_id = threading.get_ident()
+    stack = _active.setdefault(thread_id, [])
+    start = time.perf_counter()
+    stack.append((name, start))
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage=name)
+        raise
+    finally:
+        stack.pop()
+        if not stack:
+            _active.pop(thread_id, None)
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+
+
+def timed(name: str):
+    """Decorator form of stage()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def active_stages() -> List[Dict]:
+    """Stages running right now in this process, innermost last"""
+    now = time.perf_counter()
+    return [
+        {'thread': thread_id, 'stage': name, 'elapsed': round(now - start, 3)}
+        for thread_id, stack in list(_active.items())
+        for name, start in list(stack)
+    ]
@@ -0,0 +1,192 @@
+"""
+Middleware for the diagnosis service
+"""
+
+import hmac
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import JsonResponse
+from django.urls import Resolver404, resolve
+from django.utils.decorators import sync_and_async_middleware
+
+from .admission import Rejected, admission_controller
+from .metrics import REGISTRY, REQUESTS, REQUEST_SECONDS, REQUESTS_IN_FLIGHT
+from .profiling import RequestProfile, enforce_limits, trace_name
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+
+def _endpoint(request) -> str:
+    # Route name keeps the label set small (heatmap job ids are not labels)
+    try:
+        return resolve(request.path_info).url_name or 'unnamed'
+    except Resolver404:
+        return 'unmatched'
+
+
+def _begin(request):
+    REGISTRY.ensure_snapshot_writer()
+    endpoint = _endpoint(request)
+    REQUESTS_IN_FLIGHT.inc(endpoint=endpoint)
+    return endpoint, time.perf_counter()
+
+
+def _end(endpoint, start, status_code):
+    REQUESTS_IN_FLIGHT.dec(endpoint=endpoint)
+    REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint)
+    REQUESTS.inc(endpoint=endpoint, status=status_code)
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Count requests, in-flight requests and end-to-end latency per endpoint"""
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            endpoint, start = _begin(request)
+            status_code = 500
+            try:
+                response = await get_response(request)
+                status_code = response.status_code
+                return response
+            finally:
+                _end(endpoint, start, status_code)
+    else:
+        def middleware(request):
+            endpoint, start = _begin(request)
+            status_code = 500
+            try:
+                response = get_response(request)
+                status_code = response.status_code
+                return response
+            finally:
+                _end(endpoint, start, status_code)
+
+    return middleware
+
+
+def _rejection(rejected: Rejected) -> JsonResponse:
+    response = JsonResponse({
+        'error': 'The service is at capacity. Please retry later.',
+        'reason': rejected.reason,
+    }, status=rejected.status_code)
+    response['Retry-After'] = str(rejected.retry_after)
+    return response
+
+
+@sync_and_async_middleware
+def admission_middleware(get_response):
+    """Queue or shed analyze requests beyond capacity (see diagnosis.admission)"""
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            endpoint = _endpoint(request)
+            if admission_controller is None or not admission_controller.controls(endpoint):
+                return await get_response(request)
+            try:
+                async with admission_controller.admit_async(endpoint):
+                    return await get_response(request)
+            except Rejected as rejected:
+                return _rejection(rejected)
+    else:
+        def middleware(request):
+            endpoint = _endpoint(request)
+            if admission_controller is None or not admission_controller.controls(endpoint):
+                return get_response(request)
+            try:
+                with admission_controller.admit(endpoint):
+                    return get_response(request)
+            except Rejected as rejected:
+                return _rejection(rejected)
+
+    return middleware
+
+
+def _profile_reason(request):
+    """'requested', 'sampled' or None for a request that is not profiled"""
+    config = settings.PROFILING
+    if not config['ENABLED']:
+        return None
+
+    # Requested traces are written on demand, so only with the shared token
+    header = request.headers.get(config['HEADER'])
+    if config['TOKEN'] and header and hmac.compare_digest(header.encode(), config['TOKEN'].encode()):
+        return 'requested'
+    if config['SAMPLE_RATE'] > 0 and random.random() < config['SAMPLE_RATE']:
+        return 'sampled'
+    return None
+
+
+def _keep_profile(request, profile, response, elapsed):
+    """Write the trace if it was requested or the request was slow"""
+    config = settings.PROFILING
+    slow = elapsed * 1000 >= config['SLOW_THRESHOLD_MS']
+    if profile.reason != 'requested' and not slow:
+        return
+
+    endpoint = _endpoint(request)
+    name = trace_name(endpoint, elapsed)
+    status_code = response.status_code if response is not None else 500
+    summary = (
+        f'{request.method} {request.path} -> {status_code} in {elapsed * 1000:.0f} ms '
+        f'({profile.reason}{", slow" if slow else ""})'
+    )
+
+    try:
+        path = profile.write(config['DIR'], name, summary)
+        if path is None:
+            return
+        enforce_limits(config['DIR'], config['MAX_FILES'], config['MAX_BYTES'])
+    except OSError as e:
+        logger.error(f'Could not write request profile: {str(e)}')
+        return
+
+    if slow:
+        logger.warning(f'Slow request kept profile {path}: {summary}')
+    if response is not None:
+        response['X-Profile-Id'] = name
+
+
+@sync_and_async_middleware
+def profiling_middleware(get_response):
+    """Profile requests selected by header or sampling (see settings.PROFILING)"""
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            reason = _profile_reason(request)
+            if reason is None:
+                return await get_response(request)
+
+            # Pipeline work of the async views runs in executor threads
+            # and is recorded there through run_profiled
+            response = None
+            start = time.perf_counter()
+            with RequestProfile(reason, settings.PROFILING['TRACE_ALLOCATIONS']) as profile:
+                try:
+                    response = await get_response(request)
+                finally:
+                    elapsed = time.perf_counter() - start
+            _keep_profile(request, profile, response, elapsed)
+            return response
+    else:
+        def middleware(request):
+            reason = _profile_reason(request)
+            if reason is None:
+                return get_response(request)
+
+            response = None
+            start = time.perf_counter()
+            with RequestProfile(reason, settings.PROFILING['TRACE_ALLOCATIONS']) as profile:
+                try:
+                    response = profile.call(get_response, request)
+                finally:
+                    elapsed = time.perf_counter() - start
+            _keep_profile(request, profile, response, elapsed)
+            return response
+
+    return middleware
@@ -4,10 +4,17 @@ This simulates CNN ensemble, U-Net segmentation, and decision trees
 In production, this would use real trained models
 """
 
-import random
 import numpy as np
 from typing import Dict, List, Tuple
 
+from .cache import canonicalize_symptoms
+from .matching import SymptomMatcher
+from .metrics import ENSEMBLE_COST, ENSEMBLE_MODEL_RUNS, timed
+from .registry import ModelRegistry, get_registry
+from .results import Alternative, Diagnosis
+from .texts import DEFAULT_LOCALE, compile_texts, confidence_band
+from .utils import content_rng, preprocess_image
+
 
 class MockMLService:
     """
@@ -56,104 +63,137 @@ class MockMLService:
         }
     ]
     
-    def __init__(self, seed=None):
+    # Always analyzed by the whole ensemble, even in cascade mode
+    SEVERE_CLASSES = tuple(index for index, disease in enumerate(DISEASES) if disease['severity'] == 'high')
+    
+    ANALYSIS_METHODS = {
+        'image': 'CNN Ensemble (ResNet50 + DenseNet121 + EfficientNet-B0)',
+        'symptoms': 'Symptom Decision Tree with Clinical Rules',
+        'combined': 'Combined CNN Ensemble + Symptom Analysis'
+    }
+    
+    def __init__(self, seed=None, registry: ModelRegistry = None, cascade: Dict = None):
         """
         Initialize the mock ML service
         
         Args:
-            seed: Random seed for reproducible results (optional)
+            seed: Base seed mixed into every per-request generator (optional)
+            registry: Model registry for the image ensemble (defaults to
+                the process-wide registry)
+            cascade: Early-exit settings for the ensemble (settings.CASCADE);
+                None runs every member on every image
         """
-        if seed is not None:
-            random.seed(seed)
-        else:
-            # Use a default seed for educational/demo purposes to ensure consistency
-            random.seed(42)
+        self._registry = registry
+        self.cascade = cascade
+        
+        # Compile the symptom keyword index once
+        self._symptom_matcher = SymptomMatcher(self.DISEASES)
+        
+        # Expand every explanation and recommendation text once per locale
+        self._texts = compile_texts(self.DISEASES)
+        
+        # Use a default seed for educational/demo purposes to ensure consistency.
+        # Randomness comes from generators derived from this seed and the
+        # request content, never from global state, so concurrent requests
+        # do not interfere and the same input gives the same result.
+        self.seed = 42 if seed is None else seed
     
-    def analyze_image(self, image_path: str) -> Dict:
+    @timed('ml_service.analyze_image')
+    def analyze_image(self, image_path: str, image_array: np.ndarray = None,
+                      locale: str = DEFAULT_LOCALE) -> Diagnosis:
         """
         Simulate CNN ensemble analysis of skin lesion image
         
         Args:
             image_path: Path to the uploaded image
+            image_array: Preprocessed model input from preprocess_image
+            locale: Language of the explanation and recommendations
             
         Returns:
-            Dictionary containing diagnosis results
+            Diagnosis result
         """
-        # Simulate processing time and select a disease
-        primary_disease = random.choice(self.DISEASES)
-        confidence = random.uniform(0.70, 0.98)
+        if image_array is None:
+            image_array = preprocess_image(image_path)
         
-        # Generate alternative diagnoses
-        alternatives = self._generate_alternatives(primary_disease, confidence)
-        
-        # Generate clinical explanation
-        explanation = self._generate_explanation(primary_disease, confidence, 'image')
-        
-        # Generate recommendations
-        recommendations = self._generate_recommendations(primary_disease)
-        
-        return {
-            'disease': primary_disease['name'],
-            'confidence': round(confidence, 3),
-            'severity': primary_disease['severity'],
-            'description': primary_disease['description'],
-            'explanation': explanation,
-            'alternative_diagnoses': alternatives,
-            'recommendations': recommendations,
-            'analysis_method': 'CNN Ensemble (ResNet50 + DenseNet121 + EfficientNet-B0)'
-        }
+        return self.analyze_image_batch(image_array[np.newaxis], locale)[0]
+    
+    @timed('ml_service.analyze_image_batch')
+    def analyze_image_batch(self, image_batch: np.ndarray, locale: str = DEFAULT_LOCALE) -> List[Diagnosis]:
+        """
+        Simulate CNN ensemble analysis of a stacked batch of images
+        Each ensemble member is called once for the whole batch
+        
+        Args:
+            image_batch: Preprocessed images of shape (N, 224, 224, 3)
+            locale: Language of the explanations and recommendations
+            
+        Returns:
+            One Diagnosis per image, in batch order
+        """
+        probabilities, models_run = self._image_stage(image_batch)
+        predictions = self._image_predictions(probabilities)
+        return [
+            self._build_result(disease_index, confidence, 'image', self._image_rng(image_array),
+                               models_run=depth, locale=locale)
+            for (disease_index, confidence), image_array, depth in zip(predictions, image_batch, models_run)
+        ]
     
-    def analyze_symptoms(self, symptoms_data: Dict) -> Dict:
+    @timed('ml_service.analyze_symptoms')
+    def analyze_symptoms(self, symptoms_data: Dict, locale: str = DEFAULT_LOCALE) -> Diagnosis:
         """
         Simulate decision tree analysis based on symptoms
         
         Args:
             symptoms_data: Dictionary containing symptom information
+            locale: Language of the explanation and recommendations
             
         Returns:
-            Dictionary containing diagnosis results
+            Diagnosis result
         """
-        # Extract symptom keywords
-        symptoms_text = ' '.join(str(v).lower() for v in symptoms_data.values())
-        
-        # Find best matching disease based on keywords
-        best_match = None
-        best_score = 0
-        
-        for disease in self.DISEASES:
-            score = sum(1 for keyword in disease['keywords'] if keyword in symptoms_text)
-            if score > best_score:
-                best_score = score
-                best_match = disease
+        return self.analyze_symptoms_batch([symptoms_data], locale)[0]
+    
+    @timed('ml_service.analyze_symptoms_batch')
+    def analyze_symptoms_batch(self, symptoms_list: List[Dict], locale: str = DEFAULT_LOCALE) -> List[Diagnosis]:
+        """
+        Simulate decision tree analysis for many questionnaires at once
+        All questionnaires are scored with a single sparse matrix multiply
         
-        if not best_match:
-            best_match = random.choice(self.DISEASES)
+        Args:
+            symptoms_list: Symptom dictionaries
+            locale: Language of the explanations and recommendations
+            
+        Returns:
+            One Diagnosis per questionnaire, in order
+        """
+        rngs = [self._symptom_rng(symptoms_data) for symptoms_data in symptoms_list]
+        predictions = self._symptom_predictions(self._symptom_stage(symptoms_list), rngs)
+        return [
+            self._build_result(disease_index, confidence, 'symptoms', rng,
+                               symptoms_data=symptoms_data, locale=locale)
+            for (disease_index, confidence), rng, symptoms_data in zip(predictions, rngs, symptoms_list)
+        ]
+    
+    @timed('ml_service.rank_symptoms')
+    def rank_symptoms(self, symptoms_list: List[Dict], k: int = 3) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k diseases by keyword score for many questionnaires
+        Scores only, without building explanations (for bulk re-scoring)
         
-        # Lower confidence for symptom-only diagnosis
-        confidence = random.uniform(0.60, 0.85)
+        Args:
+            symptoms_list: Symptom dictionaries
+            k: Number of diseases to return per questionnaire
+            
+        Returns:
+            (disease indices, keyword scores), both of shape (Q, k), best first
+        """
+        scores = self._symptom_stage(symptoms_list)
+        top = SymptomMatcher.top_k(scores, k)
         
-        # Generate alternative diagnoses
-        alternatives = self._generate_alternatives(best_match, confidence)
-        
-        # Generate clinical explanation
-        explanation = self._generate_explanation(best_match, confidence, 'symptoms')
-        
-        # Generate recommendations
-        recommendations = self._generate_recommendations(best_match)
-        
-        return {
-            'disease': best_match['name'],
-            'confidence': round(confidence, 3),
-            'severity': best_match['severity'],
-            'description': best_match['description'],
-            'explanation': explanation,
-            'alternative_diagnoses': alternatives,
-            'recommendations': recommendations,
-            'analysis_method': 'Symptom Decision Tree with Clinical Rules',
-            'matched_symptoms': symptoms_data
-        }
+        return top, np.take_along_axis(scores, top, axis=1)
     
-    def analyze_combined(self, image_path: str, symptoms_data: Dict) -> Dict:
+    @timed('ml_service.analyze_combined')
+    def analyze_combined(self, image_path: str, symptoms_data: Dict,
+                         image_array: np.ndarray = None, locale: str = DEFAULT_LOCALE) -> Diagnosis:
         """
         Simulate combined analysis using both image and symptoms
         Highest accuracy method
@@ -161,133 +201,256 @@ class MockMLService:
         Args:
             image_path: Path to the uploaded image
             symptoms_data: Dictionary containing symptom information
+            image_array: Preprocessed model input from preprocess_image
+            locale: Language of the explanation and recommendations
+            
+        Returns:
+            Diagnosis result
+        """
+        if image_array is None:
+            image_array = preprocess_image(image_path)
+        
+        return self.analyze_batch(image_array[np.newaxis], [symptoms_data], locale)[0]
+    
+    @timed('ml_service.analyze_batch')
+    def analyze_batch(self, image_batch: np.ndarray, symptoms_list: List[Dict],
+                      locale: str = DEFAULT_LOCALE) -> List[Diagnosis]:
+        """
+        Analyze a batch of images, fusing in symptoms where provided
+        
+        Args:
+            image_batch: Preprocessed images of shape (N, 224, 224, 3)
+            symptoms_list: Symptom dictionary (or None) for each image
+            locale: Language of the explanations and recommendations
+            
+        Returns:
+            One Diagnosis per image, in batch order
+        """
+        probabilities, models_run = self._image_stage(image_batch)
+        image_predictions = self._image_predictions(probabilities)
+        
+        # Score every provided questionnaire in one batch
+        with_symptoms = [index for index, symptoms_data in enumerate(symptoms_list) if symptoms_data]
+        symptom_predictions = {}
+        if with_symptoms:
+            symptom_scores = self._symptom_stage([symptoms_list[index] for index in with_symptoms])
+            rngs = [self._symptom_rng(symptoms_list[index]) for index in with_symptoms]
+            symptom_predictions = dict(zip(with_symptoms, self._symptom_predictions(symptom_scores, rngs)))
+        
+        results = []
+        for index, image_prediction in enumerate(image_predictions):
+            if index not in symptom_predictions:
+                rng = self._image_rng(image_batch[index])
+                results.append(self._build_result(*image_prediction, 'image', rng,
+                                                  models_run=models_run[index], locale=locale))
+                continue
+            
+            symptom_prediction = symptom_predictions[index]
+            disease_index, confidence = self._fuse(image_prediction, symptom_prediction)
+            rng = self._image_rng(image_batch[index], symptoms_list[index])
+            results.append(self._build_result(
+                disease_index, confidence, 'combined', rng,
+                image_index=image_prediction[0],
+                symptom_index=symptom_prediction[0],
+                symptoms_data=symptoms_list[index],
+                models_run=models_run[index],
+                locale=locale
+            ))
+        
+        return results
+    
+    @property
+    def registry(self) -> ModelRegistry:
+        """Model registry holding the (pre-loaded) ensemble members"""
+        if self._registry is None:
+            self._registry = get_registry()
+        return self._registry
+    
+    def _image_rng(self, image_array: np.ndarray, symptoms_data: Dict = None) -> np.random.Generator:
+        """Generator for one image (and questionnaire), derived from its content"""
+        if symptoms_data is None:
+            return content_rng('image', image_array, seed=self.seed)
+        return content_rng('combined', image_array, canonicalize_symptoms(symptoms_data), seed=self.seed)
+    
+    def _symptom_rng(self, symptoms_data: Dict) -> np.random.Generator:
+        """Generator for one questionnaire, derived from its canonical form"""
+        return content_rng('symptoms', canonicalize_symptoms(symptoms_data), seed=self.seed)
+    
+    def _image_stage(self, image_batch: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Image stage: one ensemble forward pass over a batch
+        In cascade mode, members after the cheapest run only on the images
+        the ones before were not confident about
+        
+        Args:
+            image_batch: Preprocessed images of shape (N, 224, 224, 3)
+            
+        Returns:
+            (class probabilities of shape (N, num_diseases), number of
+            ensemble members run for each image)
+        """
+        members = ModelRegistry.MEMBERS
+        if self.cascade is None:
+            probabilities = self.registry.predict(image_batch)
+            models_run = np.full(len(image_batch), len(members), dtype=np.int64)
+        else:
+            probabilities, models_run = self.registry.predict_cascade(
+                image_batch,
+                threshold=self.cascade['THRESHOLD'],
+                margin=self.cascade['MARGIN'],
+                severe_classes=self.SEVERE_CLASSES,
+                severe_min_probability=self.cascade['SEVERE_MIN_PROBABILITY']
+            )
+        
+        # Track the compute the cascade saves, in relative cost units
+        spent = 0.0
+        for depth, (name, _, cost) in enumerate(members):
+            runs = int((models_run > depth).sum())
+            ENSEMBLE_MODEL_RUNS.inc(runs, model=name)
+            spent += runs * cost
+        ENSEMBLE_COST.inc(spent, outcome='spent')
+        ENSEMBLE_COST.inc(len(image_batch) * sum(cost for _, _, cost in members) - spent, outcome='saved')
+        
+        return probabilities, models_run
+    
+    def _symptom_stage(self, symptoms_list: List[Dict]) -> np.ndarray:
+        """
+        Symptom stage: keyword scoring for a batch of questionnaires
+        
+        Args:
+            symptoms_list: Symptom dictionaries
             
         Returns:
-            Dictionary containing diagnosis results
+            Matched keyword counts of shape (Q, num_diseases)
+        """
+        return self._symptom_matcher.score_batch(d.values() for d in symptoms_list)
+    
+    def _image_predictions(self, probabilities: np.ndarray) -> List[Tuple[int, float]]:
+        """(disease index, confidence) for each row of image-stage scores"""
+        chance = 1.0 / len(self.DISEASES)
+        
+        predictions = []
+        for row in probabilities:
+            index = int(row.argmax())
+            # Map the ensemble probability onto the mock's confidence range
+            confidence = 0.70 + 0.28 * (float(row[index]) - chance) / (1.0 - chance)
+            predictions.append((index, confidence))
+        
+        return predictions
+    
+    def _symptom_predictions(self, scores: np.ndarray,
+                             rngs: List[np.random.Generator]) -> List[Tuple[int, float]]:
+        """(disease index, confidence) for each row of symptom-stage scores"""
+        # Find best matching disease based on keywords (first wins ties)
+        best_indices = scores.argmax(axis=1)
+        
+        predictions = []
+        for row, best_index, rng in zip(scores, best_indices, rngs):
+            if row[best_index] == 0:
+                best_index = rng.integers(len(self.DISEASES))
+            # Lower confidence for symptom-only diagnosis
+            predictions.append((int(best_index), float(rng.uniform(0.60, 0.85))))
+        
+        return predictions
+    
+    def _fuse(self, image_prediction: Tuple[int, float], symptom_prediction: Tuple[int, float]) -> Tuple[int, float]:
+        """
+        Fusion stage: combine image and symptom predictions
+        
+        Returns:
+            (disease index, confidence) of the combined diagnosis
         """
-        # Get both analyses
-        image_result = self.analyze_image(image_path)
-        symptom_result = self.analyze_symptoms(symptoms_data)
+        image_index, image_confidence = image_prediction
+        symptom_index, symptom_confidence = symptom_prediction
         
         # Combine results with weighted confidence (image has more weight)
-        if image_result['disease'] == symptom_result['disease']:
+        if image_index == symptom_index:
             # Both agree - higher confidence
-            confidence = min(0.98, (image_result['confidence'] * 0.7 + symptom_result['confidence'] * 0.3) * 1.1)
-            final_disease = self.DISEASES[[d['name'] for d in self.DISEASES].index(image_result['disease'])]
+            confidence = min(0.98, (image_confidence * 0.7 + symptom_confidence * 0.3) * 1.1)
         else:
             # Disagree - use image result but lower confidence
-            confidence = image_result['confidence'] * 0.9
-            final_disease = self.DISEASES[[d['name'] for d in self.DISEASES].index(image_result['disease'])]
+            confidence = image_confidence * 0.9
+        
+        return image_index, confidence
+    
+    def _build_result(self, disease_index: int, confidence: float, method: str,
+                      rng: np.random.Generator, image_index: int = None, symptom_index: int = None,
+                      symptoms_data: Dict = None, models_run: int = None,
+                      locale: str = DEFAULT_LOCALE) -> Diagnosis:
+        """
+        Final stage: build the response for the chosen diagnosis
+        Alternatives, explanation and recommendations are generated only here
+        
+        Args:
+            disease_index: Index of the diagnosed disease in DISEASES
+            confidence: Final confidence
+            method: 'image', 'symptoms' or 'combined'
+            rng: Generator for this request's alternatives
+            image_index: Image-stage disease index (combined only)
+            symptom_index: Symptom-stage disease index (combined only)
+            symptoms_data: Questionnaire to echo back (symptoms and combined)
+            models_run: Ensemble members run on the image (image and combined)
+            locale: Language of the explanation and recommendations
+            
+        Returns:
+            Diagnosis result
+        """
+        disease = self.DISEASES[disease_index]
         
         # Generate alternative diagnoses
-        alternatives = self._generate_alternatives(final_disease, confidence)
-        
-        # Generate enhanced explanation for combined analysis
-        explanation = self._generate_explanation(final_disease, confidence, 'combined', 
-                                                 image_result['disease'], symptom_result['disease'])
-        
-        # Generate recommendations
-        recommendations = self._generate_recommendations(final_disease)
-        
-        return {
-            'disease': final_disease['name'],
-            'confidence': round(confidence, 3),
-            'severity': final_disease['severity'],
-            'description': final_disease['description'],
-            'explanation': explanation,
-            'alternative_diagnoses': alternatives,
-            'recommendations': recommendations,
-            'analysis_method': 'Combined CNN Ensemble + Symptom Analysis',
-            'image_analysis': image_result['disease'],
-            'symptom_analysis': symptom_result['disease'],
-            'matched_symptoms': symptoms_data
-        }
+        alternatives = self._generate_alternatives(disease, confidence, rng)
+        
+        # Look up the precompiled clinical explanation and recommendations
+        texts = self._texts.get(locale) or self._texts[DEFAULT_LOCALE]
+        band = confidence_band(confidence)
+        if method == 'combined':
+            explanation = texts.combined_explanation(band, image_index, symptom_index)
+        else:
+            explanation = texts.explanations[method][disease['severity']][band]
+        recommendations = texts.recommendations[disease['severity']]
+        
+        result = Diagnosis(
+            disease=disease['name'],
+            confidence=round(confidence, 3),
+            severity=disease['severity'],
+            description=disease['description'],
+            explanation=explanation,
+            alternative_diagnoses=alternatives,
+            recommendations=recommendations,
+            analysis_method=self.ANALYSIS_METHODS[method],
+            matched_symptoms=symptoms_data
+        )
+        
+        if method == 'combined':
+            result.image_analysis = self.DISEASES[image_index]['name']
+            result.symptom_analysis = self.DISEASES[symptom_index]['name']
+        
+        if models_run is not None:
+            result.ensemble_models = tuple(name for name, _, _ in ModelRegistry.MEMBERS[:models_run])
+        
+        return result
     
-    def _generate_alternatives(self, primary_disease: Dict, primary_confidence: float) -> List[Dict]:
+    def _generate_alternatives(self, primary_disease: Dict, primary_confidence: float,
+                               rng: np.random.Generator) -> Tuple[Alternative, ...]:
         """Generate alternative diagnoses with confidence scores"""
         alternatives = []
         remaining_diseases = [d for d in self.DISEASES if d['name'] != primary_disease['name']]
         
         # Select 2-3 alternatives
-        num_alternatives = random.randint(2, 3)
-        selected = random.sample(remaining_diseases, min(num_alternatives, len(remaining_diseases)))
+        num_alternatives = int(rng.integers(2, 4))
+        picks = rng.choice(len(remaining_diseases), min(num_alternatives, len(remaining_diseases)), replace=False)
+        selected = [remaining_diseases[i] for i in picks]
         
         remaining_confidence = 1.0 - primary_confidence
         for i, disease in enumerate(selected):
             # Distribute remaining confidence among alternatives
-            conf = remaining_confidence * random.uniform(0.2, 0.5)
+            conf = remaining_confidence * float(rng.uniform(0.2, 0.5))
             remaining_confidence -= conf
             
-            alternatives.append({
-                'disease': disease['name'],
-                'confidence': round(conf, 3),
-                'description': disease['description']
-            })
-        
-        return sorted(alternatives, key=lambda x: x['confidence'], reverse=True)
-    
-    def _generate_explanation(self, disease: Dict, confidence: float, method: str, 
-                             image_diagnosis: str = None, symptom_diagnosis: str = None) -> str:
-        """Generate clinical explanation based on the analysis"""
-        
-        severity_text = {
-            'high': 'This is a serious condition requiring immediate medical attention.',
-            'medium': 'This condition should be evaluated by a dermatologist.',
-            'low': 'This appears to be a benign condition, but monitoring is recommended.'
-        }
-        
-        confidence_text = ""
-        if confidence >= 0.90:
-            confidence_text = "The analysis shows high confidence in this diagnosis."
-        elif confidence >= 0.75:
-            confidence_text = "The analysis shows good confidence in this diagnosis."
-        else:
-            confidence_text = "The analysis shows moderate confidence. Further examination is recommended."
-        
-        method_text = {
-            'image': 'Based on visual analysis of the skin lesion using deep learning models.',
-            'symptoms': 'Based on the reported symptoms and clinical decision trees.',
-            'combined': 'Based on comprehensive analysis combining visual features and reported symptoms.'
-        }
-        
-        explanation = f"{confidence_text} {severity_text[disease['severity']]} {method_text[method]}"
-        
-        if method == 'combined' and image_diagnosis and symptom_diagnosis:
-            if image_diagnosis == symptom_diagnosis:
-                explanation += f" Both image and symptom analysis agree on {disease['name']}, increasing diagnostic confidence."
-            else:
-                explanation += f" Image analysis suggested {image_diagnosis} while symptoms indicated {symptom_diagnosis}. The final diagnosis weighs visual features more heavily."
-        
-        return explanation
-    
-    def _generate_recommendations(self, disease: Dict) -> List[str]:
-        """Generate clinical recommendations based on diagnosis"""
-        
-        common_recommendations = [
-            "Document the lesion with photographs for comparison over time",
-            "Avoid excessive sun exposure and use broad-spectrum SPF 30+ sunscreen",
-            "Perform regular skin self-examinations",
-        ]
-        
-        severity_specific = {
-            'high': [
-                "⚠️ Seek immediate consultation with a dermatologist",
-                "Consider a biopsy for definitive diagnosis",
-                "Do not delay treatment - early intervention is critical",
-                "Bring all relevant medical history to your appointment"
-            ],
-            'medium': [
-                "Schedule an appointment with a dermatologist within 2-4 weeks",
-                "Monitor for changes in size, color, or symptoms",
-                "Consider a professional skin examination",
-                "Follow up regularly as advised by your healthcare provider"
-            ],
-            'low': [
-                "Schedule a routine dermatology check-up",
-                "Monitor for any changes in appearance",
-                "Continue regular skin cancer screening",
-                "No immediate treatment typically required, but maintain observation"
-            ]
-        }
+            alternatives.append(Alternative(
+                disease=disease['name'],
+                confidence=round(conf, 3),
+                description=disease['description']
+            ))
         
-        return severity_specific[disease['severity']] + common_recommendations
+        return tuple(sorted(alternatives, key=lambda x: x.confidence, reverse=True))
@@ -0,0 +1,451 @@
+"""
+Diagnosis request pipeline shared by the sync and async views
+
+Each function takes already-parsed request inputs and returns a
+(payload, status_code) pair, so the DRF views and the native async views
+run exactly the same validation, caching and inference steps.
+"""
+
+import json
+import logging
+from dataclasses import replace
+from typing import Dict, List, Tuple
+
+import numpy as np
+from django.conf import settings
+from rest_framework import status
+
+from .batching import MicroBatcher
+from .cache import build_result_cache
+from .inference_pool import build_inference_client
+from .ml_service import MockMLService
+from .rendering import HeatmapRenderer
+from .results import Diagnosis
+from .storage import relative_path
+from .uploads import discard_uploads
+from .utils import (
+    DecodedImage,
+    compute_activation_grids,
+    validate_image,
+    save_uploaded_image,
+    preprocess_image
+)
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Initialize ML service (the ensemble runs in the inference pool when enabled)
+ml_service = MockMLService(
+    registry=build_inference_client(),
+    cascade=settings.CASCADE if settings.CASCADE['ENABLED'] else None
+)
+
+# Initialize result cache (shared by all analyze endpoints)
+result_cache = build_result_cache()
+
+# Initialize background heatmap renderer
+heatmap_renderer = HeatmapRenderer(max_workers=settings.HEATMAP_RENDER_WORKERS)
+
+
+def _analyze_items(items: List[Tuple[np.ndarray, Dict]]) -> List[Diagnosis]:
+    """Run one micro-batch of (image_array, symptoms_data or None) items"""
+    return ml_service.analyze_batch(
+        np.stack([image_array for image_array, _ in items]),
+        [symptoms_data for _, symptoms_data in items]
+    )
+
+
+# Initialize micro-batching of concurrent image and combined analyses
+inference_batcher = MicroBatcher(
+    _analyze_items,
+    max_batch_size=settings.MICRO_BATCH['MAX_SIZE'],
+    max_wait_ms=settings.MICRO_BATCH['MAX_WAIT_MS'],
+    name='analyze'
+) if settings.MICRO_BATCH['ENABLED'] else None
+
+
+def _analyze(image_path: str, image_array: np.ndarray, symptoms_data: Dict = None) -> Diagnosis:
+    """Image (or combined, with symptoms) analysis, micro-batched when enabled"""
+    if inference_batcher is not None:
+        return inference_batcher.submit((image_array, symptoms_data))
+    if symptoms_data is None:
+        return ml_service.analyze_image(image_path, image_array)
+    return ml_service.analyze_combined(image_path, symptoms_data, image_array)
+
+
+def _attach_heatmaps(results: Diagnosis, job) -> Diagnosis:
+    """Add the overlay paths and rendering status of a job to a result"""
+    results.heatmap_path = job['heatmap_path']
+    results.attention_map_path = job['attention_map_path']
+    results.heatmap_status = job['status']
+    results.heatmap_job = job['job_id']
+    return results
+
+
+def _refresh_heatmaps(results: Diagnosis) -> Diagnosis:
+    """Copy of a cached result with its current rendering status"""
+    if results.heatmap_job is None:
+        return results
+    job = heatmap_renderer.status(results.heatmap_job)
+    if job is None:
+        return results
+    return _attach_heatmaps(replace(results), job)
+
+
+def _add_heatmaps(results: Diagnosis, image_path: str, image_array: np.ndarray,
+                  image: DecodedImage = None) -> Diagnosis:
+    """
+    Attach the Grad-CAM and attention visualizations to a result
+
+    With HEATMAP_MODE=activation the small activation grids are inlined;
+    otherwise overlay rendering is queued off the request path.
+
+    Args:
+        results: Diagnosis to update
+        image_path: Path to the saved upload
+        image_array: Preprocessed model input
+        image: Decoded image, or None to let the renderer read image_path
+
+    Returns:
+        The updated results
+    """
+    if settings.HEATMAP_MODE == 'activation':
+        results.heatmap_grid, results.attention_grid = compute_activation_grids(image_path, image_array, image)
+        return results
+
+    job = heatmap_renderer.submit(image_path, image)
+    return _attach_heatmaps(results, job)
+
+
+def _cached_response(results) -> Tuple[Dict, int]:
+    return {
+        'success': True,
+        'cached': True,
+        'diagnosis': _refresh_heatmaps(results)
+    }, status.HTTP_200_OK
+
+
+def run_image_analysis(image_file) -> Tuple[Dict, int]:
+    """
+    Analyze skin lesion from an uploaded image
+
+    Args:
+        image_file: Uploaded file object (or None if missing)
+
+    Returns:
+        (response payload, HTTP status code)
+    """
+    try:
+        # Check if image was uploaded
+        if image_file is None:
+            return {
+                'error': 'No image file provided'
+            }, status.HTTP_400_BAD_REQUEST
+
+        # Validate image (decodes it once for the whole pipeline)
+        try:
+            image = validate_image(image_file)
+        except ValueError as e:
+            return {
+                'error': str(e)
+            }, status.HTTP_400_BAD_REQUEST
+
+        # Return the stored result if this exact image was analyzed before
+        cache_key = result_cache.make_key('image', image.digest)
+        results = result_cache.get(cache_key)
+        if results is not None:
+            return _cached_response(results)
+
+        # Save uploaded image
+        image_path = save_uploaded_image(image_file)
+
+        # Preprocess image into the model input tensor
+        try:
+            image_array = preprocess_image(image)
+        except ValueError as e:
+            return {
+                'error': f'Image preprocessing failed: {str(e)}'
+            }, status.HTTP_400_BAD_REQUEST
+
+        # Perform ML analysis
+        results = _analyze(image_path, image_array)
+
+        # Add image paths and heatmaps to results
+        results.image_path = relative_path(image_path)
+        _add_heatmaps(results, image_path, image_array, image)
+        result_cache.set(cache_key, results)
+
+        return {
+            'success': True,
+            'diagnosis': results
+        }, status.HTTP_200_OK
+
+    except Exception as e:
+        logger.error(f'Error in analyze_image: {str(e)}', exc_info=True)
+        return {
+            'error': 'Internal server error during image analysis',
+            'details': str(e)
+        }, status.HTTP_500_INTERNAL_SERVER_ERROR
+    finally:
+        # Uploads not stored by validate_image (early returns, errors)
+        discard_uploads([image_file])
+
+
+def run_symptom_analysis(symptoms_data) -> Tuple[Dict, int]:
+    """
+    Analyze based on symptom questionnaire responses
+
+    Args:
+        symptoms_data: Dictionary of symptom data, or a JSON string
+            encoding one (form posts)
+
+    Returns:
+        (response payload, HTTP status code)
+    """
+    try:
+        if isinstance(symptoms_data, str):
+            try:
+                symptoms_data = json.loads(symptoms_data)
+            except ValueError:
+                return {
+                    'error': 'Symptoms must be valid JSON'
+                }, status.HTTP_400_BAD_REQUEST
+
+        if not symptoms_data:
+            return {
+                'error': 'No symptom data provided'
+            }, status.HTTP_400_BAD_REQUEST
+
+        if not isinstance(symptoms_data, dict):
+            return {
+                'error': 'Symptoms must be a JSON object'
+            }, status.HTTP_400_BAD_REQUEST
+
+        # Return the stored result for an equivalent questionnaire
+        cache_key = result_cache.make_key('symptoms', symptoms_data=symptoms_data)
+        results = result_cache.get(cache_key, symptoms_data)
+        if results is not None:
+            return _cached_response(results)
+
+        # Perform symptom-based analysis
+        results = ml_service.analyze_symptoms(symptoms_data)
+        result_cache.set(cache_key, results)
+
+        return {
+            'success': True,
+            'diagnosis': results
+        }, status.HTTP_200_OK
+
+    except Exception as e:
+        logger.error(f'Error in analyze_symptoms: {str(e)}', exc_info=True)
+        return {
+            'error': 'Internal server error during symptom analysis',
+            'details': str(e)
+        }, status.HTTP_500_INTERNAL_SERVER_ERROR
+
+
+def run_combined_analysis(image_file, symptoms_raw) -> Tuple[Dict, int]:
+    """
+    Perform combined analysis using both image and symptoms
+
+    Args:
+        image_file: Uploaded file object (or None if missing)
+        symptoms_raw: Symptom dictionary, or a JSON string encoding one
+
+    Returns:
+        (response payload, HTTP status code)
+    """
+    try:
+        # Check if image was uploaded
+        if image_file is None:
+            return {
+                'error': 'No image file provided'
+            }, status.HTTP_400_BAD_REQUEST
+
+        # Get symptoms data
+        # Handle both JSON and form data
+        symptoms_data = {}
+        if symptoms_raw:
+            if isinstance(symptoms_raw, str):
+                try:
+                    symptoms_data = json.loads(symptoms_raw)
+                except ValueError:
+                    return {
+                        'error': 'Symptoms must be valid JSON'
+                    }, status.HTTP_400_BAD_REQUEST
+            else:
+                symptoms_data = symptoms_raw
+
+        if not symptoms_data:
+            return {
+                'error': 'No symptom data provided'
+            }, status.HTTP_400_BAD_REQUEST
+
+        if not isinstance(symptoms_data, dict):
+            return {
+                'error': 'Symptoms must be a JSON object'
+            }, status.HTTP_400_BAD_REQUEST
+
+        # Validate image (decodes it once for the whole pipeline)
+        try:
+            image = validate_image(image_file)
+        except ValueError as e:
+            return {
+                'error': str(e)
+            }, status.HTTP_400_BAD_REQUEST
+
+        # Return the stored result for this image and questionnaire
+        cache_key = result_cache.make_key('combined', image.digest, symptoms_data)
+        results = result_cache.get(cache_key, symptoms_data)
+        if results is not None:
+            return _cached_response(results)
+
+        # Save uploaded image
+        image_path = save_uploaded_image(image_file)
+
+        # Preprocess image into the model input tensor
+        try:
+            image_array = preprocess_image(image)
+        except ValueError as e:
+            return {
+                'error': f'Image preprocessing failed: {str(e)}'
+            }, status.HTTP_400_BAD_REQUEST
+
+        # Perform combined analysis
+        results = _analyze(image_path, image_array, symptoms_data)
+
+        # Add image paths and heatmaps to results
+        results.image_path = relative_path(image_path)
+        _add_heatmaps(results, image_path, image_array, image)
+        result_cache.set(cache_key, results)
+
+        return {
+            'success': True,
+            'diagnosis': results
+        }, status.HTTP_200_OK
+
+    except Exception as e:
+        logger.error(f'Error in analyze_combined: {str(e)}', exc_info=True)
+        return {
+            'error': 'Internal server error during combined analysis',
+            'details': str(e)
+        }, status.HTTP_500_INTERNAL_SERVER_ERROR
+    finally:
+        # Uploads not stored by validate_image (early returns, errors)
+        discard_uploads([image_file])
+
+
+def run_batch_analysis(image_files: List, symptoms_raw) -> Tuple[Dict, int]:
+    """
+    Analyze a batch of skin lesion images in a single request
+    All valid images run through the CNN ensemble as one stacked batch
+
+    Args:
+        image_files: Uploaded file objects, in upload order
+        symptoms_raw: Optional list (or JSON string encoding one) with one
+            symptom dictionary or None per image
+
+    Returns:
+        (response payload, HTTP status code)
+    """
+    try:
+        if not image_files:
+            return {
+                'error': 'No image files provided'
+            }, status.HTTP_400_BAD_REQUEST
+
+        if len(image_files) > settings.MAX_BATCH_SIZE:
+            return {
+                'error': f'Too many images. Maximum batch size is {settings.MAX_BATCH_SIZE}.'
+            }, status.HTTP_400_BAD_REQUEST
+
+        # Get optional per-image symptoms (JSON string or list)
+        symptoms_list = [None] * len(image_files)
+        if symptoms_raw:
+            try:
+                if isinstance(symptoms_raw, str):
+                    symptoms_raw = json.loads(symptoms_raw)
+            except ValueError:
+                return {
+                    'error': 'Symptoms must be valid JSON'
+                }, status.HTTP_400_BAD_REQUEST
+
+            if (not isinstance(symptoms_raw, list)
+                    or len(symptoms_raw) != len(image_files)
+                    or any(item and not isinstance(item, dict) for item in symptoms_raw)):
+                return {
+                    'error': 'Symptoms must be a list with one dictionary (or null) per image'
+                }, status.HTTP_400_BAD_REQUEST
+            symptoms_list = symptoms_raw
+
+        items = [None] * len(image_files)
+        batch = []
+
+        for index, image_file in enumerate(image_files):
+            # Validate image (decodes it once for the whole pipeline)
+            try:
+                image = validate_image(image_file)
+            except ValueError as e:
+                items[index] = {'index': index, 'success': False, 'error': str(e)}
+                continue
+
+            # Reuse the stored result for a previously analyzed image
+            symptoms_data = symptoms_list[index]
+            namespace = 'combined' if symptoms_data else 'image'
+            cache_key = result_cache.make_key(namespace, image.digest, symptoms_data)
+            results_item = result_cache.get(cache_key, symptoms_data)
+            if results_item is not None:
+                items[index] = {
+                    'index': index,
+                    'success': True,
+                    'cached': True,
+                    'diagnosis': _refresh_heatmaps(results_item)
+                }
+                continue
+
+            # Save uploaded image
+            image_path = save_uploaded_image(image_file)
+
+            # Preprocess image into the model input tensor
+            try:
+                image_array = preprocess_image(image)
+            except ValueError as e:
+                items[index] = {
+                    'index': index,
+                    'success': False,
+                    'error': f'Image preprocessing failed: {str(e)}'
+                }
+                continue
+
+            batch.append((index, cache_key, image_path, image_array))
+
+        if batch:
+            # Run every valid image through the ensemble in one call
+            results = ml_service.analyze_batch(
+                np.stack([image_array for *_, image_array in batch]),
+                [symptoms_list[index] for index, *_ in batch]
+            )
+
+            for (index, cache_key, image_path, image_array), results_item in zip(batch, results):
+                # Without the decoded image, a queued render reads the saved
+                # file so the batch does not keep every decoded image alive
+                results_item.image_path = relative_path(image_path)
+                _add_heatmaps(results_item, image_path, image_array)
+                result_cache.set(cache_key, results_item)
+                items[index] = {'index': index, 'success': True, 'diagnosis': results_item}
+
+        return {
+            'success': True,
+            'count': len(items),
+            'results': items
+        }, status.HTTP_200_OK
+
+    except Exception as e:
+        logger.error(f'Error in analyze_batch: {str(e)}', exc_info=True)
+        return {
+            'error': 'Internal server error during batch analysis',
+            'details': str(e)
+        }, status.HTTP_500_INTERNAL_SERVER_ERROR
+    finally:
+        # Uploads not stored by validate_image (early returns, errors)
+        discard_uploads(image_files or [])
@@ -0,0 +1,190 @@
+"""
+Opt-in per-request profiling
+
+A request is profiled when it carries the profiling header (see
+settings.PROFILING) or is picked by the sampling rate. The request's
+Python work is recorded with cProfile and, optionally, the allocations
+made while it ran with tracemalloc. Requested traces are always written;
+sampled traces are only kept when the request exceeded the slow
+threshold, so sampling can stay on to catch rare outliers.
+
+Under ASGI the native async views run their pipeline on a thread pool;
+the active profile travels in a context variable and run_profiled
+records those calls in the worker thread.
+"""
+
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+import uuid
+from typing import Optional
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('healio_request_profile', default=None)
+
+# tracemalloc is process-wide: trace while any profiled request needs it
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_started = False
+
+_write_lock = threading.Lock()
+
+
+def _start_tracing():
+    global _tracing_users, _tracing_started
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            _tracing_started = True
+        _tracing_users += 1
+
+
+def _stop_tracing():
+    global _tracing_users, _tracing_started
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and _tracing_started:
+            tracemalloc.stop()
+            _tracing_started = False
+
+
+class RequestProfile:
+    """cProfile (and tracemalloc) trace of one request"""
+
+    def __init__(self, reason: str, trace_allocations: bool = False):
+        """
+        Args:
+            reason: 'requested' (header) or 'sampled'
+            trace_allocations: Also record allocations with tracemalloc
+        """
+        self.reason = reason
+        self.trace_allocations = trace_allocations
+        self._profiles = []
+        self._lock = threading.Lock()
+        self._allocations_before = None
+        self._allocations = None
+        self._token = None
+
+    def __enter__(self):
+        if self.trace_allocations:
+            _start_tracing()
+            self._allocations_before = tracemalloc.take_snapshot()
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _current.reset(self._token)
+        if self.trace_allocations:
+            # Includes allocations of concurrent requests in this process
+            self._allocations = tracemalloc.take_snapshot().compare_to(self._allocations_before, 'lineno')
+            self._allocations_before = None
+            _stop_tracing()
+        return False
+
+    def call(self, func, *args, **kwargs):
+        """Run func under a profiler in the current thread"""
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *args, **kwargs)
+        finally:
+            with self._lock:
+                self._profiles.append(profiler)
+
+    def write(self, directory: str, name: str, summary: str) -> Optional[str]:
+        """
+        Write the trace as <name>.prof (pstats) and <name>.txt (report)
+
+        Args:
+            directory: Output directory
+            name: File stem
+            summary: Request description placed at the top of the report
+
+        Returns:
+            Path of the .prof file, or None if nothing was recorded
+        """
+        with self._lock:
+            profiles = list(self._profiles)
+        if not profiles:
+            return None
+
+        os.makedirs(directory, exist_ok=True)
+        stats = pstats.Stats(profiles[0])
+        for profiler in profiles[1:]:
+            stats.add(profiler)
+
+        prof_path = os.path.join(directory, f'{name}.prof')
+        stats.dump_stats(prof_path)
+
+        report = io.StringIO()
+        report.write(summary + '\n\n')
+        stats.stream = report
+        stats.sort_stats('cumulative').print_stats(40)
+
+        if self._allocations is not None:
+            report.write('Top allocations during the request (size delta by line):\n')
+            for stat in self._allocations[:25]:
+                report.write(f'{stat}\n')
+
+        with open(os.path.join(directory, f'{name}.txt'), 'w') as handle:
+            handle.write(report.getvalue())
+
+        return prof_path
+
+
+def run_profiled(func, *args):
+    """Call func, recording it in the current request's profile if any"""
+    profile = _current.get()
+    if profile is None:
+        return func(*args)
+    return profile.call(func, *args)
+
+
+def trace_name(endpoint: str, elapsed: float) -> str:
+    return f"{time.strftime('%Y%m%dT%H%M%S')}-{endpoint}-{elapsed * 1000:.0f}ms-{uuid.uuid4().hex[:6]}"
+
+
+def enforce_limits(directory: str, max_files: int, max_bytes: int):
+    """
+    Delete the oldest traces until the directory is within its caps
+
+    Args:
+        directory: Trace directory
+        max_files: Maximum number of traces (a .prof/.txt pair is one trace)
+        max_bytes: Maximum total size of all trace files
+    """
+    with _write_lock:
+        traces = {}
+        for entry in os.scandir(directory):
+            stem, extension = os.path.splitext(entry.name)
+            if extension not in ('.prof', '.txt'):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            size, mtime = traces.get(stem, (0, 0))
+            traces[stem] = (size + stat.st_size, max(mtime, stat.st_mtime))
+
+        oldest_first = sorted(traces, key=lambda stem: traces[stem][1])
+        total = sum(size for size, _ in traces.values())
+        count = len(traces)
+
+        for stem in oldest_first:
+            if count <= max_files and total <= max_bytes:
+                break
+            for extension in ('.prof', '.txt'):
+                try:
+                    os.remove(os.path.join(directory, stem + extension))
+                except FileNotFoundError:
+                    pass
+            total -= traces[stem][0]
+            count -= 1
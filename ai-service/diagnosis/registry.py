@@ -0,0 +1,183 @@
+"""
+Model registry for the CNN ensemble
+
+Each ensemble member is loaded once per process tree: gunicorn loads the
+registry in the master before forking (see gunicorn.conf.py), so workers
+share the read-only weights copy-on-write, and weight files are opened
+memory-mapped so their pages live in the shared page cache. Members come
+from the backend configured in settings.INFERENCE_BACKEND (see backends);
+a backend that is not fork-safe, such as ONNX Runtime, is loaded in each
+process that uses it instead, and must not be loaded before a fork (its
+thread pools can leave locks held in the child).
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from .backends import EnsembleMember, get_backend
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    """
+    Loads, warms and serves the ensemble members
+    Members are kept in ascending cost order
+    """
+
+    # (display name, model file stem, relative cost)
+    MEMBERS = (
+        ('EfficientNet-B0', 'efficientnet_b0', 1.0),
+        ('DenseNet121', 'densenet121', 2.9),
+        ('ResNet50', 'resnet50', 4.1),
+    )
+
+    def __init__(self, model_path, num_classes: int, input_shape: tuple = (224, 224, 3),
+                 backend: Dict = None):
+        """
+        Args:
+            model_path: Directory holding the model files
+            num_classes: Number of output classes
+            input_shape: Model input shape (H, W, C)
+            backend: Backend configuration (defaults to settings.INFERENCE_BACKEND)
+        """
+        self.model_path = model_path
+        self.num_classes = num_classes
+        self.input_shape = input_shape
+        self.backend_config = backend if backend is not None else settings.INFERENCE_BACKEND
+        self.backend = get_backend(self.backend_config['NAME'])
+        self._members = []
+        self._pid = None
+        self._warm = False
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return bool(self._members) and self._usable()
+
+    @property
+    def warm(self) -> bool:
+        return self._warm and self._usable()
+
+    @property
+    def members(self) -> List[EnsembleMember]:
+        if not self.loaded:
+            self.load()
+        return self._members
+
+    def _usable(self) -> bool:
+        """Whether the loaded members can run in this process"""
+        return self.backend.FORK_SAFE or self._pid == os.getpid()
+
+    def load(self):
+        """Load every ensemble member (no-op once loaded in this process tree)"""
+        with self._lock:
+            if self._members and self._usable():
+                return
+
+            start = time.perf_counter()
+            self._members = [
+                self.backend.load(name, key, cost, self.model_path,
+                                  self.num_classes, self.input_shape, self.backend_config)
+                for name, key, cost in self.MEMBERS
+            ]
+            self._pid = os.getpid()
+            self._warm = False
+            logger.info(
+                f'Loaded {len(self._members)} ensemble members from {self.model_path} '
+                f'with the {self.backend_config["NAME"]} backend '
+                f'in {(time.perf_counter() - start) * 1000:.0f} ms'
+            )
+
+    def warm_up(self, batch_size: int = 1):
+        """Run a dummy batch through every member before serving traffic"""
+        dummy = np.zeros((batch_size,) + tuple(self.input_shape), dtype=np.float32)
+        for member in self.members:
+            member.predict(dummy)
+        self._warm = True
+
+    def predict(self, image_batch: np.ndarray) -> np.ndarray:
+        """
+        Ensemble class probabilities (mean over members)
+
+        Args:
+            image_batch: Array of shape (N, H, W, C)
+
+        Returns:
+            float32 array of shape (N, num_classes)
+        """
+        return np.mean([member.predict(image_batch) for member in self.members], axis=0)
+
+    def predict_cascade(self, image_batch: np.ndarray, threshold: float, margin: float,
+                        severe_classes: Sequence[int] = (),
+                        severe_min_probability: float = 1.0) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Ensemble class probabilities with early exit
+
+        Members run in cost order, each only on the images still undecided.
+        An image stops once the mean probabilities of the members run so far
+        give the top class at least threshold and a lead of margin over the
+        runner-up, unless a severe class is the top class or reaches
+        severe_min_probability; those go through the whole ensemble and get
+        the probabilities predict() gives (up to float rounding, as later
+        members see smaller batches).
+
+        Args:
+            image_batch: Array of shape (N, H, W, C)
+            threshold: Top-class probability needed to stop
+            margin: Lead over the second class needed to stop
+            severe_classes: Class indices that never stop early
+            severe_min_probability: Probability of a severe class that
+                rules out stopping early
+
+        Returns:
+            (float32 probabilities of shape (N, num_classes), number of
+            members run for each image)
+        """
+        members = self.members
+        n = len(image_batch)
+        severe_classes = list(severe_classes)
+        outputs = np.empty((len(members), n, self.num_classes), dtype=np.float32)
+        probabilities = np.empty((n, self.num_classes), dtype=np.float32)
+        models_run = np.zeros(n, dtype=np.int64)
+
+        pending = np.arange(n)
+        for depth, member in enumerate(members, start=1):
+            batch = image_batch if len(pending) == n else image_batch[pending]
+            outputs[depth - 1, pending] = member.predict(batch)
+            models_run[pending] = depth
+            fused = outputs[:depth, pending].mean(axis=0)
+            probabilities[pending] = fused
+            if depth == len(members):
+                break
+
+            top_two = np.partition(fused, -2, axis=1)[:, -2:]
+            confident = (top_two[:, 1] >= threshold) & (top_two[:, 1] - top_two[:, 0] >= margin)
+            if severe_classes:
+                confident &= ~np.isin(fused.argmax(axis=1), severe_classes)
+                confident &= fused[:, severe_classes].max(axis=1) < severe_min_probability
+            pending = pending[~confident]
+            if not len(pending):
+                break
+
+        return probabilities, models_run
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ModelRegistry:
+    """Process-wide model registry (created on first use, loaded lazily)"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            from .ml_service import MockMLService
+            _registry = ModelRegistry(settings.MODEL_PATH, num_classes=len(MockMLService.DISEASES))
+        return _registry
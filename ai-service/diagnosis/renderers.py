@@ -0,0 +1,91 @@
+"""
+JSON rendering for diagnosis responses
+
+Payloads hold Diagnosis and Alternative objects (see results.py), which
+are serialized through their to_dict() hook without first converting the
+whole response to plain dicts. orjson is used when it is installed;
+otherwise the standard library encoder produces the same JSON.
+
+Clients ask for the compact representation with ?compact=1.
+"""
+
+import json
+import logging
+
+from django.http import HttpResponse
+from rest_framework.renderers import BaseRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+COMPACT_PARAM = 'compact'
+
+_TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+def wants_compact(request) -> bool:
+    """Whether the request asked for compact results"""
+    if request is None:
+        return False
+    return request.GET.get(COMPACT_PARAM, '').lower() in _TRUE_VALUES
+
+
+def _encoder_default(compact: bool):
+    def default(value):
+        to_dict = getattr(value, 'to_dict', None)
+        if to_dict is None:
+            raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+        return to_dict(compact)
+    return default
+
+
+_DEFAULTS = {False: _encoder_default(False), True: _encoder_default(True)}
+
+
+def dumps(payload, compact: bool = False) -> bytes:
+    """
+    Serialize a response payload to UTF-8 JSON
+
+    Args:
+        payload: Response data (may contain result objects)
+        compact: Use the compact result representation
+
+    Returns:
+        Encoded JSON
+    """
+    default = _DEFAULTS[compact]
+    if orjson is not None:
+        try:
+            return orjson.dumps(payload, default=default, option=orjson.OPT_PASSTHROUGH_DATACLASS)
+        except orjson.JSONEncodeError as e:
+            # e.g. integers beyond 64 bits in an echoed questionnaire
+            logger.debug(f'orjson could not encode response, using json: {str(e)}')
+    return json.dumps(payload, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class FastJSONRenderer(BaseRenderer):
+    """DRF renderer for payloads containing result objects"""
+
+    media_type = 'application/json'
+    format = 'json'
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        request = (renderer_context or {}).get('request')
+        return dumps(data, compact=wants_compact(request))
+
+
+def json_response(request, payload, status_code: int) -> HttpResponse:
+    """Response for the native async views, rendered like FastJSONRenderer"""
+    return HttpResponse(
+        dumps(payload, compact=wants_compact(request)),
+        status=status_code,
+        content_type=FastJSONRenderer.media_type
+    )
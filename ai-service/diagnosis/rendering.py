@@ -0,0 +1,195 @@
+"""
+Background rendering of Grad-CAM and attention overlays
+
+Diagnosis responses return as soon as inference finishes. The overlays
+are rendered on a thread pool (OpenCV releases the GIL while resizing,
+colormapping and encoding) and clients poll the job status until the
+files are ready. A render that fails leaves a marker file next to its
+preview, so every worker process reports the job as failed.
+"""
+
+import logging
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional
+
+from django.conf import settings
+
+from .storage import find_upload, media_path
+from .tiles import pyramid_path
+from .utils import (
+    DecodedImage,
+    generate_attention_map,
+    generate_gradcam_heatmap,
+    visualization_path
+)
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('heatmap', 'attention')
+
+
+def _job(job_id: str, image_path: str, status: str) -> Dict:
+    """Job description with the paths its files are written to"""
+    job = {
+        'job_id': job_id,
+        'status': status,
+        'heatmap_path': visualization_path(image_path, 'heatmap'),
+        'attention_map_path': visualization_path(image_path, 'attention'),
+    }
+    if settings.HEATMAP_TILES:
+        job['heatmap_pyramid'] = pyramid_path(job['heatmap_path'])
+        job['attention_pyramid'] = pyramid_path(job['attention_map_path'])
+    return job
+
+
+def _failure_marker(job: Dict) -> str:
+    """Absolute path of the file recording that a job failed"""
+    return media_path(job['heatmap_path']) + '.failed'
+
+
+def _rendered(job: Dict) -> bool:
+    """Whether every file of a job exists (previews are written last)"""
+    return all(
+        os.path.exists(media_path(job[key]))
+        for key in ('heatmap_path', 'attention_map_path', 'heatmap_pyramid', 'attention_pyramid')
+        if key in job
+    )
+
+
+class HeatmapRenderer:
+    """
+    Thread-pool queue that renders the overlays for each analyzed image
+
+    Jobs are identified by the uploaded file's name (its content digest),
+    so any worker can report a job as ready once its files exist on disk
+    (or as failed once its failure marker does), a repeated upload reuses
+    the overlays already rendered for it, and an upload submitted again
+    while its job is pending joins that job.
+    """
+
+    PENDING = 'pending'
+    READY = 'ready'
+    FAILED = 'failed'
+
+    def __init__(self, max_workers: int = 2, max_tracked_jobs: int = 10000):
+        """
+        Args:
+            max_workers: Rendering threads (0 renders inline, for development)
+            max_tracked_jobs: Job statuses kept in memory for polling
+        """
+        self.max_tracked_jobs = max_tracked_jobs
+        self._executor = (
+            ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='heatmap-render')
+            if max_workers > 0 else None
+        )
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def job_id(image_path: str) -> str:
+        return os.path.splitext(os.path.basename(image_path))[0]
+
+    def submit(self, image_path: str, image: DecodedImage = None) -> Dict:
+        """
+        Queue rendering of the Grad-CAM and attention overlays
+
+        Args:
+            image_path: Path to the saved upload
+            image: Already decoded image; pass None to let the worker read
+                image_path itself (keeps large batches from pinning every
+                decoded image in memory until its turn)
+
+        Returns:
+            Job description with the id, status, the overlay preview paths
+            the files will be written to and, with HEATMAP_TILES, the Deep
+            Zoom descriptors of their tile pyramids
+        """
+        job = _job(self.job_id(image_path), image_path, self.PENDING)
+        if _rendered(job):
+            job['status'] = self.READY
+            with self._lock:
+                self._track(job)
+            return dict(job)
+
+        with self._lock:
+            tracked = self._jobs.get(job['job_id'])
+            if tracked is not None and tracked['status'] == self.PENDING:
+                return dict(tracked)
+            self._track(job)
+
+        # Retry a job that failed before
+        try:
+            os.remove(_failure_marker(job))
+        except FileNotFoundError:
+            pass
+
+        if self._executor is None:
+            self._render(job, image_path, image)
+        else:
+            self._executor.submit(self._render, job, image_path, image)
+
+        return dict(job)
+
+    def status(self, job_id: str) -> Optional[Dict]:
+        """
+        Look up a rendering job
+
+        Jobs queued by another worker process are reported from the files
+        on disk: ready once both overlays exist, failed once the failure
+        marker exists, pending while the upload exists without either.
+
+        Args:
+            job_id: Job id returned by submit
+
+        Returns:
+            Job description, or None if the job is unknown
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+
+        # Not queued by this process: derive the status from the files
+        upload = find_upload(job_id)
+        if upload is None:
+            return None
+
+        job = _job(job_id, upload, self.PENDING)
+        if _rendered(job):
+            job['status'] = self.READY
+        elif os.path.exists(_failure_marker(job)):
+            job['status'] = self.FAILED
+        return job
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting jobs, optionally waiting for queued renders to finish"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+
+    def _track(self, job: Dict):
+        # Lock held
+        self._jobs[job['job_id']] = job
+        self._jobs.move_to_end(job['job_id'])
+        while len(self._jobs) > self.max_tracked_jobs:
+            self._jobs.popitem(last=False)
+
+    def _render(self, job: Dict, image_path: str, image: DecodedImage):
+        try:
+            generate_gradcam_heatmap(image_path, image)
+            generate_attention_map(image_path, image)
+            status = self.READY
+        except Exception as e:
+            status = self.FAILED
+            logger.error(f'Heatmap rendering failed for {job["job_id"]}: {str(e)}', exc_info=True)
+            try:
+                os.makedirs(os.path.dirname(_failure_marker(job)), exist_ok=True)
+                with open(_failure_marker(job), 'w') as marker:
+                    marker.write(f'{type(e).__name__}: {e}\n')
+            except OSError as marker_error:
+                logger.warning(f'Could not record the failure of {job["job_id"]}: {str(marker_error)}')
+
+        with self._lock:
+            job['status'] = status
@@ -0,0 +1,138 @@
+"""
+Typed diagnosis results
+
+MockMLService returns these slotted dataclasses instead of nested dicts:
+attribute access is cheap, a result carries no per-instance __dict__, and
+the explanation and recommendation texts are shared precompiled objects
+(see texts.py). diagnosis.renderers serializes them directly.
+
+to_dict() gives the documented response shape. With compact=True it
+leaves out text the client already has or can look up from the disease
+name, severity and endpoint: descriptions, recommendations, the analysis
+method and the echoed questionnaire.
+"""
+
+import base64
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+
+
+@dataclass(slots=True)
+class Alternative:
+    """An alternative diagnosis and its share of the remaining confidence"""
+
+    disease: str
+    confidence: float
+    description: str
+
+    def to_dict(self, compact: bool = False) -> Dict:
+        if compact:
+            return {'disease': self.disease, 'confidence': self.confidence}
+        return {'disease': self.disease, 'confidence': self.confidence, 'description': self.description}
+
+
+@dataclass(slots=True)
+class ActivationGrid:
+    """
+    Low-resolution activation map for the client to colorize and blend
+
+    data holds height x width uint8 values (0-255), row-major; the client
+    upsamples the grid to the image size, applies colormap and blends it
+    onto the image with weight alpha.
+    """
+
+    width: int
+    height: int
+    data: bytes
+    colormap: str
+    alpha: float
+
+    def to_dict(self, compact: bool = False) -> Dict:
+        return {
+            'width': self.width,
+            'height': self.height,
+            'encoding': 'uint8-base64',
+            'data': base64.b64encode(self.data).decode('ascii'),
+            'colormap': self.colormap,
+            'alpha': self.alpha,
+        }
+
+
+@dataclass(slots=True)
+class Diagnosis:
+    """
+    Result of an image, symptom or combined analysis
+
+    image_analysis and symptom_analysis are set for combined analyses,
+    ensemble_models (the ensemble members that ran, fewer than all of them
+    when the cascade stopped early) for image and combined analyses,
+    matched_symptoms when a questionnaire was analyzed, and the image and
+    heatmap fields by the pipeline once the upload is stored: rendered
+    overlay paths, or the activation grids with HEATMAP_MODE=activation.
+    Unset fields are left out of the response.
+    """
+
+    disease: str
+    confidence: float
+    severity: str
+    description: str
+    explanation: str
+    alternative_diagnoses: Tuple[Alternative, ...]
+    recommendations: Tuple[str, ...]
+    analysis_method: str
+    image_analysis: Optional[str] = None
+    symptom_analysis: Optional[str] = None
+    ensemble_models: Optional[Tuple[str, ...]] = None
+    matched_symptoms: Optional[Dict] = None
+    image_path: Optional[str] = None
+    heatmap_path: Optional[str] = None
+    attention_map_path: Optional[str] = None
+    heatmap_status: Optional[str] = None
+    heatmap_job: Optional[str] = None
+    heatmap_grid: Optional[ActivationGrid] = None
+    attention_grid: Optional[ActivationGrid] = None
+
+    def to_dict(self, compact: bool = False) -> Dict:
+        """
+        Response representation
+
+        Args:
+            compact: Leave out descriptions, recommendations, the analysis
+                method and matched_symptoms
+
+        Returns:
+            JSON-serializable dictionary
+        """
+        result = {
+            'disease': self.disease,
+            'confidence': self.confidence,
+            'severity': self.severity,
+        }
+        if not compact:
+            result['description'] = self.description
+        result['explanation'] = self.explanation
+        result['alternative_diagnoses'] = [
+            alternative.to_dict(compact) for alternative in self.alternative_diagnoses
+        ]
+        if not compact:
+            result['recommendations'] = self.recommendations
+            result['analysis_method'] = self.analysis_method
+
+        if self.image_analysis is not None:
+            result['image_analysis'] = self.image_analysis
+            result['symptom_analysis'] = self.symptom_analysis
+        if self.ensemble_models is not None:
+            result['ensemble_models'] = self.ensemble_models
+        if self.matched_symptoms is not None and not compact:
+            result['matched_symptoms'] = self.matched_symptoms
+        if self.image_path is not None:
+            result['image_path'] = self.image_path
+        if self.heatmap_job is not None:
+            result['heatmap_path'] = self.heatmap_path
+            result['attention_map_path'] = self.attention_map_path
+            result['heatmap_status'] = self.heatmap_status
+            result['heatmap_job'] = self.heatmap_job
+        if self.heatmap_grid is not None:
+            result['heatmap_grid'] = self.heatmap_grid.to_dict(compact)
+            result['attention_grid'] = self.attention_grid.to_dict(compact)
+        return result
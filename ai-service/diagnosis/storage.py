@@ -0,0 +1,418 @@
+"""
+Content-addressed media storage
+
+Uploads are stored under their SHA-256 digest and every visualization
+derived from an upload is named after the same digest, so a repeated
+image shares one stored copy (and its already rendered heatmaps).
+Directories are sharded by digest prefix to keep each one small:
+
+    uploads/ab/cd/abcd...<digest>.jpg
+    heatmaps/ab/cd/abcd...<digest>_heatmap.jpg  (+ .dzi and _files/ tiles)
+
+An upload and its visualizations form one stored object. StorageSweeper
+runs in the background of every server process (one at a time, through a
+lock file) and removes objects unused for longer than the retention
+period, evicts least recently used objects while the store is over its
+byte quota, deletes heatmaps whose upload is gone and abandoned partial
+uploads, and prunes empty shard directories. Reusing an object refreshes
+its modification time, which is what retention and eviction go by.
+"""
+
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, List, Optional
+
+from django.conf import settings
+
+from .metrics import STORAGE_BYTES, STORAGE_REMOVED
+
+logger = logging.getLogger(__name__)
+
+AREAS = ('uploads', 'heatmaps')
+
+# Hex characters per shard directory level
+SHARD_WIDTH = 2
+
+# Objects and partial uploads younger than this are never removed
+# (covers uploads still being analyzed or rendered)
+MIN_AGE = 3600
+
+# Eviction stops once the store is below this share of MAX_BYTES
+LOW_WATERMARK = 0.9
+
+LOCK_FILE = '.storage-sweep.lock'
+
+
+def shard(name: str) -> str:
+    """Relative shard directory of a digest-named file, e.g. 'ab/cd'"""
+    depth = settings.STORAGE['SHARD_DEPTH']
+    return os.path.join(*(name[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH] for level in range(depth))) \
+        if depth else ''
+
+
+def object_key(filename: str) -> str:
+    """Digest a stored file belongs to (uploads and all derived files)"""
+    return filename.split('.', 1)[0].split('_', 1)[0]
+
+
+def media_path(relative_path: str) -> str:
+    """Absolute path of a path relative to MEDIA_ROOT"""
+    return os.path.join(settings.MEDIA_ROOT, relative_path)
+
+
+def relative_path(path: str) -> str:
+    """Path relative to MEDIA_ROOT, as returned to clients"""
+    return os.path.relpath(path, settings.MEDIA_ROOT)
+
+
+def upload_path(digest: str, extension: str) -> str:
+    """Absolute path of the stored upload with this digest"""
+    return os.path.join(settings.UPLOAD_PATH, shard(digest), digest + extension)
+
+
+def derived_path(area: str, name: str, suffix: str) -> str:
+    """
+    Relative path of a file derived from a stored upload
+
+    Args:
+        area: Top-level media directory (e.g. 'heatmaps')
+        name: Upload digest (file name without extension)
+        suffix: Appended to the digest, e.g. '_heatmap.jpg'
+
+    Returns:
+        e.g. heatmaps/ab/cd/<digest>_heatmap.jpg
+    """
+    return os.path.join(area, shard(name), name + suffix)
+
+
+def find_upload(digest: str) -> Optional[str]:
+    """Absolute path of the stored upload with this digest, if any"""
+    directory = os.path.join(settings.UPLOAD_PATH, shard(digest))
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file() and object_key(entry.name) == digest:
+                    return entry.path
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def touch(path: str):
+    """Mark a stored file as used now (it survives retention and eviction longer)"""
+    try:
+        os.utime(path)
+    except FileNotFoundError:
+        pass
+
+
+def write_atomically(path: str, data: bytes):
+    """
+    Write a file so readers see either nothing or the whole file
+
+    The bytes go to a temporary file in the same directory (skipped by
+    the sweeper) that then replaces path, so concurrent writers of the
+    same file never interleave.
+
+    Args:
+        path: Absolute path of the file to write
+        data: File contents
+    """
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(handle, 'wb') as output:
+            output.write(data)
+        os.chmod(temporary, 0o644)
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def store_upload(source_path: str, digest: str, extension: str) -> str:
+    """
+    Move a fully written file into the store under its digest
+
+    If the content is already stored, the new copy is dropped and the
+    existing one is reused.
+
+    Args:
+        source_path: Temporary file with the upload bytes (consumed)
+        digest: SHA-256 hex digest of the bytes
+        extension: File extension including the dot
+
+    Returns:
+        Absolute path of the stored upload
+    """
+    stored_path = upload_path(digest, extension)
+    if os.path.exists(stored_path):
+        os.remove(source_path)
+        touch(stored_path)
+        return stored_path
+
+    os.makedirs(os.path.dirname(stored_path), exist_ok=True)
+    os.replace(source_path, stored_path)
+    return stored_path
+
+
+def _tree_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for filename in files:
+            try:
+                total += os.stat(os.path.join(root, filename)).st_size
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def _remove(path: str):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class StoredObject:
+    """An upload and everything derived from it"""
+
+    __slots__ = ('key', 'paths', 'size', 'mtime', 'has_upload')
+
+    def __init__(self, key: str):
+        self.key = key
+        self.paths = []
+        self.size = 0
+        self.mtime = 0.0
+        self.has_upload = False
+
+
+class StorageSweeper:
+    """
+    Background retention, quota eviction and cleanup of the media store
+    """
+
+    def __init__(self, config: Dict = None):
+        """
+        Args:
+            config: Storage configuration (defaults to settings.STORAGE)
+        """
+        self.config = config if config is not None else settings.STORAGE
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start the sweep thread in this process (after a fork, again)"""
+        if not self.config['SWEEP_INTERVAL'] or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        threading.Thread(target=self._sweep_periodically, name='storage-sweep', daemon=True).start()
+
+    def _sweep_periodically(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.config['SWEEP_INTERVAL'])
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.error(f'Storage sweep failed: {str(e)}', exc_info=True)
+
+    def sweep(self, now: float = None) -> Optional[Dict]:
+        """
+        Run one sweep unless another process is already sweeping
+
+        Args:
+            now: Reference time (defaults to the current time)
+
+        Returns:
+            Counts of what was kept and removed, or None if skipped
+        """
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        with open(media_path(LOCK_FILE), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                return self._sweep(time.time() if now is None else now)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _sweep(self, now: float) -> Dict:
+        start = time.perf_counter()
+        stats = {'objects': 0, 'bytes': 0, 'expired': 0, 'evicted': 0, 'orphaned': 0, 'stale_parts': 0}
+
+        stats['stale_parts'] = self._remove_stale_parts(now)
+        objects = self.scan()
+
+        retention = self.config['RETENTION_DAYS'] * 86400
+        kept = []
+        for stored in objects.values():
+            age = now - stored.mtime
+            if age < MIN_AGE:
+                kept.append(stored)
+            elif not stored.has_upload:
+                self._delete(stored, 'orphaned', stats)
+            elif retention and age > retention:
+                self._delete(stored, 'expired', stats)
+            else:
+                kept.append(stored)
+
+        # Evict least recently used objects while over quota
+        max_bytes = self.config['MAX_BYTES']
+        total = sum(stored.size for stored in kept)
+        if max_bytes and total > max_bytes:
+            for stored in sorted(kept, key=lambda item: item.mtime):
+                if total <= max_bytes * LOW_WATERMARK:
+                    break
+                if now - stored.mtime < MIN_AGE:
+                    continue
+                self._delete(stored, 'evicted', stats)
+                kept.remove(stored)
+                total -= stored.size
+            if total > max_bytes:
+                logger.warning(f'Media store is over quota ({total} > {max_bytes} bytes) with only recent objects')
+
+        self._prune_empty_shards()
+
+        stats['objects'] = len(kept)
+        stats['bytes'] = total
+        for area in AREAS:
+            STORAGE_BYTES.set(
+                sum(size for stored in kept for path, size in stored.paths if path.startswith(area + os.sep)),
+                area=area
+            )
+        logger.info(f'Storage sweep finished in {time.perf_counter() - start:.1f}s: {stats}')
+        return stats
+
+    def scan(self) -> Dict[str, StoredObject]:
+        """Every stored object, keyed by digest (sharded and legacy flat files)"""
+        objects = {}
+        for area in AREAS:
+            root = media_path(area)
+            if not os.path.isdir(root):
+                continue
+            for directory in self._leaf_directories(root):
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(('.part', '.tmp')) or entry.name.startswith('.'):
+                            continue
+                        if entry.is_dir(follow_symlinks=False) and directory == root \
+                                and not entry.name.endswith('_files'):
+                            # Shard directory at the area root
+                            continue
+                        self._add_entry(objects, area, entry)
+        return objects
+
+    def _leaf_directories(self, root: str) -> List[str]:
+        """The area root (legacy flat files) and every shard directory"""
+        directories = [root]
+        level = [root]
+        for _ in range(self.config['SHARD_DEPTH']):
+            next_level = []
+            for directory in level:
+                with os.scandir(directory) as entries:
+                    next_level.extend(
+                        entry.path for entry in entries
+                        if entry.is_dir(follow_symlinks=False) and len(entry.name) == SHARD_WIDTH
+                    )
+            level = next_level
+        return directories + level
+
+    def _add_entry(self, objects: Dict, area: str, entry: os.DirEntry):
+        key = object_key(entry.name)
+        stored = objects.get(key)
+        if stored is None:
+            stored = objects[key] = StoredObject(key)
+        try:
+            stat = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            return
+        size = _tree_size(entry.path) if entry.is_dir(follow_symlinks=False) else stat.st_size
+        stored.paths.append((os.path.join(area, relative_path(entry.path)[len(area) + 1:]), size))
+        stored.size += size
+        stored.mtime = max(stored.mtime, stat.st_mtime)
+        if area == 'uploads':
+            stored.has_upload = True
+
+    def _delete(self, stored: StoredObject, reason: str, stats: Dict):
+        for path, _ in stored.paths:
+            _remove(media_path(path))
+        stats[reason] += 1
+        STORAGE_REMOVED.inc(reason=reason)
+
+    def _remove_stale_parts(self, now: float) -> int:
+        removed = 0
+        try:
+            with os.scandir(settings.UPLOAD_PATH) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.part') and now - entry.stat().st_mtime > MIN_AGE:
+                        _remove(entry.path)
+                        removed += 1
+        except FileNotFoundError:
+            pass
+        if removed:
+            STORAGE_REMOVED.inc(removed, reason='stale_part')
+        return removed
+
+    def _prune_empty_shards(self):
+        for area in AREAS:
+            root = media_path(area)
+            if not os.path.isdir(root):
+                continue
+            # Deepest first so emptied parents are removed too
+            for directory in reversed(self._leaf_directories(root)[1:]):
+                while directory != root:
+                    try:
+                        os.rmdir(directory)
+                    except OSError:
+                        break
+                    directory = os.path.dirname(directory)
+
+    def migrate_flat(self) -> int:
+        """
+        Move legacy files stored directly in the area roots into shards
+
+        Stored paths handed out before the move (e.g. in diagnosis
+        history) point at the old flat location afterwards.
+
+        Returns:
+            Number of files and tile directories moved
+        """
+        moved = 0
+        for area in AREAS:
+            root = media_path(area)
+            if not os.path.isdir(root):
+                continue
+            with os.scandir(root) as entries:
+                legacy = [
+                    entry for entry in entries
+                    if not entry.name.startswith('.') and not entry.name.endswith(('.part', '.tmp'))
+                    and (entry.is_file() or entry.name.endswith('_files'))
+                ]
+            for entry in legacy:
+                target_dir = os.path.join(root, shard(object_key(entry.name)))
+                os.makedirs(target_dir, exist_ok=True)
+                target = os.path.join(target_dir, entry.name)
+                if os.path.exists(target):
+                    _remove(entry.path)
+                else:
+                    os.replace(entry.path, target)
+                moved += 1
+        return moved
+
+
+sweeper = StorageSweeper()
@@ -1,3 +1,1755 @@
-from django.test import TestCase
+import base64
+import fcntl
+import importlib.util
+import io
+import json
+import os
+import shutil
+import stat
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+from multiprocessing import AuthenticationError
+from typing import Dict
+from unittest import mock, skipUnless
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.urls import include, path, resolve
+from PIL import Image
+
+from . import async_views, pipeline, renderers, views
+from . import urls as diagnosis_urls
+from .admission import AdmissionController, Rejected, server_snapshot
+from .backends import EnsembleMember, MockMember, OnnxMember, get_backend
+from .batching import MicroBatcher
+from .cache import LocalMemoryBackend, ResultCache
+from .inference_pool import InferencePoolClient
+from .matching import SymptomMatcher
+from .metrics import AGGREGATE_FILE, Counter, Gauge, Histogram, MetricsRegistry, merge_snapshots
+from .ml_service import MockMLService
+from .profiling import enforce_limits
+from .registry import ModelRegistry
+from .renderers import FastJSONRenderer, json_response
+from .rendering import HeatmapRenderer
+from .results import Alternative, Diagnosis
+from .storage import MIN_AGE, StorageSweeper, upload_path
+from .texts import TEXTS, compile_texts
+from .tiles import read_pyramid, write_pyramid
+from .uploads import MAX_HEADER_BYTES, ImageUploadHandler
+from .utils import (
+    compute_activation_grids,
+    content_rng,
+    generate_gradcam_heatmap,
+    preprocess_image,
+    validate_image,
+)
+
+
+def encode_image(width: int, height: int, image_format: str = 'PNG') -> bytes:
+    buffer = io.BytesIO()
+    Image.new('RGB', (width, height), (120, 60, 30)).save(buffer, image_format)
+    return buffer.getvalue()
+
+
+def with_app_segments(jpeg: bytes, count: int, size: int = 65533) -> bytes:
+    """JPEG with `count` APP1 segments (like EXIF/ICC data) before its frame header"""
+    segment = b'\xff\xe1' + struct.pack('>H', size + 2) + b'\0' * size
+    return jpeg[:2] + segment * count + jpeg[2:]
+
+
+class MediaRootMixin:
+    """Runs each test against an empty temporary MEDIA_ROOT"""
+
+    def setUp(self):
+        super().setUp()
+        self.media_root = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.media_root, 'uploads'))
+        os.makedirs(os.path.join(self.media_root, 'heatmaps'))
+        override = override_settings(
+            MEDIA_ROOT=self.media_root,
+            UPLOAD_PATH=os.path.join(self.media_root, 'uploads'),
+            HEATMAP_PATH=os.path.join(self.media_root, 'heatmaps'),
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+        self.addCleanup(shutil.rmtree, self.media_root, ignore_errors=True)
+
+        # Background renders finish before the directory is removed
+        renderer = HeatmapRenderer(max_workers=1)
+        patcher = mock.patch.object(pipeline, 'heatmap_renderer', renderer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(renderer.shutdown)
+
+
+def store_image(digest: str, width: int = 64, height: int = 48) -> str:
+    """Stored PNG upload under `digest` (call inside MediaRootMixin)"""
+    path = upload_path(digest, '.png')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as handle:
+        handle.write(encode_image(width, height, 'PNG'))
+    return path
+
+
+class StreamingHeaderTests(MediaRootMixin, SimpleTestCase):
+    """Format and dimension sniffing while an upload streams in"""
+
+    CHUNK_SIZES = (1, 3, 7, 64, 65536)
+
+    def stream(self, data: bytes, chunk_size: int, content_type: str = 'image/png'):
+        handler = ImageUploadHandler()
+        handler.new_file('image', 'upload', content_type, len(data))
+        for offset in range(0, len(data), chunk_size):
+            handler.receive_data_chunk(data[offset:offset + chunk_size], offset)
+        upload = handler.file_complete(len(data))
+        self.addCleanup(upload.discard)
+        return upload
+
+    def test_png_dimensions(self):
+        data = encode_image(37, 21, 'PNG')
+        for chunk_size in self.CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                upload = self.stream(data, chunk_size)
+                self.assertIsNone(upload.rejection)
+                self.assertEqual(upload.image_format, 'PNG')
+                self.assertEqual(upload.dimensions, (37, 21))
+                self.assertEqual(upload.read(), data)
+
+    def test_jpeg_dimensions(self):
+        data = encode_image(40, 25, 'JPEG')
+        for chunk_size in self.CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                upload = self.stream(data, chunk_size, 'image/jpeg')
+                self.assertIsNone(upload.rejection)
+                self.assertEqual((upload.image_format, upload.dimensions), ('JPEG', (40, 25)))
+
+    def test_jpeg_frame_header_after_large_segments(self):
+        # Frame header beyond the first 64 KiB chunk
+        data = with_app_segments(encode_image(40, 25, 'JPEG'), 2)
+        for chunk_size in (64, 65536):
+            with self.subTest(chunk_size=chunk_size):
+                upload = self.stream(data, chunk_size, 'image/jpeg')
+                self.assertEqual(upload.dimensions, (40, 25))
+
+    def test_truncated_headers_are_rejected(self):
+        png = encode_image(37, 21, 'PNG')
+        jpeg = with_app_segments(encode_image(40, 25, 'JPEG'), 1)
+        for data in (png[:5], png[:20], jpeg[:3], jpeg[:1000]):
+            for chunk_size in self.CHUNK_SIZES:
+                with self.subTest(length=len(data), chunk_size=chunk_size):
+                    upload = self.stream(data, chunk_size)
+                    self.assertEqual(upload.rejection, 'Invalid image file. File may be corrupted.')
+                    self.assertEqual(upload.size, 0)
+
+    def test_header_beyond_limit_is_rejected(self):
+        count = MAX_HEADER_BYTES // 65537 + 1
+        data = with_app_segments(encode_image(40, 25, 'JPEG'), count)
+        for chunk_size in (64, 65536):
+            with self.subTest(chunk_size=chunk_size):
+                upload = self.stream(data, chunk_size, 'image/jpeg')
+                self.assertEqual(upload.rejection, 'Invalid image file. Could not read image dimensions.')
+
+    @override_settings(MAX_IMAGE_PIXELS=1000)
+    def test_oversized_dimensions_are_rejected(self):
+        data = encode_image(50, 50, 'PNG')
+        for chunk_size in self.CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                upload = self.stream(data, chunk_size)
+                self.assertTrue(upload.rejection.startswith('Image dimensions too large (50x50)'))
+
+    def test_non_images_are_rejected(self):
+        for chunk_size in self.CHUNK_SIZES:
+            with self.subTest(chunk_size=chunk_size):
+                upload = self.stream(b'GIF89a' + b'\0' * 100, chunk_size)
+                self.assertEqual(upload.rejection, 'Invalid file type. Only JPEG and PNG are allowed.')
+
+    def test_rejected_upload_leaves_no_file(self):
+        self.stream(encode_image(37, 21, 'PNG')[:20], 7)
+        self.assertEqual(os.listdir(os.path.join(self.media_root, 'uploads')), [])
+
+    def test_undecodable_upload_is_not_stored(self):
+        data = encode_image(37, 21, 'PNG')[:33] + os.urandom(4096)
+        upload = self.stream(data, 65536)
+        self.assertIsNone(upload.rejection)
+        with self.assertRaises(ValueError):
+            validate_image(upload)
+        self.assertEqual(list(os.walk(os.path.join(self.media_root, 'uploads')))[0][1:], ([], []))
+
+    def test_decoded_upload_is_stored_by_digest(self):
+        upload = self.stream(encode_image(37, 21, 'PNG'), 65536)
+        validate_image(upload)
+        self.assertTrue(os.path.basename(upload.stored_path).startswith(upload.digest))
+        self.assertTrue(os.path.exists(upload.stored_path))
+        self.assertIsNone(upload.part_path)
+
+
+class UploadCleanupTests(MediaRootMixin, SimpleTestCase):
+    """Requests that fail before validating their uploads leave no .part files"""
+
+    def upload(self, name: str = 'lesion.png'):
+        upload = io.BytesIO(encode_image(40, 30, 'PNG'))
+        upload.name = name
+        return upload
+
+    def part_files(self):
+        return [name for _, _, names in os.walk(settings.UPLOAD_PATH)
+                for name in names if name.endswith('.part')]
+
+    def test_invalid_combined_requests(self):
+        for symptoms in (None, '{not json'):
+            with self.subTest(symptoms=symptoms):
+                data = {'image': self.upload()}
+                if symptoms is not None:
+                    data['symptoms'] = symptoms
+                response = self.client.post('/api/analyze/combined', data)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(self.part_files(), [])
+
+    @override_settings(MAX_BATCH_SIZE=1)
+    def test_oversized_batch(self):
+        response = self.client.post('/api/analyze/batch', {'images': [self.upload(), self.upload()]})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.part_files(), [])
+
+    def test_malformed_batch_symptoms(self):
+        for symptoms in ('{not json', '[{}, {}]', '["fever"]'):
+            with self.subTest(symptoms=symptoms):
+                response = self.client.post('/api/analyze/batch', {
+                    'images': [self.upload()],
+                    'symptoms': symptoms,
+                })
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(self.part_files(), [])
+
+    def test_unexpected_file_fields(self):
+        response = self.client.post('/api/analyze/image', {
+            'image': self.upload(),
+            'thumbnail': self.upload('thumbnail.png'),
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.part_files(), [])
+
+
+class BatchAnalysisTests(MediaRootMixin, SimpleTestCase):
+    """/api/analyze/batch against the single-image endpoints"""
+
+    SYMPTOMS = {'lesion_color': 'dark brown', 'lesion_shape': 'irregular', 'size_change': 'growing'}
+
+    def setUp(self):
+        super().setUp()
+        # Every request computes its result (no answers from the cache)
+        patcher = mock.patch.object(pipeline, 'result_cache', ResultCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, data: bytes, name: str = 'lesion.png'):
+        upload = io.BytesIO(data)
+        upload.name = name
+        return upload
+
+    def post_batch(self, images, symptoms=None):
+        data = {'images': [self.upload(image) for image in images]}
+        if symptoms is not None:
+            data['symptoms'] = json.dumps(symptoms)
+        return self.client.post('/api/analyze/batch', data)
+
+    def diagnosis(self, payload: Dict) -> Dict:
+        # Only the background render may have progressed in between
+        diagnosis = dict(payload['diagnosis'])
+        self.assertIn(diagnosis.pop('heatmap_status'), ('pending', 'ready'))
+        return diagnosis
+
+    def test_invalid_images_get_their_own_entries(self):
+        valid = encode_image(96, 64, 'PNG')
+        response = self.post_batch([valid, b'GIF89a' + b'\0' * 100, valid[:20], valid])
+
+        self.assertEqual(response.status_code, 200)
+        payload = response.json()
+        self.assertEqual(payload['count'], 4)
+        self.assertEqual([item['index'] for item in payload['results']], [0, 1, 2, 3])
+        self.assertEqual([item['success'] for item in payload['results']], [True, False, False, True])
+        self.assertEqual(payload['results'][1]['error'], 'Invalid file type. Only JPEG and PNG are allowed.')
+        self.assertEqual(payload['results'][2]['error'], 'Invalid image file. File may be corrupted.')
+        self.assertEqual(self.diagnosis(payload['results'][0]), self.diagnosis(payload['results'][3]))
+
+    @override_settings(MAX_BATCH_SIZE=2)
+    def test_batch_size_limit(self):
+        image = encode_image(32, 32, 'PNG')
+        self.assertEqual(self.post_batch([image] * 2).status_code, 200)
+
+        response = self.post_batch([image] * 3)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Too many images. Maximum batch size is 2.'})
+
+    def test_no_images(self):
+        response = self.client.post('/api/analyze/batch', {})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'No image files provided'})
+
+    def test_symptoms_must_match_the_images(self):
+        images = [encode_image(32, 32, 'PNG')] * 2
+        error = {'error': 'Symptoms must be a list with one dictionary (or null) per image'}
+        for symptoms in ([self.SYMPTOMS], [self.SYMPTOMS] * 3, self.SYMPTOMS, [self.SYMPTOMS, 'itching'], [1, None]):
+            with self.subTest(symptoms=symptoms):
+                response = self.post_batch(images, symptoms)
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), error)
+
+        response = self.client.post('/api/analyze/batch', {
+            'images': [self.upload(image) for image in images],
+            'symptoms': '[{',
+        })
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'Symptoms must be valid JSON'})
+
+        self.assertEqual(self.post_batch(images, [None, self.SYMPTOMS]).status_code, 200)
+        self.assertEqual(self.post_batch(images, [None, None]).status_code, 200)
+
+    def test_batch_results_equal_single_image_results(self):
+        first, second = encode_image(96, 64, 'PNG'), encode_image(80, 120, 'JPEG')
+        batch = self.post_batch([first, second], [None, self.SYMPTOMS]).json()['results']
+
+        image = self.client.post('/api/analyze/image', {'image': self.upload(first)}).json()
+        combined = self.client.post('/api/analyze/combined', {
+            'image': self.upload(second, 'lesion.jpg'),
+            'symptoms': json.dumps(self.SYMPTOMS),
+        }).json()
+
+        self.assertEqual(self.diagnosis(batch[0]), self.diagnosis(image))
+        self.assertEqual(self.diagnosis(batch[1]), self.diagnosis(combined))
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    """Slots, queueing and shedding in one process"""
+
+    def hold(self, controller, endpoint, started, release, order):
+        with controller.admit(endpoint):
+            order.append(endpoint)
+            started.set()
+            release.wait(5)
+
+    def test_concurrent_requests_all_run_within_the_limit(self):
+        controller = AdmissionController(2, {'analyze_image': 64}, queue_timeout=10)
+        running, peak, errors = [0], [0], []
+        lock = threading.Lock()
+
+        def request():
+            try:
+                with controller.admit('analyze_image'):
+                    with lock:
+                        running[0] += 1
+                        peak[0] = max(peak[0], running[0])
+                    time.sleep(0.001)
+                    with lock:
+                        running[0] -= 1
+            except Rejected as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=request) for _ in range(48)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(peak[0], 2)
+        snapshot = controller.snapshot()
+        self.assertEqual((snapshot['active'], snapshot['queued']), (0, {'analyze_image': 0}))
+
+    def test_symptoms_go_before_queued_image_work(self):
+        controller = AdmissionController(1, {'analyze_image': 4, 'analyze_symptoms': 4})
+        release, order = threading.Event(), []
+        started = threading.Event()
+        holder = threading.Thread(target=self.hold, args=(controller, 'analyze_image', started, release, order))
+        holder.start()
+        started.wait(5)
+
+        waiters = []
+        for endpoint in ('analyze_image', 'analyze_symptoms'):
+            thread = threading.Thread(
+                target=self.hold, args=(controller, endpoint, threading.Event(), release, order)
+            )
+            thread.start()
+            waiters.append(thread)
+            while controller.snapshot()['queued'][endpoint] == 0:
+                time.sleep(0.001)
+
+        release.set()
+        for thread in [holder] + waiters:
+            thread.join()
+        self.assertEqual(order, ['analyze_image', 'analyze_symptoms', 'analyze_image'])
+
+    def test_full_queue_is_rejected_with_429(self):
+        controller = AdmissionController(1, {'analyze_batch': 0})
+        with controller.admit('analyze_batch'):
+            self.assertTrue(controller.snapshot()['saturated'])
+            with self.assertRaises(Rejected) as rejected:
+                with controller.admit('analyze_batch'):
+                    pass
+        self.assertEqual(rejected.exception.status_code, 429)
+        self.assertGreaterEqual(rejected.exception.retry_after, 1)
+        self.assertFalse(controller.snapshot()['saturated'])
+
+    def test_queue_timeout_is_rejected_with_503(self):
+        controller = AdmissionController(1, {'analyze_image': 1}, queue_timeout=0.01)
+        with controller.admit('analyze_image'):
+            with self.assertRaises(Rejected) as rejected:
+                with controller.admit('analyze_image'):
+                    pass
+        self.assertEqual(rejected.exception.status_code, 503)
+        self.assertEqual(controller.snapshot()['queued'], {'analyze_image': 0})
+
+    def test_server_snapshot_reads_metrics_dir(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        with override_settings(METRICS_DIR=''):
+            self.assertIsNone(server_snapshot())
+
+        controller = AdmissionController(1, {'analyze_batch': 0})
+        with override_settings(METRICS_DIR=directory):
+            with controller.admit('analyze_batch'):
+                busy = server_snapshot()
+            idle = server_snapshot()
+        self.assertEqual((busy['processes'], busy['active'], busy['saturated']), (1, 1, True))
+        self.assertEqual((idle['active'], idle['saturated']), (0, False))
+
+
+@override_settings(HEATMAP_TILES=False)
+class HeatmapRendererTests(MediaRootMixin, SimpleTestCase):
+    """Job status across processes and repeated submits"""
+
+    def test_renders_inline(self):
+        image_path = store_image('a' * 64)
+        job = HeatmapRenderer(max_workers=0).submit(image_path)
+        self.assertEqual(job['status'], HeatmapRenderer.READY)
+        self.assertEqual(HeatmapRenderer(max_workers=0).status(job['job_id'])['status'], HeatmapRenderer.READY)
+
+    def test_failure_is_reported_by_other_processes(self):
+        image_path = store_image('b' * 64)
+        with mock.patch('diagnosis.rendering.generate_gradcam_heatmap', side_effect=RuntimeError('boom')), \
+                self.assertLogs('diagnosis.rendering', 'ERROR'):
+            job = HeatmapRenderer(max_workers=0).submit(image_path)
+        self.assertEqual(job['status'], HeatmapRenderer.FAILED)
+
+        # A renderer that did not queue the job reads the marker
+        self.assertEqual(HeatmapRenderer(max_workers=0).status(job['job_id'])['status'], HeatmapRenderer.FAILED)
+
+        # Submitting again retries and clears the marker
+        retried = HeatmapRenderer(max_workers=0).submit(image_path)
+        self.assertEqual(retried['status'], HeatmapRenderer.READY)
+        self.assertEqual(HeatmapRenderer(max_workers=0).status(job['job_id'])['status'], HeatmapRenderer.READY)
+
+    def test_pending_job_is_not_rendered_twice(self):
+        image_path = store_image('c' * 64)
+        renderer = HeatmapRenderer(max_workers=2)
+        self.addCleanup(renderer.shutdown)
+        release = threading.Event()
+        calls = []
+
+        def render(path, image):
+            calls.append(path)
+            release.wait(5)
+
+        with mock.patch('diagnosis.rendering.generate_gradcam_heatmap', side_effect=render), \
+                mock.patch('diagnosis.rendering.generate_attention_map'):
+            first = renderer.submit(image_path)
+            second = renderer.submit(image_path)
+            release.set()
+            renderer.shutdown()
+
+        self.assertEqual(second, first)
+        self.assertEqual(len(calls), 1)
+
+
+class OverlayFilesTests(MediaRootMixin, SimpleTestCase):
+    """Overlay previews and pyramid descriptors on disk"""
+
+    def test_pyramid_is_reread_after_it_changes(self):
+        descriptor = os.path.join(self.media_root, 'heatmaps', 'overlay.dzi')
+        write_pyramid(np.zeros((300, 200, 3), np.uint8), descriptor, tile_size=128)
+        self.assertEqual(read_pyramid(descriptor)['width'], 200)
+
+        os.remove(descriptor)
+        with self.assertRaises(FileNotFoundError):
+            read_pyramid(descriptor)
+
+        write_pyramid(np.zeros((40, 600, 3), np.uint8), descriptor, tile_size=128)
+        self.assertEqual(read_pyramid(descriptor)['width'], 600)
+
+    @override_settings(HEATMAP_TILES=True)
+    def test_overlays_are_written_without_leftovers(self):
+        image_path = store_image('d' * 64)
+        preview = os.path.join(self.media_root, generate_gradcam_heatmap(image_path))
+        generate_gradcam_heatmap(image_path)
+
+        directory = os.path.dirname(preview)
+        self.assertEqual(sorted(name for name in os.listdir(directory) if name.endswith('.tmp')), [])
+        self.assertEqual(Image.open(preview).size, (64, 48))
+        self.assertEqual(read_pyramid(os.path.splitext(preview)[0] + '.dzi')['height'], 48)
+
+    @override_settings(HEATMAP_TILES=True, HEATMAP_PYRAMID_MAX_SIZE=40, HEATMAP_MAX_SIZE=0)
+    def test_pyramid_top_level_is_capped(self):
+        image_path = store_image('e' * 64, 100, 60)
+        preview = os.path.join(self.media_root, generate_gradcam_heatmap(image_path))
+
+        pyramid = read_pyramid(os.path.splitext(preview)[0] + '.dzi')
+        self.assertEqual((pyramid['width'], pyramid['height']), (40, 24))
+        self.assertEqual(Image.open(preview).size, (40, 24))
+
+
+@override_settings(HEATMAP_MODE='activation', HEATMAP_GRID_SIZE=16)
+class ActivationGridTests(MediaRootMixin, SimpleTestCase):
+    """Inline activation grids instead of rendered overlays"""
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(pipeline, 'result_cache', ResultCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def decode(self, grid: Dict) -> np.ndarray:
+        self.assertEqual(grid['encoding'], 'uint8-base64')
+        data = base64.b64decode(grid['data'])
+        return np.frombuffer(data, np.uint8).reshape(grid['height'], grid['width'])
+
+    def test_grid_shape_and_encoding(self):
+        image_path = store_image('a' * 64, 120, 80)
+        image_array = preprocess_image(image_path)
+
+        for size, expected in ((None, 16), (8, 8)):
+            with self.subTest(size=size):
+                gradcam, attention = compute_activation_grids(image_path, image_array, size=size)
+                for grid in (gradcam, attention):
+                    self.assertEqual((grid.width, grid.height, len(grid.data)), (expected, expected, expected ** 2))
+                    self.assertIsInstance(grid.data, bytes)
+
+                    encoded = grid.to_dict()
+                    decoded = self.decode(encoded)
+                    self.assertEqual((decoded.shape, decoded.dtype), ((expected, expected), np.uint8))
+                    self.assertEqual(decoded.tobytes(), grid.data)
+                    self.assertEqual(encoded, grid.to_dict(compact=True))
+                self.assertEqual((gradcam.colormap, gradcam.alpha), ('jet', 0.4))
+                self.assertEqual((attention.colormap, attention.alpha), ('hot', 0.3))
+                self.assertGreater(max(gradcam.data), 0)
+
+        first = compute_activation_grids(image_path, image_array)
+        again = compute_activation_grids(image_path, preprocess_image(image_path))
+        self.assertEqual([grid.data for grid in again], [grid.data for grid in first])
+
+    def heatmap_files(self):
+        return [name for _, _, names in os.walk(settings.HEATMAP_PATH) for name in names]
+
+    def test_endpoints_return_grids_without_rendering(self):
+        upload = io.BytesIO(encode_image(120, 80, 'PNG'))
+        upload.name = 'lesion.png'
+        batch_uploads = []
+        for size in ((90, 60), (60, 90)):
+            batch_upload = io.BytesIO(encode_image(*size, 'PNG'))
+            batch_upload.name = 'lesion.png'
+            batch_uploads.append(batch_upload)
+
+        with mock.patch.object(pipeline.heatmap_renderer, 'submit') as submit:
+            diagnoses = [self.client.post('/api/analyze/image', {'image': upload}).json()['diagnosis']]
+            diagnoses += [
+                item['diagnosis']
+                for item in self.client.post('/api/analyze/batch', {'images': batch_uploads}).json()['results']
+            ]
+        submit.assert_not_called()
+
+        for diagnosis in diagnoses:
+            for field in ('heatmap_path', 'attention_map_path', 'heatmap_status', 'heatmap_job'):
+                self.assertNotIn(field, diagnosis)
+            self.assertEqual(self.decode(diagnosis['heatmap_grid']).shape, (16, 16))
+            self.assertEqual(self.decode(diagnosis['attention_grid']).shape, (16, 16))
+        self.assertEqual(self.heatmap_files(), [])
+
+
+class CompiledTextsTests(SimpleTestCase):
+    """Combined explanations built from the per-disease parts"""
+
+    DISEASES = [
+        {'name': 'Melanoma', 'severity': 'high'},
+        {'name': 'Eczema', 'severity': 'low'},
+    ]
+
+    def test_combined_explanations(self):
+        texts = compile_texts(self.DISEASES)['en']
+        agreeing = texts.combined_explanation(0, 0, 0)
+        self.assertTrue(agreeing.startswith(texts.explanations['combined']['high'][0]))
+        self.assertTrue(agreeing.endswith(TEXTS['en']['agree'].format(disease='Melanoma')))
+
+        disagreeing = texts.combined_explanation(2, 1, 0)
+        self.assertEqual(
+            disagreeing,
+            texts.explanations['combined']['low'][2]
+            + TEXTS['en']['disagree'].format(image_diagnosis='Eczema', symptom_diagnosis='Melanoma')
+        )
+
+
+class ResultSerializationTests(SimpleTestCase):
+    """Diagnosis.to_dict and the JSON renderers"""
+
+    FULL = {
+        'disease': 'Melanoma',
+        'confidence': 0.912,
+        'severity': 'high',
+        'description': 'Skin cancer',
+        'explanation': 'Dark, irregular lesion',
+        'alternative_diagnoses': [
+            {'disease': 'Nevus', 'confidence': 0.05, 'description': 'A benign mole'},
+            {'disease': 'Dermatofibroma', 'confidence': 0.038, 'description': 'A benign nodule'},
+        ],
+        'recommendations': ['See a dermatologist', 'Avoid sun exposure'],
+        'analysis_method': 'Combined',
+        'image_analysis': 'Melanoma',
+        'symptom_analysis': 'Nevus',
+        'ensemble_models': ['EfficientNet-B0', 'DenseNet121'],
+        'matched_symptoms': {'lesion_color': 'dark', 'note': 'café au lait', 'count': 2},
+        'image_path': 'uploads/ab/cd/abcd.png',
+        'heatmap_path': 'heatmaps/ab/cd/abcd_gradcam.png',
+        'attention_map_path': 'heatmaps/ab/cd/abcd_attention.png',
+        'heatmap_status': 'ready',
+        'heatmap_job': 'abcd',
+    }
+
+    COMPACT_DROPS = ('description', 'recommendations', 'analysis_method', 'matched_symptoms')
+
+    def diagnosis(self, **fields) -> Diagnosis:
+        return Diagnosis(**dict({
+            'disease': 'Melanoma',
+            'confidence': 0.912,
+            'severity': 'high',
+            'description': 'Skin cancer',
+            'explanation': 'Dark, irregular lesion',
+            'alternative_diagnoses': (
+                Alternative('Nevus', 0.05, 'A benign mole'),
+                Alternative('Dermatofibroma', 0.038, 'A benign nodule'),
+            ),
+            'recommendations': ('See a dermatologist', 'Avoid sun exposure'),
+            'analysis_method': 'Combined',
+            'image_analysis': 'Melanoma',
+            'symptom_analysis': 'Nevus',
+            'ensemble_models': ('EfficientNet-B0', 'DenseNet121'),
+            'matched_symptoms': {'lesion_color': 'dark', 'note': 'café au lait', 'count': 2},
+            'image_path': 'uploads/ab/cd/abcd.png',
+            'heatmap_path': 'heatmaps/ab/cd/abcd_gradcam.png',
+            'attention_map_path': 'heatmaps/ab/cd/abcd_attention.png',
+            'heatmap_status': 'ready',
+            'heatmap_job': 'abcd',
+        }, **fields))
+
+    def test_full_shape(self):
+        result = json.loads(json.dumps(self.diagnosis().to_dict()))
+        self.assertEqual(result, self.FULL)
+        self.assertEqual(list(result), list(self.FULL))
+
+    def test_compact_shape(self):
+        result = json.loads(json.dumps(self.diagnosis().to_dict(compact=True)))
+        expected = {key: value for key, value in self.FULL.items() if key not in self.COMPACT_DROPS}
+        expected['alternative_diagnoses'] = [
+            {'disease': 'Nevus', 'confidence': 0.05}, {'disease': 'Dermatofibroma', 'confidence': 0.038},
+        ]
+        self.assertEqual(result, expected)
+
+    def test_unset_fields_are_left_out(self):
+        result = self.diagnosis(
+            image_analysis=None, symptom_analysis=None, ensemble_models=None, matched_symptoms=None,
+            image_path=None, heatmap_path=None, attention_map_path=None, heatmap_status=None, heatmap_job=None,
+        ).to_dict()
+        self.assertEqual(list(result), [
+            'disease', 'confidence', 'severity', 'description', 'explanation',
+            'alternative_diagnoses', 'recommendations', 'analysis_method',
+        ])
+
+    def payload(self, **fields) -> Dict:
+        return {'success': True, 'count': 1, 'results': [{'index': 0, 'diagnosis': self.diagnosis(**fields)}]}
+
+    def test_renderer_output(self):
+        renderer = FastJSONRenderer()
+        factory = RequestFactory()
+        for query, compact in (('', False), ('?compact=1', True), ('?compact=no', False)):
+            with self.subTest(query=query):
+                request = factory.get('/api/analyze/batch' + query)
+                rendered = renderer.render(self.payload(), renderer_context={'request': request})
+                self.assertEqual(
+                    json.loads(rendered)['results'][0]['diagnosis'],
+                    json.loads(json.dumps(self.diagnosis().to_dict(compact)))
+                )
+                response = json_response(request, self.payload(), 201)
+                self.assertEqual((response.status_code, response['Content-Type']), (201, 'application/json'))
+                self.assertEqual(response.content, rendered)
+        self.assertEqual(renderer.render(None), b'')
+
+    def test_stdlib_fallback_without_orjson(self):
+        request = RequestFactory().get('/api/analyze/batch')
+        expected = FastJSONRenderer().render(self.payload(), renderer_context={'request': request})
+
+        with mock.patch.object(renderers, 'orjson', None):
+            rendered = FastJSONRenderer().render(self.payload(), renderer_context={'request': request})
+            response = json_response(request, self.payload(), 200)
+            with self.assertRaises(TypeError):
+                renderers.dumps({'value': object()})
+
+        self.assertEqual(json.loads(rendered), json.loads(expected))
+        self.assertEqual(response.content, rendered)
+        self.assertIn('café'.encode('utf-8'), rendered)
+        if renderers.orjson is not None:
+            self.assertEqual(rendered, expected)
+
+    def test_values_orjson_cannot_encode(self):
+        # Integers beyond 64 bits fall back to the standard library encoder
+        rendered = renderers.dumps(self.payload(matched_symptoms={'count': 2 ** 70}))
+        self.assertEqual(json.loads(rendered)['results'][0]['diagnosis']['matched_symptoms'], {'count': 2 ** 70})
+
+
+class SymptomMatcherTests(SimpleTestCase):
+    """Whole-word keyword matching over the disease vocabulary"""
+
+    DISEASES = MockMLService.DISEASES
+
+    def setUp(self):
+        super().setUp()
+        self.matcher = SymptomMatcher(self.DISEASES)
+
+    @staticmethod
+    def substring_scores(values) -> list:
+        # Scoring before the compiled matcher: keywords as substrings of the answers
+        text = ' '.join(str(v).lower() for v in values)
+        return [sum(1 for keyword in disease['keywords'] if keyword in text) for disease in MockMLService.DISEASES]
+
+    def test_keywords_inside_longer_words_do_not_match(self):
+        self.assertEqual(self.matcher.score(['bored', 'darkness', 'unstable', 'legacy']).tolist(), [0] * 6)
+        # The old substring scan matched all of them
+        self.assertEqual(self.substring_scores(['bored', 'darkness', 'unstable', 'legacy']), [1, 0, 1, 0, 1, 1])
+
+    def test_plurals_and_hyphens(self):
+        matcher = SymptomMatcher([{'keywords': ['blister'], 'synonyms': ['stuck-on']}, {'keywords': ['bumps']}])
+        self.assertEqual(matcher.score(['blisters']).tolist(), [1, 0])
+        self.assertEqual(matcher.score(['a blister']).tolist(), [1, 0])
+        self.assertEqual(matcher.score(['stuck on', 'bump']).tolist(), [1, 1])
+        self.assertEqual(matcher.score(['stuck', 'on']).tolist(), [1, 0])
+        self.assertEqual(matcher.score(['stuckon', 'blistering']).tolist(), [0, 0])
+
+    def test_distinct_keywords_are_counted_once(self):
+        scores = self.matcher.score(['brown', 'brown and Brown', 'scaly, rough'])
+        self.assertEqual(scores.tolist(), [0, 1, 1, 2, 2, 1])
+
+    def test_scores_equal_the_substring_baseline_on_whole_words(self):
+        keywords = sorted({keyword for disease in self.DISEASES for keyword in disease['keywords']})
+        questionnaires = [[keyword] for keyword in keywords]
+        questionnaires += [[first, second] for first in keywords for second in keywords]
+        questionnaires += [[' '.join(keywords)], [keyword.upper() for keyword in keywords], []]
+
+        for values in questionnaires:
+            with self.subTest(values=values):
+                self.assertEqual(self.matcher.score(values).tolist(), self.substring_scores(values))
+
+
+class BulkScoringTests(SimpleTestCase):
+    """Batched symptom scoring, top-k ranking and the rescore_symptoms command"""
+
+    QUESTIONNAIRES = [
+        {'lesion_color': 'dark brown', 'lesion_shape': 'irregular', 'size_change': 'growing'},
+        {'texture': 'scaly and rough', 'location': 'sun-exposed scalp'},
+        {'notes': 'nothing unusual'},
+        {'texture': 'waxy, stuck-on', 'color': 'brown'},
+        {'feel': 'firm nodule on the leg', 'surface': 'dimple when pinched'},
+        {},
+    ]
+
+    def setUp(self):
+        super().setUp()
+        self.service = MockMLService()
+        self.matcher = SymptomMatcher(MockMLService.DISEASES)
+
+    def test_batch_scores_equal_row_by_row_scores(self):
+        batch = self.matcher.score_batch(d.values() for d in self.QUESTIONNAIRES)
+        rows = np.stack([self.matcher.score(d.values()) for d in self.QUESTIONNAIRES])
+        self.assertEqual(batch.shape, (len(self.QUESTIONNAIRES), len(MockMLService.DISEASES)))
+        np.testing.assert_array_equal(batch, rows)
+        self.assertEqual(self.matcher.score_batch([]).shape, (0, len(MockMLService.DISEASES)))
+
+    def test_top_k_orders_by_score_then_index(self):
+        scores = np.array([
+            [1, 3, 0, 3, 2],
+            [0, 0, 0, 0, 0],
+            [5, 4, 3, 2, 1],
+            [1, 2, 3, 4, 5],
+        ])
+        np.testing.assert_array_equal(SymptomMatcher.top_k(scores, 3), [[1, 3, 4], [0, 1, 2], [0, 1, 2], [4, 3, 2]])
+        np.testing.assert_array_equal(SymptomMatcher.top_k(scores, 9)[0], [1, 3, 4, 0, 2])
+        np.testing.assert_array_equal(SymptomMatcher.top_k(scores, 1)[:, 0], [1, 0, 0, 4])
+
+    def test_top_k_matches_a_full_sort(self):
+        rng = np.random.default_rng(0)
+        scores = rng.integers(0, 4, (200, 6))
+        for k in range(1, 7):
+            with self.subTest(k=k):
+                top = SymptomMatcher.top_k(scores, k)
+                expected = np.stack([sorted(range(6), key=lambda i: (-row[i], i))[:k] for row in scores])
+                # Ties at the cut may keep any of the tied entries, with the same scores
+                np.testing.assert_array_equal(
+                    np.take_along_axis(scores, top, axis=1), np.take_along_axis(scores, expected, axis=1)
+                )
+                for row, indices in zip(scores, top):
+                    keys = [(-row[i], i) for i in indices]
+                    self.assertEqual(keys, sorted(keys))
+
+    def test_rank_symptoms(self):
+        indices, scores = self.service.rank_symptoms(self.QUESTIONNAIRES, 2)
+        full = self.matcher.score_batch(d.values() for d in self.QUESTIONNAIRES)
+        self.assertEqual(indices.shape, (len(self.QUESTIONNAIRES), 2))
+        np.testing.assert_array_equal(scores, np.take_along_axis(full, indices, axis=1))
+        np.testing.assert_array_equal(scores[:, 0], full.max(axis=1))
+
+    def rescore(self, lines, *args) -> list:
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        source, target = os.path.join(directory, 'in.jsonl'), os.path.join(directory, 'out.jsonl')
+        with open(source, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        call_command('rescore_symptoms', source, '--output', target, *args, stderr=io.StringIO())
+        with open(target) as handle:
+            return [json.loads(line) for line in handle]
+
+    def test_rescore_command(self):
+        lines = [json.dumps({'id': f'q{index}', 'symptoms': d}) for index, d in enumerate(self.QUESTIONNAIRES)]
+        lines.insert(2, json.dumps({'color': 'red'}))
+        results = self.rescore(lines, '--top-k', '2')
+
+        self.assertEqual([result['id'] for result in results], ['q0', 'q1', 3, 'q2', 'q3', 'q4', 'q5'])
+        self.assertEqual(results[0]['disease'], 'Melanoma')
+        # Three diseases tie for second place (any of them may be kept)
+        self.assertEqual([entry['score'] for entry in results[0]['top']], [3, 1])
+        self.assertEqual(results[2]['top'], [{'disease': 'Actinic Keratosis', 'score': 1}])
+        self.assertEqual(results[3], {'id': 'q2', 'disease': None, 'top': []})
+
+        # Chunking does not change the output
+        self.assertEqual(self.rescore(lines, '--top-k', '2', '--chunk-size', '2'), results)
+
+    def test_rescore_command_rejects_invalid_lines(self):
+        with self.assertRaisesMessage(CommandError, 'Line 2 is not valid JSON'):
+            self.rescore(['{}', '{'])
+        with self.assertRaisesMessage(CommandError, 'Line 1 is not a questionnaire object'):
+            self.rescore(['[1, 2]'])
+
+
+class DeterminismTests(MediaRootMixin, SimpleTestCase):
+    """The same input gives the same result, in any process and any order"""
+
+    SYMPTOMS = {'lesion_color': 'dark brown', 'lesion_shape': 'irregular', 'size_change': 'growing'}
+
+    def test_content_rng_streams(self):
+        image = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+        draw = lambda *parts, seed=0: content_rng(*parts, seed=seed).random(4).tolist()
+
+        self.assertEqual(draw('image', image), draw('image', image.copy()))
+        self.assertEqual(draw('image', image[:, ::2]), draw('image', np.ascontiguousarray(image[:, ::2])))
+        self.assertEqual(draw('image', image), draw(b'image', image.tobytes()))
+        self.assertNotEqual(draw('ab', 'c'), draw('a', 'bc'))
+        self.assertNotEqual(draw('image', image), draw('image', image, seed=1))
+        self.assertNotEqual(draw('image', image), draw('image', image + 1))
+
+    def test_service_results_depend_only_on_input(self):
+        image = preprocess_image(store_image('e' * 64, 300, 200))
+        other = preprocess_image(store_image('f' * 64, 120, 160))
+        first, second = MockMLService(), MockMLService()
+
+        self.assertEqual(
+            first.analyze_image('', image).to_dict(), second.analyze_image('', image.copy()).to_dict()
+        )
+        self.assertEqual(
+            first.analyze_symptoms(self.SYMPTOMS).to_dict(),
+            second.analyze_symptoms(dict(reversed(list(self.SYMPTOMS.items())))).to_dict()
+        )
+        self.assertEqual(
+            first.analyze_combined('', self.SYMPTOMS, image).to_dict(),
+            second.analyze_combined('', self.SYMPTOMS, image).to_dict()
+        )
+
+        # Batching and batch neighbours do not change a result
+        batch = second.analyze_batch(np.stack([other, image]), [None, self.SYMPTOMS])
+        self.assertEqual(batch[1].to_dict(), first.analyze_combined('', self.SYMPTOMS, image).to_dict())
+        self.assertEqual(batch[0].to_dict(), first.analyze_image('', other).to_dict())
+
+    def test_analyze_endpoints_repeat_their_responses(self):
+        # Repeats may be answered from the result cache ('cached': true)
+        responses = [
+            self.client.post('/api/analyze/symptoms', {'symptoms': self.SYMPTOMS}, content_type='application/json')
+            for _ in range(2)
+        ]
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[0].json()['diagnosis'], responses[1].json()['diagnosis'])
+
+        data = encode_image(96, 64, 'PNG')
+        responses = []
+        for _ in range(2):
+            upload = io.BytesIO(data)
+            upload.name = 'lesion.png'
+            responses.append(self.client.post('/api/analyze/image', {'image': upload}))
+        self.assertEqual(responses[0].status_code, 200)
+        # Only the background render may have progressed in between
+        diagnoses = [response.json()['diagnosis'] for response in responses]
+        for diagnosis in diagnoses:
+            self.assertIn(diagnosis.pop('heatmap_status'), ('pending', 'ready'))
+        self.assertEqual(diagnoses[0], diagnoses[1])
+
+
+def asgi_urlconf() -> types.ModuleType:
+    """Root URLConf with diagnosis.urls loaded as under ASGI (ASYNC_VIEWS on)"""
+    with override_settings(ASYNC_VIEWS=True):
+        spec = importlib.util.spec_from_file_location('diagnosis.asgi_urls', diagnosis_urls.__file__)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    root = types.ModuleType('asgi_root_urls')
+    root.urlpatterns = [path('api/', include(module))]
+    return root
+
+
+class AsyncViewParityTests(MediaRootMixin, SimpleTestCase):
+    """The native async views answer like the DRF views"""
+
+    SYMPTOMS = {'lesion_color': 'dark brown', 'lesion_shape': 'irregular', 'size_change': 'growing'}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.urlconf = asgi_urlconf()
+
+    def setUp(self):
+        super().setUp()
+        # Both views compute every result (no answers from the cache)
+        patcher = mock.patch.object(pipeline, 'result_cache', ResultCache())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def upload(self, data: bytes = None, name: str = 'lesion.png'):
+        upload = io.BytesIO(data if data is not None else encode_image(96, 64, 'PNG'))
+        upload.name = name
+        return upload
+
+    def compare(self, method: str, url: str, data=None, status_code: int = 200, **extra):
+        """Send the request to both views (data may be a factory for fresh uploads)"""
+        build = data if callable(data) else lambda: data
+
+        async def send_async():
+            return await getattr(self.async_client, method)(url, build(), **extra)
+
+        sync_response = getattr(self.client, method)(url, build(), **extra)
+        with override_settings(ROOT_URLCONF=self.urlconf):
+            async_response = async_to_sync(send_async)()
+
+        payloads = []
+        for response in (sync_response, async_response):
+            self.assertEqual(response.status_code, status_code)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            payloads.append(self.strip_render_status(response.json()))
+        self.assertEqual(payloads[0], payloads[1])
+        return payloads[0]
+
+    def strip_render_status(self, payload: Dict) -> Dict:
+        # Only the background render may have progressed in between
+        for item in [payload] + payload.get('results', []):
+            diagnosis = item.get('diagnosis')
+            if diagnosis is not None and 'heatmap_job' in diagnosis:
+                self.assertIn(diagnosis.pop('heatmap_status'), ('pending', 'ready'))
+        return payload
+
+    def test_urlconf_serves_the_async_views(self):
+        self.assertIs(resolve('/api/analyze/image', self.urlconf).func, async_views.analyze_image)
+        self.assertIs(resolve('/api/analyze/batch', self.urlconf).func, async_views.analyze_batch)
+        self.assertIs(resolve('/api/analyze/image').func, views.analyze_image)
+
+    def test_image(self):
+        self.assertIn('diagnosis', self.compare('post', '/api/analyze/image', lambda: {'image': self.upload()}))
+        self.compare('post', '/api/analyze/image', {}, 400)
+        payload = self.compare(
+            'post', '/api/analyze/image', lambda: {'image': self.upload(b'GIF89a' + b'\0' * 100)}, 400
+        )
+        self.assertEqual(payload, {'error': 'Invalid file type. Only JPEG and PNG are allowed.'})
+        self.compare('get', '/api/analyze/image', None, 405)
+
+    def test_symptoms_as_json_and_form_data(self):
+        json_payload = self.compare(
+            'post', '/api/analyze/symptoms', {'symptoms': self.SYMPTOMS}, content_type='application/json'
+        )
+        form_payload = self.compare('post', '/api/analyze/symptoms', {'symptoms': json.dumps(self.SYMPTOMS)})
+        self.assertEqual(json_payload, form_payload)
+
+    def test_symptom_errors(self):
+        for body, error in (
+            ('{"symptoms": ', None),
+            ('[1, 2]', {'error': 'No symptom data provided'}),
+            ('{}', {'error': 'No symptom data provided'}),
+            ('{"symptoms": ["dark"]}', {'error': 'Symptoms must be a JSON object'}),
+        ):
+            with self.subTest(body=body):
+                payload = self.compare('post', '/api/analyze/symptoms', body, 400, content_type='application/json')
+                if error is None:
+                    self.assertTrue(payload['detail'].startswith('JSON parse error - '))
+                else:
+                    self.assertEqual(payload, error)
+
+        payload = self.compare('post', '/api/analyze/symptoms', {'symptoms': '{not json'}, 400)
+        self.assertEqual(payload, {'error': 'Symptoms must be valid JSON'})
+
+    def test_combined(self):
+        self.compare('post', '/api/analyze/combined', lambda: {
+            'image': self.upload(), 'symptoms': json.dumps(self.SYMPTOMS),
+        })
+        for symptoms in (None, '{not json', '"dark"'):
+            with self.subTest(symptoms=symptoms):
+                data = lambda: dict({'image': self.upload()}, **({'symptoms': symptoms} if symptoms else {}))
+                self.compare('post', '/api/analyze/combined', data, 400)
+        self.compare(
+            'post', '/api/analyze/combined', {'symptoms': self.SYMPTOMS}, 400, content_type='application/json'
+        )
+
+    def test_batch(self):
+        images = lambda: [self.upload(), self.upload(encode_image(64, 96, 'JPEG'), 'lesion.jpg')]
+        payload = self.compare('post', '/api/analyze/batch', lambda: {
+            'images': images(), 'symptoms': json.dumps([None, self.SYMPTOMS]),
+        })
+        self.assertEqual(payload['count'], 2)
+        self.compare('post', '/api/analyze/batch', lambda: {'images': images(), 'symptoms': '[null]'}, 400)
+        self.compare('post', '/api/analyze/batch', {}, 400)
+
+
+class MicroBatcherTests(SimpleTestCase):
+    """Concurrent submit() calls sharing batches"""
+
+    def setUp(self):
+        self.batches = []
+
+    def run_batch(self, items):
+        self.batches.append(list(items))
+        return [item * 10 for item in items]
+
+    def submit_all(self, batcher, items, leader_first=True):
+        """Submit every item on its own thread; returns {item: result or exception}"""
+        outcomes = {}
+
+        def submit(item):
+            try:
+                outcomes[item] = batcher.submit(item)
+            except BaseException as e:
+                outcomes[item] = e
+
+        threads = [threading.Thread(target=submit, args=(item,)) for item in items]
+        for number, thread in enumerate(threads):
+            thread.start()
+            if number == 0 and leader_first:
+                # Later items join the batch the first one opened
+                while batcher._open is None and thread.is_alive():
+                    time.sleep(0.001)
+        for thread in threads:
+            thread.join(10)
+        return outcomes
+
+    def test_results_go_back_to_their_callers(self):
+        batcher = MicroBatcher(self.run_batch, max_batch_size=4, max_wait_ms=50)
+        outcomes = self.submit_all(batcher, range(1, 17), leader_first=False)
+
+        self.assertEqual(outcomes, {item: item * 10 for item in range(1, 17)})
+        self.assertEqual(sorted(item for batch in self.batches for item in batch), list(range(1, 17)))
+        self.assertTrue(all(len(batch) <= 4 for batch in self.batches))
+
+    def test_full_batch_runs_without_waiting(self):
+        batcher = MicroBatcher(self.run_batch, max_batch_size=3, max_wait_ms=10000)
+        start = time.perf_counter()
+        outcomes = self.submit_all(batcher, [1, 2, 3])
+
+        self.assertLess(time.perf_counter() - start, 5)
+        self.assertEqual(outcomes, {1: 10, 2: 20, 3: 30})
+        self.assertEqual(self.batches, [[1, 2, 3]])
+
+    def test_partial_batch_runs_after_the_wait(self):
+        batcher = MicroBatcher(self.run_batch, max_batch_size=16, max_wait_ms=200)
+        start = time.perf_counter()
+        outcomes = self.submit_all(batcher, [1, 2])
+
+        self.assertGreaterEqual(time.perf_counter() - start, 0.2)
+        self.assertEqual(outcomes, {1: 10, 2: 20})
+        self.assertEqual(self.batches, [[1, 2]])
+
+    def test_batch_error_reaches_every_caller(self):
+        def fail(items):
+            self.batches.append(list(items))
+            raise ValueError(f'bad batch {items}')
+
+        batcher = MicroBatcher(fail, max_batch_size=3, max_wait_ms=10000)
+        with self.assertLogs('diagnosis.batching', 'WARNING'):
+            outcomes = self.submit_all(batcher, [1, 2, 3])
+
+        # The batch is retried item by item, so each caller gets its own error
+        self.assertEqual({item: str(error) for item, error in outcomes.items()},
+                         {item: f'bad batch [{item}]' for item in (1, 2, 3)})
+        self.assertEqual(self.batches, [[1, 2, 3], [1], [2], [3]])
+
+    def test_leader_interrupted_releases_every_waiter(self):
+        class Interrupted(BaseException):
+            pass
+
+        def interrupt(items):
+            raise Interrupted()
+
+        batcher = MicroBatcher(interrupt, max_batch_size=3, max_wait_ms=10000)
+        outcomes = self.submit_all(batcher, [1, 2, 3])
+
+        self.assertIsInstance(outcomes[1], Interrupted)
+        for item in (2, 3):
+            self.assertIsInstance(outcomes[item], RuntimeError)
+            self.assertEqual(str(outcomes[item]), 'Batch was not processed')
+
+
+class StorageSweeperTests(MediaRootMixin, SimpleTestCase):
+    """What a sweep of the media store deletes and what it keeps"""
+
+    HOUR = 3600
+    DAY = 86400
+
+    def setUp(self):
+        super().setUp()
+        self.now = time.time()
+
+    def sweeper(self, **config):
+        return StorageSweeper(dict({'SHARD_DEPTH': 2, 'RETENTION_DAYS': 0, 'MAX_BYTES': 0, 'SWEEP_INTERVAL': 0}, **config))
+
+    def put(self, relative: str, age: float, size: int = 100) -> str:
+        path = os.path.join(self.media_root, relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as handle:
+            handle.write(b'\0' * size)
+        os.utime(path, (self.now - age, self.now - age))
+        return path
+
+    def put_object(self, digest: str, age: float, size: int = 100, heatmap: bool = True) -> list:
+        """Stored upload plus its overlay preview and tiles"""
+        shard = f'{digest[:2]}/{digest[2:4]}'
+        paths = [self.put(f'uploads/{shard}/{digest}.png', age, size)]
+        if heatmap:
+            paths.append(self.put(f'heatmaps/{shard}/{digest}_heatmap.png', age, size))
+            paths.append(self.put(f'heatmaps/{shard}/{digest}_heatmap_files/0/0_0.jpg', age, size))
+            tiles = os.path.join(self.media_root, f'heatmaps/{shard}/{digest}_heatmap_files')
+            os.utime(tiles, (self.now - age, self.now - age))
+        return paths
+
+    def assertKept(self, paths):
+        for path in paths:
+            self.assertTrue(os.path.exists(path), path)
+
+    def assertRemoved(self, paths):
+        for path in paths:
+            self.assertFalse(os.path.exists(path), path)
+
+    def test_orphans_are_removed_after_min_age(self):
+        young = self.put(f'heatmaps/aa/aa/{"a" * 64}_heatmap.png', MIN_AGE / 2)
+        old = self.put(f'heatmaps/bb/bb/{"b" * 64}_heatmap.png', MIN_AGE * 2)
+        stats = self.sweeper().sweep(self.now)
+
+        self.assertKept([young])
+        self.assertRemoved([old, os.path.join(self.media_root, 'heatmaps', 'bb')])
+        self.assertEqual((stats['orphaned'], stats['objects']), (1, 1))
+
+    def test_retention_removes_whole_objects(self):
+        expired = self.put_object('c' * 64, 2 * self.DAY)
+        recent = self.put_object('d' * 64, 12 * self.HOUR)
+        stats = self.sweeper(RETENTION_DAYS=1).sweep(self.now)
+
+        self.assertRemoved(expired)
+        self.assertKept(recent)
+        self.assertEqual(stats['expired'], 1)
+
+    def test_objects_are_kept_without_limits(self):
+        stored = self.put_object('c' * 64, 300 * self.DAY)
+        stats = self.sweeper().sweep(self.now)
+
+        self.assertKept(stored)
+        self.assertEqual((stats['objects'], stats['bytes']), (1, 300))
+
+    def test_quota_evicts_least_recently_used_objects(self):
+        # 4 objects of 400 bytes against a quota of 1000 (evicts down to 900)
+        oldest = self.put_object('1' * 64, 4 * self.HOUR, size=400, heatmap=False)
+        older = self.put_object('2' * 64, 3 * self.HOUR, size=400, heatmap=False)
+        old = self.put_object('3' * 64, 2 * self.HOUR, size=400, heatmap=False)
+        young = self.put_object('4' * 64, MIN_AGE / 2, size=400, heatmap=False)
+        stats = self.sweeper(MAX_BYTES=1000).sweep(self.now)
+
+        self.assertRemoved(oldest + older)
+        self.assertKept(old + young)
+        self.assertEqual((stats['evicted'], stats['bytes']), (2, 800))
+
+    def test_quota_never_evicts_young_objects(self):
+        young = self.put_object('5' * 64, MIN_AGE / 2, size=400, heatmap=False)
+        with self.assertLogs('diagnosis.storage', 'WARNING'):
+            stats = self.sweeper(MAX_BYTES=100).sweep(self.now)
+
+        self.assertKept(young)
+        self.assertEqual(stats['evicted'], 0)
+
+    def test_stale_partial_uploads_are_removed(self):
+        stale = self.put('uploads/upload-1.part', MIN_AGE * 2)
+        writing = self.put('uploads/upload-2.part', 10)
+        temporary = self.put('heatmaps/ee/ee/tmp1234.tmp', MIN_AGE * 2)
+        stats = self.sweeper().sweep(self.now)
+
+        self.assertRemoved([stale])
+        self.assertKept([writing, temporary])
+        self.assertEqual(stats['stale_parts'], 1)
+
+    def test_skipped_while_another_sweep_holds_the_lock(self):
+        orphan = self.put(f'heatmaps/ff/ff/{"f" * 64}_heatmap.png', MIN_AGE * 2)
+        with open(os.path.join(self.media_root, '.storage-sweep.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.assertIsNone(self.sweeper().sweep(self.now))
+        self.assertKept([orphan])
+
+    def test_migrate_flat_moves_legacy_files_into_shards(self):
+        digest = 'ab12' + '0' * 60
+        flat = [
+            self.put(f'uploads/{digest}.png', 0),
+            self.put(f'heatmaps/{digest}_heatmap.png', 0),
+            self.put(f'heatmaps/{digest}_heatmap_files/0/0_0.jpg', 0),
+        ]
+        partial = self.put('uploads/upload-3.part', 0)
+        hidden = self.put('uploads/.keep', 0)
+        # Already sharded copy wins over the flat one
+        duplicate = 'cd34' + '0' * 60
+        sharded = self.put(f'uploads/cd/34/{duplicate}.png', 0, size=7)
+        flat_duplicate = self.put(f'uploads/{duplicate}.png', 0, size=3)
+
+        self.assertEqual(self.sweeper().migrate_flat(), 4)
+
+        self.assertRemoved(flat + [flat_duplicate])
+        self.assertKept([
+            partial, hidden,
+            os.path.join(self.media_root, f'uploads/ab/12/{digest}.png'),
+            os.path.join(self.media_root, f'heatmaps/ab/12/{digest}_heatmap.png'),
+            os.path.join(self.media_root, f'heatmaps/ab/12/{digest}_heatmap_files/0/0_0.jpg'),
+        ])
+        self.assertEqual(os.path.getsize(sharded), 7)
+
+
+try:
+    import onnx
+    import onnxruntime
+except ImportError:
+    onnx = onnxruntime = None
+
+
+class BackendTests(SimpleTestCase):
+    """Ensemble members behind ModelRegistry"""
+
+    NUM_CLASSES = 6
+
+    def setUp(self):
+        self.model_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.model_path, ignore_errors=True)
+
+    def config(self, **options):
+        return dict({
+            'NAME': 'mock', 'QUANTIZED': False, 'GRAPH_OPTIMIZATION': 'all',
+            'INTRA_OP_THREADS': 1, 'INTER_OP_THREADS': 1,
+            'INPUT_NORMALIZATION': 'none', 'OUTPUTS': 'logits',
+        }, **options)
+
+    def test_get_backend(self):
+        self.assertIs(get_backend('mock'), MockMember)
+        self.assertIs(get_backend('diagnosis.backends.OnnxMember'), OnnxMember)
+        with self.assertRaises(ImproperlyConfigured):
+            get_backend('no.such.Backend')
+
+    def test_mock_members_are_deterministic_probabilities(self):
+        batch = np.random.default_rng(0).random((3, 224, 224, 3), dtype=np.float32)
+        first = MockMember.load('ResNet50', 'resnet50', 4.1, self.model_path, self.NUM_CLASSES)
+        second = MockMember.load('ResNet50', 'resnet50', 4.1, self.model_path, self.NUM_CLASSES)
+
+        probabilities = first.predict(batch)
+        self.assertEqual((probabilities.shape, probabilities.dtype), ((3, self.NUM_CLASSES), np.float32))
+        np.testing.assert_allclose(probabilities.sum(axis=1), 1, rtol=1e-5)
+        np.testing.assert_array_equal(probabilities, second.predict(batch))
+        # Batch neighbours change at most the float rounding
+        np.testing.assert_allclose(probabilities[1:2], first.predict(batch[1:2]), atol=1e-6)
+
+    def test_mock_weights_file_is_checked(self):
+        np.save(os.path.join(self.model_path, 'resnet50.npy'), np.zeros((10, self.NUM_CLASSES), np.float32))
+        with self.assertRaises(ValueError):
+            MockMember.load('ResNet50', 'resnet50', 4.1, self.model_path, self.NUM_CLASSES)
+
+    def test_cascade_matches_full_ensemble_when_it_cannot_stop(self):
+        registry = ModelRegistry(self.model_path, self.NUM_CLASSES, backend=self.config())
+        batch = np.random.default_rng(1).random((4, 224, 224, 3), dtype=np.float32)
+
+        probabilities, models_run = registry.predict_cascade(batch, threshold=1.1, margin=1.0)
+        np.testing.assert_allclose(probabilities, registry.predict(batch), atol=1e-6)
+        self.assertEqual(models_run.tolist(), [3] * 4)
+
+        _, models_run = registry.predict_cascade(batch, threshold=0.0, margin=0.0)
+        self.assertEqual(models_run.tolist(), [1] * 4)
+
+    @skipUnless(onnxruntime is not None and onnx is not None, 'requires onnx and onnxruntime')
+    def test_onnx_member_runs_exported_graph(self):
+        from onnx import TensorProto, helper, numpy_helper
+
+        # Global average pool over NCHW input, then a linear layer to logits
+        weights = np.random.default_rng(2).normal(size=(3, self.NUM_CLASSES)).astype(np.float32)
+        graph = helper.make_graph(
+            [
+                helper.make_node('GlobalAveragePool', ['input'], ['pooled']),
+                helper.make_node('Flatten', ['pooled'], ['features']),
+                helper.make_node('MatMul', ['features', 'weights'], ['logits']),
+            ],
+            'mock_cnn',
+            [helper.make_tensor_value_info('input', TensorProto.FLOAT, ['N', 3, 224, 224])],
+            [helper.make_tensor_value_info('logits', TensorProto.FLOAT, ['N', self.NUM_CLASSES])],
+            [numpy_helper.from_array(weights, 'weights')],
+        )
+        model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+        model.ir_version = 8
+        onnx.save(model, os.path.join(self.model_path, 'resnet50.onnx'))
+
+        member = OnnxMember.load('ResNet50', 'resnet50', 4.1, self.model_path, self.NUM_CLASSES,
+                                 config=self.config(NAME='onnxruntime'))
+        batch = np.random.default_rng(3).random((2, 224, 224, 3), dtype=np.float32)
+        logits = batch.mean(axis=(1, 2)) @ weights
+        expected = np.exp(logits - logits.max(axis=1, keepdims=True))
+        expected /= expected.sum(axis=1, keepdims=True)
+
+        self.assertTrue(member.channels_first)
+        np.testing.assert_allclose(member.predict(batch), expected, rtol=1e-4)
+
+        with self.assertRaises(FileNotFoundError):
+            OnnxMember.load('DenseNet121', 'densenet121', 2.9, self.model_path, self.NUM_CLASSES,
+                            config=self.config(NAME='onnxruntime'))
+
+
+class ProfileMember(EnsembleMember):
+    """Member returning a fixed probability row per image, picked by its first pixel"""
+
+    def __init__(self, name: str, key: str, cost: float, profiles: np.ndarray):
+        super().__init__(name, key, cost)
+        self.profiles = profiles
+        self.batch_sizes = []
+
+    def predict(self, image_batch: np.ndarray) -> np.ndarray:
+        self.batch_sizes.append(len(image_batch))
+        return self.profiles[image_batch[:, 0, 0, 0].astype(int)]
+
+
+class SevereCascadeTests(SimpleTestCase):
+    """Severe classes always go through the whole ensemble"""
+
+    MELANOMA = 0
+    CASCADE = {'ENABLED': True, 'THRESHOLD': 0.9, 'MARGIN': 0.5, 'SEVERE_MIN_PROBABILITY': 0.05}
+    NAMES = tuple(name for name, _, _ in ModelRegistry.MEMBERS)
+
+    # Every profile would stop after the first member without the severe rules
+    PROFILES = np.array([
+        [0.96, 0.01, 0.01, 0.01, 0.005, 0.005],  # Melanoma on top
+        [0.02, 0.01, 0.93, 0.02, 0.01, 0.01],    # Nevus on top, Melanoma below the cut-off
+        [0.06, 0.005, 0.92, 0.005, 0.005, 0.005],  # Nevus on top, Melanoma at the cut-off
+    ], dtype=np.float32)
+
+    def setUp(self):
+        super().setUp()
+        self.registry = ModelRegistry(tempfile.gettempdir(), len(MockMLService.DISEASES))
+        self.registry._members = [
+            ProfileMember(name, key, cost, self.PROFILES) for name, key, cost in ModelRegistry.MEMBERS
+        ]
+        self.registry._pid = os.getpid()
+
+    def images(self, *profiles) -> np.ndarray:
+        batch = np.zeros((len(profiles), 224, 224, 3), dtype=np.float32)
+        batch[:, 0, 0, 0] = profiles
+        return batch
+
+    def test_severe_classes(self):
+        self.assertEqual(MockMLService.SEVERE_CLASSES, (self.MELANOMA,))
+
+    def test_severe_images_run_every_member(self):
+        probabilities, models_run = self.registry.predict_cascade(
+            self.images(0, 1, 2), threshold=0.9, margin=0.5,
+            severe_classes=MockMLService.SEVERE_CLASSES, severe_min_probability=0.05
+        )
+        self.assertEqual(models_run.tolist(), [3, 1, 3])
+        self.assertEqual([member.batch_sizes for member in self.registry.members], [[3], [2], [2]])
+        np.testing.assert_allclose(probabilities, self.PROFILES, atol=1e-6)
+
+        # Without severe classes every image stops after the first member
+        _, models_run = self.registry.predict_cascade(self.images(0, 1, 2), threshold=0.9, margin=0.5)
+        self.assertEqual(models_run.tolist(), [1, 1, 1])
+
+    def test_reported_ensemble_models(self):
+        service = MockMLService(registry=self.registry, cascade=self.CASCADE)
+        severe, mild, borderline = service.analyze_image_batch(self.images(0, 1, 2))
+
+        self.assertEqual((severe.disease, severe.ensemble_models), ('Melanoma', self.NAMES))
+        self.assertEqual((mild.disease, mild.ensemble_models), ('Nevus', self.NAMES[:1]))
+        self.assertEqual((borderline.disease, borderline.ensemble_models), ('Nevus', self.NAMES))
+
+        combined = service.analyze_combined('', {'lesion_color': 'dark'}, self.images(0)[0])
+        self.assertEqual(combined.ensemble_models, self.NAMES)
+
+        # Without the cascade every image reports the whole ensemble
+        full = MockMLService(registry=self.registry).analyze_image_batch(self.images(0, 1, 2))
+        self.assertEqual([result.ensemble_models for result in full], [self.NAMES] * 3)
+        self.assertIsNone(MockMLService().analyze_symptoms({'lesion_color': 'dark'}).ensemble_models)
+
+
+class InferencePoolTests(SimpleTestCase):
+    """The pool command serving a client over its socket"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.directory = tempfile.mkdtemp()
+        cls.socket = os.path.join(cls.directory, 'inference.sock')
+        cls.pool = subprocess.Popen(
+            [sys.executable, 'manage.py', 'inference_pool', '--workers', '1', '--socket', cls.socket],
+            cwd=settings.BASE_DIR, env=dict(os.environ, INFERENCE_POOL_AUTHKEY='pool-secret', METRICS_DIR=''),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.terminate()
+        cls.pool.wait(10)
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        super().tearDownClass()
+
+    def pool_client(self, authkey=b'pool-secret'):
+        client = InferencePoolClient(self.socket, authkey, timeout=30)
+        self.addCleanup(client.close)
+        return client
+
+    def test_predicts_like_the_registry(self):
+        batch = np.random.default_rng(4).random((2, 224, 224, 3), dtype=np.float32)
+        client = self.pool_client()
+        self.assertEqual(client.status()['backend'], 'mock')
+        registry = ModelRegistry(settings.MODEL_PATH, len(MockMLService.DISEASES))
+        np.testing.assert_allclose(client.predict(batch), registry.predict(batch), atol=1e-6)
+
+    def test_socket_is_owner_only(self):
+        self.pool_client().status()
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket).st_mode), 0o600)
+
+    def test_wrong_authkey_is_rejected(self):
+        self.pool_client().status()
+        with self.assertRaises(AuthenticationError):
+            self.pool_client(b'guess').status()
+        self.assertTrue(self.pool_client().status()['members'])
+
+
+class ResultCacheTests(SimpleTestCase):
+    """Equivalent questionnaires sharing one cached result"""
+
+    FIRST = {'Lesion_Color': ' Dark Brown ', 'bleeding': 'YES'}
+    SECOND = {'bleeding': 'yes', 'Lesion_Color': 'dark brown'}
+
+    def test_hit_echoes_the_current_symptoms(self):
+        cache = ResultCache(LocalMemoryBackend())
+        key = cache.make_key('symptoms', symptoms_data=self.FIRST)
+        self.assertEqual(key, cache.make_key('symptoms', symptoms_data=self.SECOND))
+
+        first = MockMLService().analyze_symptoms(self.FIRST)
+        self.assertEqual(first.matched_symptoms, self.FIRST)
+        cache.set(key, first)
+
+        hit = cache.get(key, self.SECOND)
+        self.assertEqual(hit.matched_symptoms, self.SECOND)
+        self.assertEqual(hit.disease, first.disease)
+        self.assertIsNone(cache.get(key).matched_symptoms)
+        self.assertEqual(first.matched_symptoms, self.FIRST)
+
+    def test_symptoms_endpoint_echoes_each_spelling(self):
+        for symptoms in (self.FIRST, self.SECOND):
+            response = self.client.post(
+                '/api/analyze/symptoms', {'symptoms': symptoms}, content_type='application/json'
+            )
+            self.assertEqual(response.json()['diagnosis']['matched_symptoms'], symptoms)
+
+
+class MetricsExpositionTests(SimpleTestCase):
+    """Prometheus text exposition of the in-process registry"""
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    @override_settings(METRICS_DIR='')
+    def test_counters_and_gauges(self):
+        requests = Counter(
+            'test_requests_total', 'Requests by endpoint', ('endpoint', 'status'), registry=self.registry
+        )
+        active = Gauge('test_active', 'Active requests', registry=self.registry)
+        requests.inc(endpoint='image', status=200)
+        requests.inc(2, endpoint='image', status=200)
+        requests.inc(endpoint='batch', status=400)
+        requests.inc(0.5, endpoint='path "a\\b"\nc', status=500)
+        active.inc(3)
+        active.dec(1.25)
+
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP test_active Active requests',
+            '# TYPE test_active gauge',
+            'test_active 1.75',
+            '# HELP test_requests_total Requests by endpoint',
+            '# TYPE test_requests_total counter',
+            'test_requests_total{endpoint="batch",status="400"} 1',
+            'test_requests_total{endpoint="image",status="200"} 3',
+            'test_requests_total{endpoint="path \\"a\\\\b\\"\\nc",status="500"} 0.5',
+        ]) + '\n')
+
+    @override_settings(METRICS_DIR='')
+    def test_histogram_buckets(self):
+        latency = Histogram(
+            'test_latency_seconds', 'Latency', ('stage',), buckets=(1.0, 0.1, 2.5), registry=self.registry
+        )
+        for value in (0.05, 0.1, 0.7, 1.0, 2.0, 30.0):
+            latency.observe(value, stage='decode')
+        latency.observe(0.2, stage='infer')
+
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP test_latency_seconds Latency',
+            '# TYPE test_latency_seconds histogram',
+            'test_latency_seconds_bucket{stage="decode",le="0.1"} 2',
+            'test_latency_seconds_bucket{stage="decode",le="1"} 4',
+            'test_latency_seconds_bucket{stage="decode",le="2.5"} 5',
+            'test_latency_seconds_bucket{stage="decode",le="+Inf"} 6',
+            'test_latency_seconds_sum{stage="decode"} 33.85',
+            'test_latency_seconds_count{stage="decode"} 6',
+            'test_latency_seconds_bucket{stage="infer",le="0.1"} 0',
+            'test_latency_seconds_bucket{stage="infer",le="1"} 1',
+            'test_latency_seconds_bucket{stage="infer",le="2.5"} 1',
+            'test_latency_seconds_bucket{stage="infer",le="+Inf"} 1',
+            'test_latency_seconds_sum{stage="infer"} 0.2',
+            'test_latency_seconds_count{stage="infer"} 1',
+        ]) + '\n')
+
+    @override_settings(METRICS_DIR='')
+    def test_unlabelled_histogram_and_empty_families(self):
+        latency = Histogram('test_latency_seconds', 'Latency', buckets=(0.5,), registry=self.registry)
+        Counter('test_unused_total', 'Never incremented', ('endpoint',), registry=self.registry)
+        latency.observe(0.25)
+
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP test_latency_seconds Latency',
+            '# TYPE test_latency_seconds histogram',
+            'test_latency_seconds_bucket{le="0.5"} 1',
+            'test_latency_seconds_bucket{le="+Inf"} 1',
+            'test_latency_seconds_sum 0.25',
+            'test_latency_seconds_count 1',
+            '# HELP test_unused_total Never incremented',
+            '# TYPE test_unused_total counter',
+        ]) + '\n')
+
+    def test_merged_histograms_render_summed_buckets(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        latency = Histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1.0), registry=self.registry)
+        latency.observe(0.05)
+
+        # Another live process (this one, under a second snapshot name)
+        other = MetricsRegistry()
+        Histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1.0), registry=other).observe(0.5)
+        with open(os.path.join(directory, f'{os.getpid()}.json'), 'w') as handle:
+            json.dump(other.collect(), handle)
+
+        with override_settings(METRICS_DIR=directory):
+            rendered = self.registry.render()
+        self.assertIn('test_latency_seconds_bucket{le="0.1"} 1\n', rendered)
+        self.assertIn('test_latency_seconds_bucket{le="1"} 2\n', rendered)
+        self.assertIn('test_latency_seconds_bucket{le="+Inf"} 2\n', rendered)
+        self.assertIn('test_latency_seconds_sum 0.55\n', rendered)
+        self.assertIn('test_latency_seconds_count 2\n', rendered)
+
+    def test_label_and_name_checks(self):
+        requests = Counter('test_requests_total', 'Requests', ('endpoint',), registry=self.registry)
+        with self.assertRaises(ValueError):
+            requests.inc(status=200)
+        with self.assertRaises(ValueError):
+            requests.inc(endpoint='image', status=200)
+        with self.assertRaises(ValueError):
+            Gauge('test_requests_total', 'Duplicate', registry=self.registry)
+
+
+class MetricsSnapshotTests(SimpleTestCase):
+    """Merging the per-process snapshots in METRICS_DIR"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        override = override_settings(METRICS_DIR=self.directory)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.registry = MetricsRegistry()
+        self.requests = Counter('test_requests_total', 'Requests', ('endpoint',), registry=self.registry)
+        self.active = Gauge('test_active', 'Active requests', registry=self.registry)
+        self.latency = Histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1.0), registry=self.registry)
+
+        exited = subprocess.run([sys.executable, '-c', 'import os; print(os.getpid())'],
+                                capture_output=True, text=True, check=True)
+        self.exited_pid = int(exited.stdout)
+
+    def write(self, filename: str, requests: int, active: int = 0):
+        """Snapshot of another process with these values"""
+        registry = MetricsRegistry()
+        Counter('test_requests_total', 'Requests', ('endpoint',), registry=registry).inc(requests, endpoint='image')
+        Gauge('test_active', 'Active requests', registry=registry).set(active)
+        Histogram('test_latency_seconds', 'Latency', buckets=(0.1, 1.0), registry=registry).observe(0.5)
+        with open(os.path.join(self.directory, filename), 'w') as handle:
+            json.dump(registry.collect(), handle)
+
+    def totals(self) -> Dict:
+        families = merge_snapshots(self.directory)
+        samples = lambda name: families.get(name, {}).get('samples', [])
+        return {
+            'requests': sum(value for _, value in samples('test_requests_total')),
+            'active': sum(value for _, value in samples('test_active')),
+            'observations': sum(sum(value[0]) for _, value in samples('test_latency_seconds')),
+        }
+
+    def test_exited_workers_are_folded_into_the_aggregate(self):
+        self.requests.inc(2, endpoint='image')
+        self.active.set(1)
+        self.registry.write_snapshot()
+        self.write(f'{self.exited_pid}-12345.json', requests=5, active=3)
+
+        expected = {'requests': 7, 'active': 1, 'observations': 1}
+        self.assertEqual(self.totals(), expected)
+        self.assertFalse(os.path.exists(os.path.join(self.directory, f'{self.exited_pid}-12345.json')))
+        self.assertTrue(os.path.exists(os.path.join(self.directory, AGGREGATE_FILE)))
+
+        # Folded once: the next merges report the same totals
+        self.assertEqual(self.totals(), expected)
+        self.assertEqual(self.totals(), expected)
+
+    def test_reused_pid_does_not_replace_the_exited_worker(self):
+        # An earlier process that had this process's pid
+        self.write(f'{os.getpid()}-1.json', requests=5)
+        self.requests.inc(1, endpoint='image')
+        self.registry.write_snapshot()
+
+        self.assertEqual(self.totals()['requests'], 6)
+        self.requests.inc(1, endpoint='image')
+        self.registry.write_snapshot()
+        self.assertEqual(self.totals()['requests'], 7)
+
+    def test_interrupted_fold_is_not_counted_twice(self):
+        self.write(f'{self.exited_pid}-12345.json', requests=5)
+        self.assertEqual(self.totals()['requests'], 5)
+
+        # The snapshot survived (e.g. a crash before removing it)
+        with open(os.path.join(self.directory, AGGREGATE_FILE)) as handle:
+            self.assertEqual(json.load(handle)['folded'], [f'{self.exited_pid}-12345.json'])
+        self.write(f'{self.exited_pid}-12345.json', requests=5)
+        self.assertEqual(self.totals()['requests'], 5)
+
+
+class ProfilingTests(SimpleTestCase):
+    """Request selection, kept traces and the trace directory caps"""
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def configure(self, **overrides):
+        config = {
+            'ENABLED': True,
+            'HEADER': 'X-Profile',
+            'TOKEN': 'secret',
+            'SAMPLE_RATE': 0,
+            'SLOW_THRESHOLD_MS': 60000,
+            'TRACE_ALLOCATIONS': False,
+            'DIR': self.directory,
+            'MAX_FILES': 50,
+            'MAX_BYTES': 100 * 1024 * 1024,
+        }
+        config.update(overrides)
+        override = override_settings(PROFILING=config)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def get(self, **headers):
+        return self.client.get('/api/health', headers=headers)
+
+    def traces(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.prof'))
+
+    def test_header_requires_the_token(self):
+        self.configure()
+        self.assertNotIn('X-Profile-Id', self.get(**{'X-Profile': 'wrong'}))
+        self.assertNotIn('X-Profile-Id', self.get(**{'X-Profile': 'ŝecret'}))
+        self.assertEqual(self.traces(), [])
+
+        response = self.get(**{'X-Profile': 'secret'})
+        self.assertEqual(self.traces(), [response['X-Profile-Id'] + '.prof'])
+
+    def test_header_is_ignored_without_a_token(self):
+        self.configure(TOKEN='')
+        self.assertNotIn('X-Profile-Id', self.get(**{'X-Profile': '1'}))
+        self.assertEqual(self.traces(), [])
+
+    def test_sampled_traces_are_kept_only_when_slow(self):
+        self.configure(SAMPLE_RATE=0.5)
+        with mock.patch('diagnosis.middleware.random.random', return_value=0.9):
+            self.assertNotIn('X-Profile-Id', self.get())
+        with mock.patch('diagnosis.middleware.random.random', return_value=0.1):
+            self.assertNotIn('X-Profile-Id', self.get())
+        self.assertEqual(self.traces(), [])
+
+        self.configure(SAMPLE_RATE=0.5, SLOW_THRESHOLD_MS=0)
+        with mock.patch('diagnosis.middleware.random.random', return_value=0.1), \
+                self.assertLogs('diagnosis.middleware', 'WARNING'):
+            response = self.get()
+        self.assertEqual(self.traces(), [response['X-Profile-Id'] + '.prof'])
+        with open(os.path.join(self.directory, response['X-Profile-Id'] + '.txt')) as handle:
+            self.assertIn('(sampled, slow)', handle.readline())
+
+    def test_allocations_are_traced_only_when_enabled(self):
+        self.configure()
+        response = self.get(**{'X-Profile': 'secret'})
+        with open(os.path.join(self.directory, response['X-Profile-Id'] + '.txt')) as handle:
+            self.assertNotIn('Top allocations', handle.read())
+
+        self.configure(TRACE_ALLOCATIONS=True)
+        response = self.get(**{'X-Profile': 'secret'})
+        with open(os.path.join(self.directory, response['X-Profile-Id'] + '.txt')) as handle:
+            self.assertIn('Top allocations', handle.read())
+
+    def write_traces(self, count: int, size: int):
+        for index in range(count):
+            for extension in ('.prof', '.txt'):
+                path = os.path.join(self.directory, f'trace-{index}{extension}')
+                with open(path, 'wb') as handle:
+                    handle.write(b'\0' * size)
+                os.utime(path, (1000 + index, 1000 + index))
+
+    def test_trace_count_limit_removes_the_oldest(self):
+        self.write_traces(5, 10)
+        enforce_limits(self.directory, 3, 10 ** 6)
+        self.assertEqual(sorted(os.listdir(self.directory)), [
+            f'trace-{index}{extension}' for index in (2, 3, 4) for extension in ('.prof', '.txt')
+        ])
+
+    def test_trace_size_limit_removes_the_oldest(self):
+        # 100 bytes per trace
+        self.write_traces(5, 50)
+        enforce_limits(self.directory, 50, 250)
+        self.assertEqual(self.traces(), ['trace-3.prof', 'trace-4.prof'])
+
+    def test_kept_traces_respect_the_limits(self):
+        self.configure(MAX_FILES=2)
+        names = [self.get(**{'X-Profile': 'secret'})['X-Profile-Id'] for _ in range(4)]
+        self.assertEqual(len(self.traces()), 2)
+        self.assertIn(names[-1] + '.prof', self.traces())
@@ -0,0 +1,164 @@
+"""
+Clinical explanation and recommendation texts
+
+TEXTS holds the source strings per locale. compile_texts() expands them
+once into every explanation and recommendation list the service can
+return (per method, severity and confidence band), so building a response
+mostly indexes into immutable tuples. Combined explanations are stored
+per band and image disease, with the agreement sentence already attached;
+only a disagreement between image and symptoms formats its sentence per
+request, which keeps a locale linear in the number of diseases. Adding a
+locale adds strings at startup, not work per request.
+"""
+
+from typing import Dict, List
+
+DEFAULT_LOCALE = 'en'
+
+# Confidence bands, highest first: band 0 >= 0.90, band 1 >= 0.75, band 2 below
+CONFIDENCE_BANDS = (0.90, 0.75)
+
+METHODS = ('image', 'symptoms', 'combined')
+
+SEVERITIES = ('high', 'medium', 'low')
+
+TEXTS = {
+    'en': {
+        'confidence': (
+            "The analysis shows high confidence in this diagnosis.",
+            "The analysis shows good confidence in this diagnosis.",
+            "The analysis shows moderate confidence. Further examination is recommended.",
+        ),
+        'severity': {
+            'high': 'This is a serious condition requiring immediate medical attention.',
+            'medium': 'This condition should be evaluated by a dermatologist.',
+            'low': 'This appears to be a benign condition, but monitoring is recommended.',
+        },
+        'method': {
+            'image': 'Based on visual analysis of the skin lesion using deep learning models.',
+            'symptoms': 'Based on the reported symptoms and clinical decision trees.',
+            'combined': 'Based on comprehensive analysis combining visual features and reported symptoms.',
+        },
+        'agree': " Both image and symptom analysis agree on {disease}, increasing diagnostic confidence.",
+        'disagree': (
+            " Image analysis suggested {image_diagnosis} while symptoms indicated {symptom_diagnosis}."
+            " The final diagnosis weighs visual features more heavily."
+        ),
+        'recommendations': {
+            'common': [
+                "Document the lesion with photographs for comparison over time",
+                "Avoid excessive sun exposure and use broad-spectrum SPF 30+ sunscreen",
+                "Perform regular skin self-examinations",
+            ],
+            'high': [
+                "⚠️ Seek immediate consultation with a dermatologist",
+                "Consider a biopsy for definitive diagnosis",
+                "Do not delay treatment - early intervention is critical",
+                "Bring all relevant medical history to your appointment"
+            ],
+            'medium': [
+                "Schedule an appointment with a dermatologist within 2-4 weeks",
+                "Monitor for changes in size, color, or symptoms",
+                "Consider a professional skin examination",
+                "Follow up regularly as advised by your healthcare provider"
+            ],
+            'low': [
+                "Schedule a routine dermatology check-up",
+                "Monitor for any changes in appearance",
+                "Continue regular skin cancer screening",
+                "No immediate treatment typically required, but maintain observation"
+            ],
+        },
+    },
+}
+
+
+def confidence_band(confidence: float) -> int:
+    """Index into the 'confidence' texts for a confidence value"""
+    if confidence >= CONFIDENCE_BANDS[0]:
+        return 0
+    if confidence >= CONFIDENCE_BANDS[1]:
+        return 1
+    return 2
+
+
+class CompiledTexts:
+    """
+    Every explanation and recommendation list for one locale
+
+    Attributes:
+        explanations: {method: {severity: (text per confidence band)}}
+            for single-source analyses
+        recommendations: {severity: tuple of recommendations}
+
+    Combined explanations come from combined_explanation().
+    """
+
+    def __init__(self, diseases: List[Dict], texts: Dict):
+        self.explanations = {
+            method: {
+                severity: tuple(
+                    f"{confidence} {texts['severity'][severity]} {texts['method'][method]}"
+                    for confidence in texts['confidence']
+                )
+                for severity in SEVERITIES
+            }
+            for method in METHODS
+        }
+
+        # Per band and image disease: the combined explanation up to the
+        # image/symptom comparison, and with the agreement sentence
+        self._names = tuple(disease['name'] for disease in diseases)
+        self._disagree = texts['disagree']
+        self._combined_prefixes = tuple(
+            tuple(self.explanations['combined'][disease['severity']][band] for disease in diseases)
+            for band in range(len(texts['confidence']))
+        )
+        self._combined_agreeing = tuple(
+            tuple(
+                prefix + texts['agree'].format(disease=name)
+                for prefix, name in zip(prefixes, self._names)
+            )
+            for prefixes in self._combined_prefixes
+        )
+
+        recommendations = texts['recommendations']
+        self.recommendations = {
+            severity: tuple(recommendations[severity]) + tuple(recommendations['common'])
+            for severity in SEVERITIES
+        }
+
+    def combined_explanation(self, band: int, image_index: int, symptom_index: int) -> str:
+        """
+        Explanation of a combined analysis (the final diagnosis is the image one)
+
+        Args:
+            band: Confidence band (see confidence_band)
+            image_index: Disease index from the image analysis
+            symptom_index: Disease index from the symptom analysis
+
+        Returns:
+            Explanation text
+        """
+        if image_index == symptom_index:
+            return self._combined_agreeing[band][image_index]
+        return self._combined_prefixes[band][image_index] + self._disagree.format(
+            image_diagnosis=self._names[image_index], symptom_diagnosis=self._names[symptom_index]
+        )
+
+
+def compile_texts(diseases: List[Dict], texts: Dict = None) -> Dict[str, CompiledTexts]:
+    """
+    Compile the texts of every locale
+
+    Args:
+        diseases: Disease records (order defines the disease indices)
+        texts: Source strings per locale (defaults to TEXTS)
+
+    Returns:
+        {locale: CompiledTexts}
+    """
+    return {
+        locale: CompiledTexts(diseases, locale_texts)
+        for locale, locale_texts in (texts if texts is not None else TEXTS).items()
+    }
@@ -0,0 +1,198 @@
+"""
+Multi-resolution tile pyramids for heatmap overlays
+
+Overlays of large dermoscopy images are stored in the Deep Zoom (DZI)
+layout instead of as one full-resolution file:
+
+    heatmaps/ab/cd/<name>_<kind>.dzi               descriptor (XML)
+    heatmaps/ab/cd/<name>_<kind>_files/<level>/<col>_<row>.jpg
+
+Level 0 is 1x1 pixel and every level doubles the previous one up to the
+full overlay size at the top level. Deep Zoom viewers can load the
+descriptor straight from MEDIA_URL; read_region() assembles any region of
+any level for clients that want a single image (e.g. a thumbnail).
+"""
+
+import math
+import os
+import xml.etree.ElementTree as ElementTree
+from functools import lru_cache
+from typing import Dict, List, Tuple
+
+import cv2
+import numpy as np
+
+from .metrics import timed
+from .storage import write_atomically
+
+DZI_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+
+TILE_FORMAT = 'jpg'
+
+
+def pyramid_path(visualization: str) -> str:
+    """
+    Descriptor path of the pyramid stored next to a flat overlay
+
+    Args:
+        visualization: Overlay path, e.g. heatmaps/<name>_heatmap.jpg
+
+    Returns:
+        Path with the same directory, e.g. heatmaps/<name>_heatmap.dzi
+    """
+    return os.path.splitext(visualization)[0] + '.dzi'
+
+
+def tiles_dir(descriptor_path: str) -> str:
+    return os.path.splitext(descriptor_path)[0] + '_files'
+
+
+def level_sizes(width: int, height: int) -> List[Tuple[int, int]]:
+    """(width, height) of every pyramid level, level 0 (1x1) first"""
+    max_level = math.ceil(math.log2(max(width, height, 1)))
+    return [
+        (math.ceil(width / 2 ** (max_level - level)), math.ceil(height / 2 ** (max_level - level)))
+        for level in range(max_level + 1)
+    ]
+
+
+@timed('tile_pyramid')
+def write_pyramid(overlay: np.ndarray, descriptor_path: str, tile_size: int = 512, quality: int = 85) -> Dict:
+    """
+    Tile an overlay into a Deep Zoom pyramid
+
+    The top level is tiled straight from the overlay; each lower level is
+    downscaled from the one above it. The descriptor is written last, so
+    its presence means every tile exists.
+
+    Args:
+        overlay: BGR uint8 overlay at full pyramid resolution
+        descriptor_path: Absolute path of the .dzi file to write
+        tile_size: Side of the square tiles in pixels
+        quality: JPEG quality of the tiles
+
+    Returns:
+        Pyramid description (see read_pyramid)
+    """
+    height, width = overlay.shape[:2]
+    sizes = level_sizes(width, height)
+    directory = tiles_dir(descriptor_path)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+    level_image = overlay
+    for level in range(len(sizes) - 1, -1, -1):
+        level_width, level_height = sizes[level]
+        if (level_image.shape[1], level_image.shape[0]) != (level_width, level_height):
+            level_image = cv2.resize(level_image, (level_width, level_height), interpolation=cv2.INTER_AREA)
+
+        level_dir = os.path.join(directory, str(level))
+        os.makedirs(level_dir, exist_ok=True)
+        for row, top in enumerate(range(0, level_height, tile_size)):
+            for col, left in enumerate(range(0, level_width, tile_size)):
+                tile = level_image[top:top + tile_size, left:left + tile_size]
+                ok, encoded = cv2.imencode(f'.{TILE_FORMAT}', tile, params)
+                if not ok:
+                    raise ValueError(f'Could not encode tile {level}/{col}_{row}')
+                with open(os.path.join(level_dir, f'{col}_{row}.{TILE_FORMAT}'), 'wb') as handle:
+                    handle.write(encoded.tobytes())
+
+    root = ElementTree.Element('Image', {
+        'xmlns': DZI_NAMESPACE,
+        'TileSize': str(tile_size),
+        'Overlap': '0',
+        'Format': TILE_FORMAT,
+    })
+    ElementTree.SubElement(root, 'Size', {'Width': str(width), 'Height': str(height)})
+    write_atomically(descriptor_path, ElementTree.tostring(root, encoding='utf-8', xml_declaration=True))
+
+    return {'width': width, 'height': height, 'tile_size': tile_size, 'levels': len(sizes)}
+
+
+def read_pyramid(descriptor_path: str) -> Dict:
+    """
+    Read a pyramid descriptor
+
+    Cached by the descriptor's inode and modification time, so a pyramid
+    that was swept or rendered again is read afresh.
+
+    Args:
+        descriptor_path: Absolute path of the .dzi file
+
+    Returns:
+        {'width', 'height', 'tile_size', 'levels'}; raises FileNotFoundError
+        if the pyramid does not exist (yet)
+    """
+    stat = os.stat(descriptor_path)
+    return dict(_parse_descriptor(descriptor_path, stat.st_ino, stat.st_mtime_ns))
+
+
+@lru_cache(maxsize=1024)
+def _parse_descriptor(descriptor_path: str, inode: int, mtime_ns: int) -> Dict:
+    root = ElementTree.parse(descriptor_path).getroot()
+    size = root.find(f'{{{DZI_NAMESPACE}}}Size')
+    width, height = int(size.get('Width')), int(size.get('Height'))
+    return {
+        'width': width,
+        'height': height,
+        'tile_size': int(root.get('TileSize')),
+        'levels': len(level_sizes(width, height)),
+    }
+
+
+def thumbnail_level(pyramid: Dict) -> int:
+    """Highest level that fits in a single tile"""
+    sizes = level_sizes(pyramid['width'], pyramid['height'])
+    fitting = [level for level, size in enumerate(sizes) if max(size) <= pyramid['tile_size']]
+    return fitting[-1]
+
+
+@timed('heatmap_region')
+def read_region(descriptor_path: str, level: int, x: int = 0, y: int = 0,
+                width: int = None, height: int = None, max_side: int = 0) -> np.ndarray:
+    """
+    Assemble a region of one pyramid level from its tiles
+
+    Args:
+        descriptor_path: Absolute path of the .dzi file
+        level: Pyramid level (0 is 1x1, levels - 1 is full resolution)
+        x, y: Top-left corner in level pixels
+        width, height: Region size (defaults to the rest of the level)
+        max_side: Largest accepted region side (0 for no limit)
+
+    Returns:
+        BGR uint8 array; raises ValueError for a region outside the level
+    """
+    pyramid = read_pyramid(descriptor_path)
+    if not 0 <= level < pyramid['levels']:
+        raise ValueError(f"Level must be between 0 and {pyramid['levels'] - 1}")
+
+    level_width, level_height = level_sizes(pyramid['width'], pyramid['height'])[level]
+    if width is None:
+        width = level_width - x
+    if height is None:
+        height = level_height - y
+    if x < 0 or y < 0 or width <= 0 or height <= 0 or x + width > level_width or y + height > level_height:
+        raise ValueError(f'Region is outside level {level} ({level_width}x{level_height})')
+    if max_side and max(width, height) > max_side:
+        raise ValueError(f'Region sides must be at most {max_side} pixels; request a lower level')
+
+    tile_size = pyramid['tile_size']
+    level_dir = os.path.join(tiles_dir(descriptor_path), str(level))
+    region = np.empty((height, width, 3), dtype=np.uint8)
+
+    for row in range(y // tile_size, (y + height - 1) // tile_size + 1):
+        for col in range(x // tile_size, (x + width - 1) // tile_size + 1):
+            tile = cv2.imread(os.path.join(level_dir, f'{col}_{row}.{TILE_FORMAT}'))
+            if tile is None:
+                raise FileNotFoundError(f'Missing tile {level}/{col}_{row}')
+
+            # Overlap of this tile with the region, in level coordinates
+            left, top = max(x, col * tile_size), max(y, row * tile_size)
+            right = min(x + width, col * tile_size + tile.shape[1])
+            bottom = min(y + height, row * tile_size + tile.shape[0])
+            region[top - y:bottom - y, left - x:right - x] = tile[
+                top - row * tile_size:bottom - row * tile_size,
+                left - col * tile_size:right - col * tile_size
+            ]
+
+    return region
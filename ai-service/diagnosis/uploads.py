@@ -0,0 +1,288 @@
+"""
+Streaming ingestion of uploaded images
+
+ImageUploadHandler inspects each upload while the request body is still
+arriving. The first bytes identify the format (magic bytes) and the image
+dimensions (PNG IHDR or JPEG SOF header), so non-images, oversize files
+and decompression bombs are rejected before the rest of the file is
+buffered, written or decoded. Accepted uploads are hashed and written to
+a partial file in UPLOAD_PATH chunk by chunk as they are received. Only
+once the image decodes (utils.validate_image) is it moved into the
+content-addressed store (see storage.py); otherwise it is deleted.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import struct
+import time
+import uuid
+from typing import Optional, Tuple
+
+from django.conf import settings
+from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+from .metrics import STAGE_SECONDS
+from .storage import store_upload
+
+logger = logging.getLogger(__name__)
+
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+JPEG_MAGIC = b'\xff\xd8\xff'
+
+EXTENSIONS = {'PNG': '.png', 'JPEG': '.jpg'}
+
+# Give up looking for a JPEG frame header after this many bytes
+# (EXIF and ICC segments can push it well past the first chunk)
+MAX_HEADER_BYTES = 512 * 1024
+
+# JPEG start-of-frame markers (SOF0-SOF15 except DHT, JPG and DAC)
+_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+# JPEG markers without a length field
+_STANDALONE_MARKERS = frozenset(range(0xD0, 0xDA)) | {0x01}
+
+
+class UploadRejected(ValueError):
+    """An image refused before decoding (size, type or dimensions)"""
+
+
+def sniff_image_header(head: bytes) -> Optional[Tuple[str, int, int]]:
+    """
+    Read format and dimensions from the start of an encoded image
+
+    Args:
+        head: Leading bytes of the file
+
+    Returns:
+        (format, width, height), or None if more bytes are needed.
+        Raises UploadRejected if the bytes are not a JPEG or PNG image.
+    """
+    if len(head) < 8:
+        if PNG_MAGIC.startswith(head) or JPEG_MAGIC.startswith(head[:3]):
+            return None
+        raise UploadRejected("Invalid file type. Only JPEG and PNG are allowed.")
+
+    if head.startswith(PNG_MAGIC):
+        # Signature, then the IHDR chunk: length, type, width, height
+        if len(head) < 24:
+            return None
+        if head[12:16] != b'IHDR':
+            raise UploadRejected("Invalid image file. File may be corrupted.")
+        width, height = struct.unpack('>II', head[16:24])
+        return 'PNG', width, height
+
+    if head.startswith(JPEG_MAGIC):
+        return _sniff_jpeg(head)
+
+    raise UploadRejected("Invalid file type. Only JPEG and PNG are allowed.")
+
+
+def _sniff_jpeg(head: bytes) -> Optional[Tuple[str, int, int]]:
+    position = 2
+    while True:
+        # Skip fill bytes before the marker
+        while position < len(head) and head[position] == 0xFF:
+            position += 1
+        if position >= len(head):
+            return None
+        if head[position - 1] != 0xFF:
+            raise UploadRejected("Invalid image file. File may be corrupted.")
+
+        marker = head[position]
+        position += 1
+        if marker in _STANDALONE_MARKERS:
+            continue
+        if marker == 0xD9 or marker == 0xDA:
+            # End of image or start of scan before any frame header
+            raise UploadRejected("Invalid image file. File may be corrupted.")
+
+        if marker in _SOF_MARKERS:
+            # Length (2), precision (1), height (2), width (2)
+            if position + 7 > len(head):
+                return None
+            height, width = struct.unpack('>HH', head[position + 3:position + 7])
+            return 'JPEG', width, height
+
+        if position + 2 > len(head):
+            return None
+        length, = struct.unpack('>H', head[position:position + 2])
+        position += length
+
+
+def check_image_dimensions(width: int, height: int):
+    """Raise UploadRejected if an image exceeds MAX_IMAGE_PIXELS"""
+    if width <= 0 or height <= 0:
+        raise UploadRejected("Invalid image file. File may be corrupted.")
+    if width * height > settings.MAX_IMAGE_PIXELS:
+        raise UploadRejected(
+            f"Image dimensions too large ({width}x{height}). "
+            f"Maximum is {settings.MAX_IMAGE_PIXELS / 1e6:g} megapixels."
+        )
+
+
+def upload_size_error() -> str:
+    return f"Image file too large. Maximum size is {settings.MAX_UPLOAD_SIZE // (1024 * 1024)}MB."
+
+
+class StreamedImageUpload(InMemoryUploadedFile):
+    """
+    An upload received by ImageUploadHandler
+
+    Accepted uploads keep their bytes in memory (for decoding) and carry
+    the SHA-256 digest and the partial file written while streaming, which
+    store() moves into the store and discard() deletes. Rejected uploads
+    are empty and carry the reason in `rejection`.
+    """
+
+    def __init__(self, file, field_name, name, content_type, size, charset,
+                 content_type_extra=None, digest: str = None, part_path: str = None,
+                 image_format: str = None, dimensions: Tuple[int, int] = None,
+                 rejection: str = None):
+        super().__init__(file, field_name, name, content_type, size, charset, content_type_extra)
+        self.digest = digest
+        self.part_path = part_path
+        self.stored_path = None
+        self.image_format = image_format
+        self.dimensions = dimensions
+        self.rejection = rejection
+
+    def store(self) -> str:
+        """Move the received bytes into the content-addressed store (once)"""
+        if self.stored_path is None:
+            # Content-addressed name: identical uploads share one stored file
+            self.stored_path = store_upload(self.part_path, self.digest, EXTENSIONS[self.image_format])
+            self.part_path = None
+        return self.stored_path
+
+    def discard(self):
+        """Delete the received bytes of an upload that failed validation"""
+        if self.part_path is not None:
+            _remove_part(self.part_path)
+            self.part_path = None
+
+    def close(self):
+        # Django closes every upload of a request once the response is sent,
+        # so bytes no view stored (e.g. unexpected file fields) go with it
+        self.discard()
+        super().close()
+
+
+class ImageUploadHandler(FileUploadHandler):
+    """
+    Upload handler that validates, hashes and stores images as they stream
+
+    A rejected file stops being buffered and written at the chunk where the
+    problem is detected; the rest of its bytes are discarded as they arrive
+    and the view receives a StreamedImageUpload explaining the rejection,
+    so other files in the same request (batch uploads) are unaffected.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self._buffer = io.BytesIO()
+        self._hash = hashlib.sha256()
+        self._received = 0
+        self._header = None
+        self._rejection = None
+        # Time spent sniffing, hashing and writing (not waiting for the network)
+        self._busy = 0.0
+
+        # Stored under a temporary name until the digest is known
+        self._part_path = os.path.join(settings.UPLOAD_PATH, f'{uuid.uuid4().hex}.part')
+        self._part = open(self._part_path, 'wb')
+
+    def receive_data_chunk(self, raw_data, start):
+        if self._rejection is not None:
+            return None
+
+        started = time.perf_counter()
+        self._received += len(raw_data)
+        try:
+            if self._received > settings.MAX_UPLOAD_SIZE:
+                raise UploadRejected(upload_size_error())
+
+            if self._header is None:
+                head = self._buffer.getvalue() + raw_data
+                self._header = sniff_image_header(head[:MAX_HEADER_BYTES])
+                if self._header is None and len(head) >= MAX_HEADER_BYTES:
+                    raise UploadRejected("Invalid image file. Could not read image dimensions.")
+                if self._header is not None:
+                    check_image_dimensions(*self._header[1:])
+        except UploadRejected as e:
+            self._reject(str(e))
+            return None
+
+        self._buffer.write(raw_data)
+        self._hash.update(raw_data)
+        self._part.write(raw_data)
+        self._busy += time.perf_counter() - started
+        return None
+
+    def file_complete(self, file_size):
+        start = time.perf_counter()
+        self._part.close()
+
+        if self._rejection is None and self._header is None:
+            # Body ended before the header could be read
+            self._reject("Invalid image file. File may be corrupted.")
+
+        if self._rejection is not None:
+            return StreamedImageUpload(
+                io.BytesIO(), self.field_name, self.file_name, self.content_type, 0,
+                self.charset, self.content_type_extra, rejection=self._rejection
+            )
+
+        image_format, width, height = self._header
+
+        # Stored under the digest only after the image has decoded
+        self._buffer.seek(0)
+        STAGE_SECONDS.observe(self._busy + time.perf_counter() - start, stage='upload_stream')
+        return StreamedImageUpload(
+            self._buffer, self.field_name, self.file_name, self.content_type, file_size,
+            self.charset, self.content_type_extra, digest=self._hash.hexdigest(),
+            part_path=self._part_path, image_format=image_format, dimensions=(width, height)
+        )
+
+    def upload_interrupted(self):
+        part = getattr(self, '_part', None)
+        if part is not None and not part.closed:
+            part.close()
+            self._discard_part()
+
+    def _reject(self, reason: str):
+        logger.info(f'Rejected upload {self.file_name!r}: {reason}')
+        self._rejection = reason
+        self._buffer = io.BytesIO()
+        if not self._part.closed:
+            self._part.close()
+        self._discard_part()
+
+    def _discard_part(self):
+        _remove_part(self._part_path)
+
+
+def discard_uploads(files):
+    """
+    Delete the partial files of streamed uploads that were never stored
+
+    Every file the handler streams is written to a .part file that only
+    validate_image stores or deletes, so a request that fails before (or
+    instead of) validating its files has to discard them.
+
+    Args:
+        files: Uploaded file objects (None entries and other upload types
+            are skipped)
+    """
+    for upload in files:
+        if isinstance(upload, StreamedImageUpload):
+            upload.discard()
+
+
+def _remove_part(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
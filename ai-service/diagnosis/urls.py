@@ -2,12 +2,24 @@
 URL configuration for diagnosis app
 """
 
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# Native async analyze views when serving over ASGI
+if settings.ASYNC_VIEWS:
+    from . import async_views as analyze_views
+else:
+    analyze_views = views
+
 urlpatterns = [
     path('health', views.health_check, name='health_check'),
-    path('analyze/image', views.analyze_image, name='analyze_image'),
-    path('analyze/symptoms', views.analyze_symptoms, name='analyze_symptoms'),
-    path('analyze/combined', views.analyze_combined, name='analyze_combined'),
+    path('ready', views.readiness, name='readiness'),
+    path('metrics', views.metrics, name='metrics'),
+    path('analyze/image', analyze_views.analyze_image, name='analyze_image'),
+    path('analyze/symptoms', analyze_views.analyze_symptoms, name='analyze_symptoms'),
+    path('analyze/combined', analyze_views.analyze_combined, name='analyze_combined'),
+    path('analyze/batch', analyze_views.analyze_batch, name='analyze_batch'),
+    path('heatmaps/<slug:job_id>', views.heatmap_status, name='heatmap_status'),
+    path('heatmaps/<slug:job_id>/<slug:kind>', views.heatmap_region, name='heatmap_region'),
 ]
@@ -2,19 +2,106 @@
 Utility functions for image processing and heatmap generation
 """
 
+import hashlib
+import io
 import os
 import cv2
 import numpy as np
 from PIL import Image
 from django.conf import settings
 
+from .metrics import IMAGE_BYTES, IMAGE_MEGAPIXELS, timed
+from .results import ActivationGrid
+from .storage import derived_path, media_path, store_upload, write_atomically
+from .tiles import pyramid_path, write_pyramid
+from .uploads import UploadRejected, check_image_dimensions, upload_size_error
 
-def preprocess_image(image_path: str, target_size: tuple = (224, 224)) -> np.ndarray:
+
+class DecodedImage:
+    """
+    An uploaded image decoded once from its in-memory buffer
+    
+    Validation, preprocessing, heatmap generation and the model all share
+    this object instead of reopening the upload or the saved file.
+    """
+    
+    def __init__(self, data: bytes, digest: str = None):
+        """
+        Decode raw image bytes
+        
+        Args:
+            data: Encoded image bytes (JPEG or PNG)
+            digest: SHA-256 hex digest of data, if already computed
+        """
+        img = Image.open(io.BytesIO(data))
+        # Refuse decompression bombs before allocating the pixel buffer
+        check_image_dimensions(*img.size)
+        # load() fully decodes, so truncated or corrupted files fail here
+        img.load()
+        
+        self.data = data
+        self.format = img.format
+        self.image = img if img.mode == 'RGB' else img.convert('RGB')
+        self._bgr = None
+        self._digest = digest
+    
+    @property
+    def digest(self) -> str:
+        """SHA-256 hex digest of the encoded bytes (content address)"""
+        if self._digest is None:
+            self._digest = hashlib.sha256(self.data).hexdigest()
+        return self._digest
+    
+    @property
+    def width(self) -> int:
+        return self.image.width
+    
+    @property
+    def height(self) -> int:
+        return self.image.height
+    
+    @property
+    def bgr(self) -> np.ndarray:
+        """Pixels as an OpenCV-style BGR uint8 array (converted on first use)"""
+        if self._bgr is None:
+            self._bgr = cv2.cvtColor(np.asarray(self.image), cv2.COLOR_RGB2BGR)
+        return self._bgr
+
+
+def content_rng(*parts, seed: int = 0) -> np.random.Generator:
+    """
+    Independent random generator derived from request content
+    
+    The same parts (and seed) always produce the same stream, so results
+    are reproducible per input, and concurrent requests never share state.
+    
+    Args:
+        *parts: str, bytes or numpy arrays identifying the input
+        seed: Base seed mixed into the content hash
+        
+    Returns:
+        numpy Generator
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode('utf-8')
+        elif isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part).data
+        digest.update(part)
+        # Separator so ('ab', 'c') and ('a', 'bc') differ
+        digest.update(b'\0')
+    
+    return np.random.default_rng([seed, int.from_bytes(digest.digest(), 'little')])
+
+
+@timed('preprocess')
+def preprocess_image(image, target_size: tuple = (224, 224)) -> np.ndarray:
     """
     Preprocess image for model input
     
     Args:
-        image_path: Path to the image file
+        image: DecodedImage, or path to the image file
         target_size: Target size for resizing
         
     Returns:
@@ -22,7 +109,10 @@ def preprocess_image(image_path: str, target_size: tuple = (224, 224)) -> np.nda
     """
     try:
         # Load image
-        img = Image.open(image_path)
+        if isinstance(image, DecodedImage):
+            img = image.image
+        else:
+            img = Image.open(image)
         
         # Convert to RGB if needed
         if img.mode != 'RGB':
@@ -39,79 +129,280 @@ def preprocess_image(image_path: str, target_size: tuple = (224, 224)) -> np.nda
         raise ValueError(f"Error preprocessing image: {str(e)}")
 
 
-def generate_gradcam_heatmap(image_path: str) -> str:
+def visualization_path(image_path: str, kind: str) -> str:
     """
-    Generate a mock Grad-CAM heatmap for explainable AI
-    In production, this would use actual gradient computation from the CNN
+    Relative media path of a visualization derived from an uploaded image
     
     Args:
         image_path: Path to the original image
+        kind: Visualization type ('heatmap' or 'attention')
         
     Returns:
-        Path to the generated heatmap image
+        Path relative to MEDIA_ROOT, e.g. heatmaps/ab/cd/<name>_heatmap.jpg
     """
-    try:
-        # Load original image
-        img = cv2.imread(image_path)
-        if img is None:
-            raise ValueError("Could not read image")
+    name, ext = os.path.splitext(os.path.basename(image_path))
+    return derived_path('heatmaps', name, f"_{kind}{ext}")
+
+
+def _capped_size(width: int, height: int, max_side: int) -> tuple:
+    """Scale (width, height) down so the longest side is at most max_side"""
+    if not max_side or max(width, height) <= max_side:
+        return width, height
+    scale = max_side / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def load_overlay_base(image_path: str, image: DecodedImage = None, max_side: int = None) -> np.ndarray:
+    """
+    Load the BGR image a visualization is blended onto, capped in size
+    
+    Decoded images are downscaled through PIL before the BGR conversion,
+    so a full-resolution BGR copy is never made when a cap applies.
+    
+    Args:
+        image_path: Path to the original image
+        image: Already decoded image (avoids reading image_path back from disk)
+        max_side: Longest output side in pixels (None or 0 for native size)
         
-        # Get image dimensions
-        height, width = img.shape[:2]
+    Returns:
+        BGR uint8 array
+    """
+    if image is not None:
+        size = _capped_size(image.width, image.height, max_side)
+        if size == (image.width, image.height):
+            return image.bgr
+        resized = image.image.resize(size, Image.BILINEAR, reducing_gap=2.0)
+        return cv2.cvtColor(np.asarray(resized), cv2.COLOR_RGB2BGR)
+    
+    img = cv2.imread(image_path)
+    if img is None:
+        raise ValueError("Could not read image")
+    
+    height, width = img.shape[:2]
+    size = _capped_size(width, height, max_side)
+    if size != (width, height):
+        img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    return img
+
+
+def _gaussian_kernel_1d(length: int, center: float, sigma: float) -> np.ndarray:
+    """1-D float32 Gaussian profile of the given length"""
+    positions = np.arange(length, dtype=np.float32)
+    return np.exp(-((positions - np.float32(center)) ** 2) / np.float32(2 * sigma ** 2))
+
+
+def compute_activation_map(focal_point: tuple, size: tuple = (224, 224), spread: float = 0.15) -> np.ndarray:
+    """
+    Compute a mock Grad-CAM activation map at model resolution
+    In production, this would be the class activation of the CNN's last
+    convolutional layer, which is also model-resolution
+    
+    The Gaussian is separable, so it is the outer product of two 1-D
+    kernels rather than an exp over a full 2-D grid.
+    
+    Args:
+        focal_point: (x, y) centre as fractions of width and height
+        size: (width, height) of the activation map
+        spread: Standard deviation as a fraction of each side
         
-        # Create a mock heatmap (in production, this would be actual Grad-CAM)
-        # Generate a random focal point
-        center_x = int(width * np.random.uniform(0.3, 0.7))
-        center_y = int(height * np.random.uniform(0.3, 0.7))
+    Returns:
+        float32 array of shape (height, width) with values in [0, 1]
+    """
+    width, height = size
+    kernel_x = _gaussian_kernel_1d(width, focal_point[0] * width, spread * width)
+    kernel_y = _gaussian_kernel_1d(height, focal_point[1] * height, spread * height)
+    return np.outer(kernel_y, kernel_x)
+
+
+def gradcam_focal_point(image_path: str, image: DecodedImage = None) -> tuple:
+    """
+    Centre of the mock Grad-CAM activation
+    
+    Derived from the image so the same upload always gets the same map
+    (stored uploads are named by their digest).
+    
+    Args:
+        image_path: Path to the original image
+        image: Already decoded image, if any
         
-        # Create gaussian-like heatmap
-        y, x = np.ogrid[:height, :width]
-        sigma_x = width * 0.15
-        sigma_y = height * 0.15
+    Returns:
+        (x, y) as fractions of width and height
+    """
+    rng = content_rng(
+        image.digest if image is not None
+        else os.path.splitext(os.path.basename(image_path))[0]
+    )
+    return tuple(rng.uniform(0.3, 0.7, 2))
+
+
+@timed('activation_grid')
+def compute_activation_grids(image_path: str, image_array: np.ndarray, image: DecodedImage = None,
+                             size: int = None) -> tuple:
+    """
+    Grad-CAM and attention maps as small uint8 grids (HEATMAP_MODE=activation)
+    
+    Nothing is rendered, encoded or stored: the grids travel inline with
+    the diagnosis and the client colorizes and blends them itself. The
+    attention grid is derived from the preprocessed model input, so the
+    original image is never touched at full resolution.
+    
+    Args:
+        image_path: Path to the original image
+        image_array: Preprocessed model input from preprocess_image
+        image: Already decoded image, if any
+        size: Grid side in cells (defaults to settings.HEATMAP_GRID_SIZE)
         
-        heatmap = np.exp(-((x - center_x)**2 / (2 * sigma_x**2) + 
-                          (y - center_y)**2 / (2 * sigma_y**2)))
+    Returns:
+        (Grad-CAM grid, attention grid) as ActivationGrid
+    """
+    if size is None:
+        size = settings.HEATMAP_GRID_SIZE
+    
+    activation = compute_activation_map(gradcam_focal_point(image_path, image), size=(size, size))
+    gradcam = (activation * 255).astype(np.uint8)
+    
+    # Edge density of the model input, averaged down to the grid
+    gray = cv2.cvtColor((image_array * 255).astype(np.uint8), cv2.COLOR_RGB2GRAY)
+    edges = cv2.dilate(cv2.Canny(gray, 50, 150), np.ones((3, 3), np.uint8))
+    attention = cv2.resize(edges, (size, size), interpolation=cv2.INTER_AREA)
+    
+    return (
+        ActivationGrid(size, size, gradcam.tobytes(), 'jet', 0.4),
+        ActivationGrid(size, size, attention.tobytes(), 'hot', 0.3),
+    )
+
+
+def render_activation_overlay(img: np.ndarray, activation: np.ndarray,
+                              colormap: int = cv2.COLORMAP_JET, alpha: float = 0.4) -> np.ndarray:
+    """
+    Colormap an activation map and blend it onto an image
+    
+    The activation map is quantized to uint8 at its own resolution and only
+    then upsampled to the image size, so no full-size float buffers are made.
+    
+    Args:
+        img: BGR uint8 image to draw on
+        activation: float32 map with values in [0, 1] (or an already
+            quantized uint8 map), any resolution
+        colormap: OpenCV colormap to apply
+        alpha: Weight of the colormapped activation in the blend
         
-        # Normalize to 0-255
-        heatmap = (heatmap * 255).astype(np.uint8)
+    Returns:
+        BGR uint8 overlay the same size as img
+    """
+    height, width = img.shape[:2]
+    
+    heatmap = activation if activation.dtype == np.uint8 else (activation * 255).astype(np.uint8)
+    heatmap = cv2.resize(heatmap, (width, height), interpolation=cv2.INTER_LINEAR)
+    heatmap_colored = cv2.applyColorMap(heatmap, colormap)
+    
+    # Blend into the colormap buffer to avoid one more full-size allocation
+    return cv2.addWeighted(img, 1.0 - alpha, heatmap_colored, alpha, 0, dst=heatmap_colored)
+
+
+def write_overlay(image_path: str, image: DecodedImage, visualization: str, activation: np.ndarray,
+                  colormap: int, alpha: float, max_side: int, preview_base: np.ndarray = None):
+    """
+    Render an overlay and store it as a flat preview (plus a tile pyramid)
+    
+    With settings.HEATMAP_TILES the overlay is rendered once at pyramid
+    resolution (settings.HEATMAP_PYRAMID_MAX_SIZE, 0 for native), tiled,
+    and downscaled to the preview. The pyramid is complete before the
+    preview is written, and the preview is moved into place whole, so an
+    existing preview means both are ready.
+    
+    Args:
+        image_path: Path to the original image
+        image: Already decoded image (or None to read image_path)
+        visualization: Relative preview path from visualization_path
+        activation: Map to colorize, any resolution (see render_activation_overlay)
+        colormap: OpenCV colormap to apply
+        alpha: Weight of the colormapped activation in the blend
+        max_side: Longest side of the preview (0 keeps native resolution)
+        preview_base: Base image already loaded at preview size, if any
+    """
+    os.makedirs(os.path.dirname(media_path(visualization)), exist_ok=True)
+    if settings.HEATMAP_TILES:
+        base = load_overlay_base(image_path, image, settings.HEATMAP_PYRAMID_MAX_SIZE)
+        overlay = render_activation_overlay(base, activation, colormap, alpha)
+        write_pyramid(
+            overlay,
+            media_path(pyramid_path(visualization)),
+            tile_size=settings.HEATMAP_TILE_SIZE,
+            quality=settings.HEATMAP_TILE_QUALITY
+        )
         
-        # Apply colormap (JET for medical visualization)
-        heatmap_colored = cv2.applyColorMap(heatmap, cv2.COLORMAP_JET)
+        height, width = overlay.shape[:2]
+        size = _capped_size(width, height, max_side)
+        if size != (width, height):
+            overlay = cv2.resize(overlay, size, interpolation=cv2.INTER_AREA)
+    else:
+        if preview_base is None:
+            preview_base = load_overlay_base(image_path, image, max_side)
+        overlay = render_activation_overlay(preview_base, activation, colormap, alpha)
+    
+    ok, encoded = cv2.imencode(os.path.splitext(visualization)[1], overlay)
+    if not ok:
+        raise ValueError(f"Could not encode {visualization}")
+    write_atomically(media_path(visualization), encoded.tobytes())
+
+
+@timed('gradcam_heatmap')
+def generate_gradcam_heatmap(image_path: str, image: DecodedImage = None, max_side: int = None) -> str:
+    """
+    Generate a mock Grad-CAM heatmap for explainable AI
+    In production, this would use actual gradient computation from the CNN
+    
+    Args:
+        image_path: Path to the original image
+        image: Already decoded image (avoids reading image_path back from disk)
+        max_side: Longest side of the flat preview (defaults to
+            settings.HEATMAP_MAX_SIZE; 0 keeps native resolution)
         
-        # Overlay on original image
-        overlay = cv2.addWeighted(img, 0.6, heatmap_colored, 0.4, 0)
+    Returns:
+        Path to the generated heatmap preview (the tile pyramid, if
+        enabled, is stored next to it; see tiles.pyramid_path)
+    """
+    try:
+        if max_side is None:
+            max_side = settings.HEATMAP_MAX_SIZE
         
-        # Save heatmap
-        filename = os.path.basename(image_path)
-        name, ext = os.path.splitext(filename)
-        heatmap_filename = f"{name}_heatmap{ext}"
-        heatmap_path = os.path.join(settings.HEATMAP_PATH, heatmap_filename)
+        # Create a mock activation map at model resolution
+        # (in production, this would be actual Grad-CAM)
+        activation = compute_activation_map(gradcam_focal_point(image_path, image))
         
-        cv2.imwrite(heatmap_path, overlay)
+        # Apply colormap (JET for medical visualization), overlay and save
+        heatmap_path = visualization_path(image_path, 'heatmap')
+        write_overlay(image_path, image, heatmap_path, activation, cv2.COLORMAP_JET, 0.4, max_side)
         
         # Return relative path for URL generation
-        return os.path.join('heatmaps', heatmap_filename)
+        return heatmap_path
         
     except Exception as e:
         raise ValueError(f"Error generating heatmap: {str(e)}")
 
 
-def generate_attention_map(image_path: str) -> str:
+@timed('attention_map')
+def generate_attention_map(image_path: str, image: DecodedImage = None, max_side: int = None) -> str:
     """
     Generate an attention map showing areas of interest
     Similar to Grad-CAM but focuses on feature attention
     
     Args:
         image_path: Path to the original image
+        image: Already decoded image (avoids reading image_path back from disk)
+        max_side: Longest side of the flat preview (defaults to
+            settings.HEATMAP_MAX_SIZE; 0 keeps native resolution)
         
     Returns:
-        Path to the generated attention map
+        Path to the generated attention map preview
     """
     try:
-        # Load image
-        img = cv2.imread(image_path)
-        if img is None:
-            raise ValueError("Could not read image")
+        if max_side is None:
+            max_side = settings.HEATMAP_MAX_SIZE
+        
+        # Load image, capped to the preview resolution
+        img = load_overlay_base(image_path, image, max_side)
         
         # Convert to grayscale for edge detection
         gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
@@ -123,57 +414,82 @@ def generate_attention_map(image_path: str) -> str:
         kernel = np.ones((5, 5), np.uint8)
         edges_dilated = cv2.dilate(edges, kernel, iterations=2)
         
-        # Create attention map
-        attention = cv2.applyColorMap(edges_dilated, cv2.COLORMAP_HOT)
-        
-        # Overlay on original
-        result = cv2.addWeighted(img, 0.7, attention, 0.3, 0)
+        # Create attention map, overlay on original and save
+        attention_path = visualization_path(image_path, 'attention')
+        write_overlay(image_path, image, attention_path, edges_dilated, cv2.COLORMAP_HOT, 0.3,
+                      max_side, preview_base=img)
         
-        # Save attention map
-        filename = os.path.basename(image_path)
-        name, ext = os.path.splitext(filename)
-        attention_filename = f"{name}_attention{ext}"
-        attention_path = os.path.join(settings.HEATMAP_PATH, attention_filename)
-        
-        cv2.imwrite(attention_path, result)
-        
-        return os.path.join('heatmaps', attention_filename)
+        return attention_path
         
     except Exception as e:
         raise ValueError(f"Error generating attention map: {str(e)}")
 
 
-def validate_image(image_file) -> bool:
+@timed('validate')
+def validate_image(image_file) -> DecodedImage:
     """
     Validate uploaded image file
     
+    The upload is decoded once here and the result is meant to be reused by
+    the rest of the pipeline. A streamed upload enters the media store only
+    once it has decoded; the bytes of an invalid one are deleted.
+    
     Args:
         image_file: Uploaded file object
         
     Returns:
-        True if valid, raises ValueError otherwise
+        DecodedImage if valid, raises ValueError otherwise
     """
-    # Check file size (max 10MB)
-    if image_file.size > 10 * 1024 * 1024:
-        raise ValueError("Image file too large. Maximum size is 10MB.")
+    try:
+        image = _decode_upload(image_file)
+    except ValueError:
+        if hasattr(image_file, 'discard'):
+            image_file.discard()
+        raise
+    
+    if hasattr(image_file, 'store'):
+        image_file.store()
+    
+    IMAGE_BYTES.observe(len(image.data))
+    IMAGE_MEGAPIXELS.observe(image.width * image.height / 1e6)
+    return image
+
+
+def _decode_upload(image_file) -> DecodedImage:
+    """Check an upload's size and type and decode it (ValueError if invalid)"""
+    # Uploads rejected while streaming carry the reason
+    rejection = getattr(image_file, 'rejection', None)
+    if rejection:
+        raise ValueError(rejection)
+    
+    # Check file size
+    if image_file.size > settings.MAX_UPLOAD_SIZE:
+        raise ValueError(upload_size_error())
     
     # Check file type
     allowed_types = ['image/jpeg', 'image/jpg', 'image/png']
     if image_file.content_type not in allowed_types:
         raise ValueError("Invalid file type. Only JPEG and PNG are allowed.")
     
-    # Try to open as image
+    # Decode from the in-memory upload buffer
     try:
-        img = Image.open(image_file)
-        img.verify()
-        return True
+        image_file.seek(0)
+        image = DecodedImage(image_file.read(), digest=getattr(image_file, 'digest', None))
+    except UploadRejected:
+        raise
     except Exception:
         raise ValueError("Invalid image file. File may be corrupted.")
+    finally:
+        # Rewind so the upload can still be saved to storage
+        image_file.seek(0)
+    
+    return image
 
 
+@timed('save')
 def save_uploaded_image(image_file) -> str:
     """
-    Save uploaded image to disk
+    Save uploaded image to the content-addressed store
     
     Args:
         image_file: Uploaded file object
@@ -182,14 +498,19 @@ def save_uploaded_image(image_file) -> str:
         Path to saved image
     """
     import uuid
-    from django.core.files.storage import default_storage
     
-    # Generate unique filename
-    ext = os.path.splitext(image_file.name)[1]
-    filename = f"{uuid.uuid4()}{ext}"
-    filepath = os.path.join('uploads', filename)
+    # Streamed uploads were stored by validate_image
+    stored_path = getattr(image_file, 'stored_path', None)
+    if stored_path and os.path.exists(stored_path):
+        return stored_path
     
-    # Save file
-    full_path = default_storage.save(filepath, image_file)
+    # Hash while writing a temporary copy, then store it under its digest
+    digest = hashlib.sha256()
+    part_path = os.path.join(settings.UPLOAD_PATH, f"{uuid.uuid4().hex}.part")
+    with open(part_path, 'wb') as part:
+        for chunk in image_file.chunks():
+            digest.update(chunk)
+            part.write(chunk)
     
-    return os.path.join(settings.MEDIA_ROOT, full_path)
+    ext = os.path.splitext(image_file.name)[1].lower()
+    return store_upload(part_path, digest.hexdigest(), ext)
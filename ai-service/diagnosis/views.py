@@ -2,33 +2,48 @@
 API views for diagnosis endpoints
 """
 
+import cv2
+from django.conf import settings
+from django.http import HttpResponse
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
 from rest_framework import status
-from django.conf import settings
-import os
-import traceback
 import logging
 
-from .ml_service import MockMLService
-from .utils import (
-    validate_image,
-    save_uploaded_image,
-    generate_gradcam_heatmap,
-    preprocess_image
+from .admission import admission_controller, server_snapshot
+from .inference_pool import InferencePoolClient
+from .metrics import REGISTRY
+from .pipeline import (
+    heatmap_renderer,
+    ml_service,
+    run_image_analysis,
+    run_symptom_analysis,
+    run_combined_analysis,
+    run_batch_analysis
 )
+from .rendering import KINDS, HeatmapRenderer
+from .storage import media_path
+from .tiles import read_pyramid, read_region, thumbnail_level
 
 # Configure logger
 logger = logging.getLogger(__name__)
 
-# Initialize ML service
-ml_service = MockMLService()
+
+# Seconds the readiness check waits for the inference pool
+READINESS_TIMEOUT = 2.0
+
+
+def _symptoms_field(request, default=None):
+    """Symptoms from the parsed body (default when the body is not an object)"""
+    if isinstance(request.data, dict):
+        return request.data.get('symptoms', default)
+    return default
 
 
 @api_view(['GET'])
 def health_check(request):
     """
-    Health check endpoint for service monitoring
+    Liveness endpoint for service monitoring (the process is up)
     """
     return Response({
         'status': 'healthy',
@@ -37,82 +52,175 @@ def health_check(request):
     })
 
 
+def _model_status():
+    """Whether the ensemble is loaded and warm, in this process or the inference pool"""
+    registry = ml_service.registry
+    try:
+        if isinstance(registry, InferencePoolClient):
+            pool = registry.status(timeout=READINESS_TIMEOUT)
+            return {'loaded': bool(pool['members']), 'warm': pool['warm'], 'members': pool['members'],
+                    'backend': pool.get('backend'), 'location': 'inference_pool'}
+
+        # Loads on first use otherwise; this is what the next analysis would do
+        registry.load()
+        return {'loaded': registry.loaded, 'warm': registry.warm,
+                'members': [member.name for member in registry.members],
+                'backend': registry.backend_config['NAME'], 'location': 'process'}
+    except Exception as e:
+        logger.warning(f'Readiness check could not reach the models: {str(e)}')
+        return {'loaded': False, 'warm': False, 'members': [], 'error': str(e)}
+
+
+@api_view(['GET'])
+def readiness(request):
+    """
+    Readiness endpoint: whether this server should receive analyses
+
+    Returns 200 when the models are loaded and the analyze queues have
+    room, 503 otherwise, with:
+    - models: loaded, warm, members, backend and where they run
+    - admission: analyses running, queue depth and limit per endpoint in
+      this process, and (with METRICS_DIR) totals over every server
+      process under 'server'; the server is saturated once all are
+    """
+    models = _model_status()
+    admission = None
+    saturated = False
+    if admission_controller is not None:
+        admission = admission_controller.snapshot()
+        admission['server'] = server_snapshot()
+        saturated = admission['server']['saturated'] if admission['server'] else admission['saturated']
+    ready = models['loaded'] and not saturated
+
+    return Response({
+        'status': 'ready' if ready else 'not_ready',
+        'models': models,
+        'admission': admission,
+    }, status=status.HTTP_200_OK if ready else status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+def metrics(request):
+    """
+    Prometheus metrics: request and stage latency histograms, in-flight
+    requests, result cache lookups and image size distribution
+    """
+    return HttpResponse(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@api_view(['GET'])
+def heatmap_status(request, job_id):
+    """
+    Rendering status of the heatmap and attention map for an analysis
+
+    Returns:
+    - status: pending, ready or failed
+    - heatmap_path and attention_map_path to fetch once ready
+    """
+    job = heatmap_renderer.status(job_id)
+    if job is None:
+        return Response({
+            'error': 'Unknown heatmap job'
+        }, status=status.HTTP_404_NOT_FOUND)
+
+    return Response(job, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+def heatmap_region(request, job_id, kind):
+    """
+    Region of one level of a heatmap (kind 'heatmap') or attention map
+    (kind 'attention') tile pyramid, as a JPEG
+
+    Query parameters (all optional):
+    - level: 0 (1x1 pixel) up to the full-resolution top level; defaults
+      to the thumbnail, the largest level that fits in a single tile
+    - x, y, width, height: Region in pixels of that level; defaults to
+      the whole level
+
+    Deep Zoom viewers can instead load the <kind>_pyramid descriptor
+    from the job status and fetch the tiles from the media URL.
+    """
+    job = heatmap_renderer.status(job_id)
+    if job is None or kind not in KINDS:
+        return Response({
+            'error': 'Unknown heatmap job'
+        }, status=status.HTTP_404_NOT_FOUND)
+
+    if f'{kind}_pyramid' not in job:
+        return Response({
+            'error': 'Heatmap tiles are not enabled'
+        }, status=status.HTTP_404_NOT_FOUND)
+
+    if job['status'] != HeatmapRenderer.READY:
+        return Response({
+            'error': 'Heatmap is not ready',
+            'status': job['status']
+        }, status=status.HTTP_409_CONFLICT)
+
+    try:
+        params = {
+            name: int(request.query_params[name])
+            for name in ('level', 'x', 'y', 'width', 'height')
+            if name in request.query_params
+        }
+    except ValueError:
+        return Response({
+            'error': 'level, x, y, width and height must be integers'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    descriptor = media_path(job[f'{kind}_pyramid'])
+    try:
+        pyramid = read_pyramid(descriptor)
+        level = params.pop('level', None)
+        region = read_region(
+            descriptor,
+            thumbnail_level(pyramid) if level is None else level,
+            max_side=settings.HEATMAP_MAX_REGION,
+            **params
+        )
+    except FileNotFoundError:
+        # Rendered before tiles were enabled
+        return Response({
+            'error': 'Heatmap tiles not found'
+        }, status=status.HTTP_404_NOT_FOUND)
+    except ValueError as e:
+        return Response({
+            'error': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    _, encoded = cv2.imencode('.jpg', region, [cv2.IMWRITE_JPEG_QUALITY, settings.HEATMAP_TILE_QUALITY])
+    response = HttpResponse(encoded.tobytes(), content_type='image/jpeg')
+    # Overlays are named by the upload digest and never change
+    response['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+
 @api_view(['POST'])
 def analyze_image(request):
     """
     Analyze skin lesion from uploaded image
-    
+
     Expected input:
     - image: Image file (JPEG or PNG, max 10MB)
-    
+
     Returns:
     - Diagnosis results with confidence scores
-    - Heatmap path for visualization
+    - Heatmap and attention map paths, rendered in the background;
+      poll heatmaps/<heatmap_job> until heatmap_status is ready
     """
-    try:
-        # Check if image was uploaded
-        if 'image' not in request.FILES:
-            return Response({
-                'error': 'No image file provided'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        image_file = request.FILES['image']
-        
-        # Validate image
-        try:
-            validate_image(image_file)
-        except ValueError as e:
-            return Response({
-                'error': str(e)
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Save uploaded image
-        image_path = save_uploaded_image(image_file)
-        
-        # Preprocess image (validate it can be processed)
-        try:
-            preprocess_image(image_path)
-        except ValueError as e:
-            return Response({
-                'error': f'Image preprocessing failed: {str(e)}'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Generate Grad-CAM heatmap
-        try:
-            heatmap_path = generate_gradcam_heatmap(image_path)
-        except Exception as e:
-            # Heatmap generation failure shouldn't stop diagnosis
-            heatmap_path = None
-            logger.error(f'Heatmap generation failed: {str(e)}', exc_info=True)
-        
-        # Perform ML analysis
-        results = ml_service.analyze_image(image_path)
-        
-        # Add image paths to results
-        results['image_path'] = os.path.join('uploads', os.path.basename(image_path))
-        results['heatmap_path'] = heatmap_path
-        
-        return Response({
-            'success': True,
-            'diagnosis': results
-        }, status=status.HTTP_200_OK)
-        
-    except Exception as e:
-        logger.error(f'Error in analyze_image: {str(e)}', exc_info=True)
-        return Response({
-            'error': 'Internal server error during image analysis',
-            'details': str(e)
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    payload, status_code = run_image_analysis(request.FILES.get('image'))
+    return Response(payload, status=status_code)
 
 
 @api_view(['POST'])
 def analyze_symptoms(request):
     """
     Analyze based on symptom questionnaire responses
-    
+
     Expected input (JSON):
-    - symptoms: Dictionary of symptom data
-    
+    - symptoms: Dictionary of symptom data (or a JSON string of one in
+      form data)
+
     Example:
     {
         "symptoms": {
@@ -123,33 +231,12 @@ def analyze_symptoms(request):
             "itching": "no"
         }
     }
-    
+
     Returns:
     - Diagnosis results based on symptoms
     """
-    try:
-        # Get symptoms data
-        symptoms_data = request.data.get('symptoms', {})
-        
-        if not symptoms_data:
-            return Response({
-                'error': 'No symptom data provided'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Perform symptom-based analysis
-        results = ml_service.analyze_symptoms(symptoms_data)
-        
-        return Response({
-            'success': True,
-            'diagnosis': results
-        }, status=status.HTTP_200_OK)
-        
-    except Exception as e:
-        logger.error(f'Error in analyze_symptoms: {str(e)}', exc_info=True)
-        return Response({
-            'error': 'Internal server error during symptom analysis',
-            'details': str(e)
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    payload, status_code = run_symptom_analysis(_symptoms_field(request, {}))
+    return Response(payload, status=status_code)
 
 
 @api_view(['POST'])
@@ -157,80 +244,38 @@ def analyze_combined(request):
     """
     Perform combined analysis using both image and symptoms
     This provides the highest accuracy
-    
+
     Expected input:
     - image: Image file
     - symptoms: JSON string or form data with symptom information
-    
+
     Returns:
     - Comprehensive diagnosis with highest confidence
     """
-    try:
-        # Check if image was uploaded
-        if 'image' not in request.FILES:
-            return Response({
-                'error': 'No image file provided'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        image_file = request.FILES['image']
-        
-        # Get symptoms data
-        # Handle both JSON and form data
-        symptoms_data = {}
-        if 'symptoms' in request.data:
-            import json
-            symptoms_raw = request.data['symptoms']
-            if isinstance(symptoms_raw, str):
-                symptoms_data = json.loads(symptoms_raw)
-            else:
-                symptoms_data = symptoms_raw
-        
-        if not symptoms_data:
-            return Response({
-                'error': 'No symptom data provided'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Validate image
-        try:
-            validate_image(image_file)
-        except ValueError as e:
-            return Response({
-                'error': str(e)
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Save uploaded image
-        image_path = save_uploaded_image(image_file)
-        
-        # Preprocess image
-        try:
-            preprocess_image(image_path)
-        except ValueError as e:
-            return Response({
-                'error': f'Image preprocessing failed: {str(e)}'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Generate Grad-CAM heatmap
-        try:
-            heatmap_path = generate_gradcam_heatmap(image_path)
-        except Exception as e:
-            heatmap_path = None
-            logger.error(f'Heatmap generation failed: {str(e)}', exc_info=True)
-        
-        # Perform combined analysis
-        results = ml_service.analyze_combined(image_path, symptoms_data)
-        
-        # Add image paths to results
-        results['image_path'] = os.path.join('uploads', os.path.basename(image_path))
-        results['heatmap_path'] = heatmap_path
-        
-        return Response({
-            'success': True,
-            'diagnosis': results
-        }, status=status.HTTP_200_OK)
-        
-    except Exception as e:
-        logger.error(f'Error in analyze_combined: {str(e)}', exc_info=True)
-        return Response({
-            'error': 'Internal server error during combined analysis',
-            'details': str(e)
-        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    payload, status_code = run_combined_analysis(
+        request.FILES.get('image'),
+        _symptoms_field(request)
+    )
+    return Response(payload, status=status_code)
+
+
+@api_view(['POST'])
+def analyze_batch(request):
+    """
+    Analyze a batch of skin lesion images in a single request
+    All valid images run through the CNN ensemble as one stacked batch
+
+    Expected input:
+    - images: One or more image files (JPEG or PNG, max 10MB each)
+    - symptoms: Optional JSON list with one symptom dictionary (or null)
+      per image, in upload order
+
+    Returns:
+    - One entry per image, in upload order, holding either its diagnosis
+      or the error that prevented it
+    """
+    payload, status_code = run_batch_analysis(
+        request.FILES.getlist('images'),
+        _symptoms_field(request)
+    )
+    return Response(payload, status=status_code)
@@ -0,0 +1,106 @@
+"""
+Gunicorn configuration for the Heal-Io AI service
+
+SERVER_MODE=wsgi (default) runs sync workers on heal_io_ai.wsgi.
+SERVER_MODE=asgi runs uvicorn workers on heal_io_ai.asgi, where the
+analyze endpoints are native async views and one process can hold many
+in-flight uploads while CPU work runs on a bounded thread pool.
+
+INFERENCE_POOL_WORKERS > 0 moves the models out of the request workers
+into a pool of inference processes (`manage.py inference_pool`), started
+and stopped with the server.
+"""
+
+import os
+import subprocess
+import sys
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+
+if os.getenv('SERVER_MODE', 'wsgi') == 'asgi':
+    wsgi_app = 'heal_io_ai.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'heal_io_ai.wsgi:application'
+
+# Models live in the inference pool when it is enabled
+inference_pool_workers = int(os.getenv('INFERENCE_POOL_WORKERS', '0'))
+start_inference_pool = inference_pool_workers > 0 and os.getenv('INFERENCE_POOL_START', 'True') == 'True'
+inference_pool = None
+
+# Otherwise load the model ensemble once in the master so forked workers share it
+preload_models = os.getenv('PRELOAD_MODELS', 'True') == 'True' and inference_pool_workers <= 0
+preload_app = preload_models
+
+
+def on_starting(server):
+    """Clear metrics snapshots left by a previous run and start the inference pool"""
+    global inference_pool
+
+    metrics_dir = os.getenv('METRICS_DIR')
+    if metrics_dir and os.path.isdir(metrics_dir):
+        for filename in os.listdir(metrics_dir):
+            if filename.endswith(('.json', '.tmp')):
+                os.remove(os.path.join(metrics_dir, filename))
+
+    if start_inference_pool:
+        inference_pool = subprocess.Popen(
+            [sys.executable, 'manage.py', 'inference_pool'],
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        )
+        server.log.info(f'Started inference pool ({inference_pool_workers} workers, pid {inference_pool.pid})')
+
+
+def on_exit(server):
+    """Stop the inference pool"""
+    if inference_pool is None:
+        return
+
+    inference_pool.terminate()
+    try:
+        inference_pool.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        inference_pool.kill()
+
+
+def when_ready(server):
+    """Load every ensemble member before any worker is forked"""
+    if not preload_models:
+        return
+
+    import django
+    django.setup()
+
+    from diagnosis.registry import get_registry
+    registry = get_registry()
+    if not registry.backend.FORK_SAFE:
+        server.log.info('Inference backend is not fork-safe; each worker loads its own models')
+        return
+
+    registry.load()
+    server.log.info('Model registry loaded in master')
+
+
+def post_worker_init(worker):
+    """Start the media store sweeper and warm the models before the worker accepts traffic"""
+    from diagnosis.storage import sweeper
+    sweeper.ensure_started()
+
+    if not preload_models:
+        return
+
+    from diagnosis.registry import get_registry
+    get_registry().warm_up()
+
+
+def worker_abort(worker):
+    """Log the pipeline stages a timed-out worker was stuck in"""
+    from diagnosis.metrics import active_stages
+
+    for entry in active_stages():
+        worker.log.error(
+            f"Worker timeout in stage {entry['stage']} "
+            f"({entry['elapsed']:.1f}s, thread {entry['thread']})"
+        )
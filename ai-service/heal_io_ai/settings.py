@@ -33,6 +33,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'diagnosis.middleware.metrics_middleware',
+    'diagnosis.middleware.admission_middleware',
+    'diagnosis.middleware.profiling_middleware',
     'django.middleware.security.SecurityMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -103,7 +106,7 @@ CORS_ALLOW_CREDENTIALS = True
 # REST Framework settings
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
+        'diagnosis.renderers.FastJSONRenderer',
     ],
     'DEFAULT_PARSER_CLASSES': [
         'rest_framework.parsers.JSONParser',
@@ -116,11 +119,177 @@ REST_FRAMEWORK = {
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
 
+# Image uploads are sniffed, hashed and stored while they stream in
+FILE_UPLOAD_HANDLERS = [
+    'diagnosis.uploads.ImageUploadHandler',
+]
+
 # Custom settings
-MODEL_PATH = BASE_DIR / 'models'
+MODEL_PATH = Path(os.getenv('MODEL_PATH', BASE_DIR / 'models'))
 UPLOAD_PATH = MEDIA_ROOT / 'uploads'
 HEATMAP_PATH = MEDIA_ROOT / 'heatmaps'
 
+# Largest accepted image file (bytes) and decoded size (width x height)
+MAX_UPLOAD_SIZE = int(os.getenv('MAX_UPLOAD_SIZE', '10485760'))
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', '40000000'))
+
+# Longest side (pixels) of the flat heatmap previews; 0 keeps native resolution
+HEATMAP_MAX_SIZE = int(os.getenv('HEATMAP_MAX_SIZE', '1024'))
+
+# Also store overlays as Deep Zoom tile pyramids, served by level and
+# region from /api/heatmaps/<job>/<kind>. PYRAMID_MAX_SIZE caps the top
+# level (0 opts into native resolution); MAX_REGION caps the side of a
+# served region.
+HEATMAP_TILES = os.getenv('HEATMAP_TILES', 'True') == 'True'
+HEATMAP_TILE_SIZE = int(os.getenv('HEATMAP_TILE_SIZE', '512'))
+HEATMAP_TILE_QUALITY = int(os.getenv('HEATMAP_TILE_QUALITY', '85'))
+HEATMAP_PYRAMID_MAX_SIZE = int(os.getenv('HEATMAP_PYRAMID_MAX_SIZE', '4096'))
+HEATMAP_MAX_REGION = int(os.getenv('HEATMAP_MAX_REGION', '4096'))
+
+# 'overlay' renders heatmap images in the background; 'activation' returns
+# GRID_SIZE x GRID_SIZE uint8 activation grids inline for the client to
+# colorize, with nothing rendered or stored
+HEATMAP_MODE = os.getenv('HEATMAP_MODE', 'overlay')
+HEATMAP_GRID_SIZE = int(os.getenv('HEATMAP_GRID_SIZE', '32'))
+
+# Background threads rendering heatmaps; 0 renders inline before responding
+HEATMAP_RENDER_WORKERS = int(os.getenv('HEATMAP_RENDER_WORKERS', '2'))
+
+# Serving mode: 'wsgi' (sync gunicorn workers) or 'asgi' (uvicorn workers)
+SERVER_MODE = os.getenv('SERVER_MODE', 'wsgi')
+
+# Route analyze endpoints to native async views (defaults on under ASGI)
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', str(SERVER_MODE == 'asgi')) == 'True'
+
+# Threads per process for decoding, inference and file writes in async views
+ASYNC_CPU_WORKERS = int(os.getenv('ASYNC_CPU_WORKERS', str(os.cpu_count() or 2)))
+
+# Admission control for the analyze endpoints, per process: at most
+# MAX_ACTIVE analyses run at once and the rest wait in per-endpoint queues
+# (symptom-only requests first). A full queue answers 429 and a wait over
+# QUEUE_TIMEOUT seconds 503, both with Retry-After. Requires a process that
+# serves requests concurrently, so it defaults on under ASGI only: a sync
+# worker handles one request at a time and nothing queues inside it.
+# MAX_ACTIVE defaults to ASYNC_CPU_WORKERS under ASGI and 1 otherwise.
+ADMISSION = {
+    'ENABLED': os.getenv('ADMISSION_ENABLED', str(SERVER_MODE == 'asgi')) == 'True',
+    'MAX_ACTIVE': int(os.getenv('ADMISSION_MAX_ACTIVE', str(ASYNC_CPU_WORKERS if SERVER_MODE == 'asgi' else 1))),
+    'QUEUE_TIMEOUT': float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '30')),
+    'QUEUES': {
+        'analyze_symptoms': int(os.getenv('ADMISSION_QUEUE_SYMPTOMS', '64')),
+        'analyze_image': int(os.getenv('ADMISSION_QUEUE_IMAGE', '16')),
+        'analyze_combined': int(os.getenv('ADMISSION_QUEUE_COMBINED', '16')),
+        'analyze_batch': int(os.getenv('ADMISSION_QUEUE_BATCH', '2')),
+    },
+}
+
+# Dedicated inference processes (0: run the models in each request worker).
+# Request workers hand tensors to them through shared memory and the Unix
+# SOCKET. gunicorn starts the pool unless INFERENCE_POOL_START=False (then
+# run `manage.py inference_pool` yourself, on the same host and IPC namespace).
+# Connections authenticate with AUTHKEY (SECRET_KEY unless set).
+INFERENCE_POOL = {
+    'WORKERS': int(os.getenv('INFERENCE_POOL_WORKERS', '0')),
+    'SOCKET': os.getenv('INFERENCE_POOL_SOCKET', '/tmp/healio-inference.sock'),
+    'AUTHKEY': os.getenv('INFERENCE_POOL_AUTHKEY', SECRET_KEY),
+    'TIMEOUT': float(os.getenv('INFERENCE_POOL_TIMEOUT', '30')),
+}
+
+# Runtime of the image ensemble: 'mock' (NumPy stand-in, used by tests),
+# 'onnxruntime' (<MODEL_PATH>/<key>.onnx on the CPU, or <key>.int8.onnx with
+# QUANTIZED; see `manage.py quantize_models`) or the dotted path of an
+# EnsembleMember subclass. Thread counts of 0 let ONNX Runtime pick one
+# intra-op thread per core; keep INTRA_OP_THREADS x processes running
+# inference (web or inference pool workers) at or below the core count.
+INFERENCE_BACKEND = {
+    'NAME': os.getenv('INFERENCE_BACKEND', 'mock'),
+    'QUANTIZED': os.getenv('INFERENCE_QUANTIZED', 'False') == 'True',
+    'GRAPH_OPTIMIZATION': os.getenv('INFERENCE_GRAPH_OPTIMIZATION', 'all'),
+    'INTRA_OP_THREADS': int(os.getenv('INFERENCE_INTRA_OP_THREADS', '0')),
+    'INTER_OP_THREADS': int(os.getenv('INFERENCE_INTER_OP_THREADS', '0')),
+    'INPUT_NORMALIZATION': os.getenv('INFERENCE_INPUT_NORMALIZATION', 'imagenet'),
+    'OUTPUTS': os.getenv('INFERENCE_OUTPUTS', 'logits'),
+}
+
+# Confidence-gated cascade over the image ensemble: members run in cost
+# order and an image stops once the mean probabilities of the members run
+# so far give the top disease THRESHOLD and a lead of MARGIN over the next.
+# Images whose top disease is high-severity (Melanoma), or where one reaches
+# SEVERE_MIN_PROBABILITY, always go through the whole ensemble.
+CASCADE = {
+    'ENABLED': os.getenv('CASCADE_ENABLED', 'False') == 'True',
+    'THRESHOLD': float(os.getenv('CASCADE_THRESHOLD', '0.9')),
+    'MARGIN': float(os.getenv('CASCADE_MARGIN', '0.5')),
+    'SEVERE_MIN_PROBABILITY': float(os.getenv('CASCADE_SEVERE_MIN_PROBABILITY', '0.05')),
+}
+
+# Micro-batching of concurrent image and combined analyses: the first request
+# waits up to MAX_WAIT_MS for others and they run as one model call of at
+# most MAX_SIZE images. Only helps processes serving requests concurrently
+# (batches are bounded by ASYNC_CPU_WORKERS under ASGI), so defaults on there.
+MICRO_BATCH = {
+    'ENABLED': os.getenv('MICRO_BATCH_ENABLED', str(SERVER_MODE == 'asgi')) == 'True',
+    'MAX_SIZE': int(os.getenv('MICRO_BATCH_MAX_SIZE', '16')),
+    'MAX_WAIT_MS': float(os.getenv('MICRO_BATCH_MAX_WAIT_MS', '5')),
+}
+
+# Maximum number of images accepted by the batch analysis endpoint
+MAX_BATCH_SIZE = int(os.getenv('MAX_BATCH_SIZE', '100'))
+
+# Directory where each server process writes its metrics snapshot so
+# /api/metrics reports every gunicorn worker (empty: this process only)
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+
+# Opt-in request profiling (cProfile, plus tracemalloc with
+# TRACE_ALLOCATIONS). Requests sending HEADER equal to TOKEN are always
+# traced (never while TOKEN is empty); SAMPLE_RATE picks a random share
+# whose traces are kept only above SLOW_THRESHOLD_MS. DIR is capped at
+# MAX_FILES traces and MAX_BYTES, oldest removed first.
+PROFILING = {
+    'ENABLED': os.getenv('PROFILING_ENABLED', 'False') == 'True',
+    'HEADER': os.getenv('PROFILING_HEADER', 'X-Profile'),
+    'TOKEN': os.getenv('PROFILING_TOKEN', ''),
+    'SAMPLE_RATE': float(os.getenv('PROFILING_SAMPLE_RATE', '0')),
+    'SLOW_THRESHOLD_MS': int(os.getenv('PROFILING_SLOW_THRESHOLD_MS', '2000')),
+    'TRACE_ALLOCATIONS': os.getenv('PROFILING_TRACE_ALLOCATIONS', 'False') == 'True',
+    'DIR': os.getenv('PROFILING_DIR', '/tmp/healio-profiles'),
+    'MAX_FILES': int(os.getenv('PROFILING_MAX_FILES', '50')),
+    'MAX_BYTES': int(os.getenv('PROFILING_MAX_BYTES', str(100 * 1024 * 1024))),
+}
+
+# Content-addressed media store (uploads and heatmaps, see diagnosis/storage.py).
+# Files are sharded into SHARD_DEPTH levels of 2-hex-digit directories
+# (keep it fixed once files are stored; `manage.py sweep_storage --migrate`
+# moves files from the older flat layout into shards). A background
+# sweeper runs every SWEEP_INTERVAL seconds (0: never) and removes objects
+# unused for RETENTION_DAYS and least recently used objects above MAX_BYTES
+# (0 disables either limit).
+STORAGE = {
+    'SHARD_DEPTH': int(os.getenv('STORAGE_SHARD_DEPTH', '2')),
+    'RETENTION_DAYS': float(os.getenv('STORAGE_RETENTION_DAYS', '0')),
+    'MAX_BYTES': int(os.getenv('STORAGE_MAX_BYTES', '0')),
+    'SWEEP_INTERVAL': int(os.getenv('STORAGE_SWEEP_INTERVAL', '3600')),
+}
+
+# Shared cache store (Redis when REDIS_URL is set, local memory otherwise)
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+
+# Diagnosis result cache, keyed by image digest and canonical symptoms
+# BACKEND: 'local' (per-process LRU), 'django' (CACHES alias), 'none',
+# or a dotted path to a custom backend class
+RESULT_CACHE = {
+    'BACKEND': os.getenv('RESULT_CACHE_BACKEND', 'local'),
+    'MAX_ENTRIES': int(os.getenv('RESULT_CACHE_MAX_ENTRIES', '1024')),
+    'TTL': int(os.getenv('RESULT_CACHE_TTL', '3600')),
+    'CACHE_ALIAS': os.getenv('RESULT_CACHE_ALIAS', 'default'),
+}
+
 # Ensure directories exist
 UPLOAD_PATH.mkdir(parents=True, exist_ok=True)
 HEATMAP_PATH.mkdir(parents=True, exist_ok=True)
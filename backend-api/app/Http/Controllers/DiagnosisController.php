@@ -34,11 +34,7 @@ class DiagnosisController extends Controller
             )->post($this->aiServiceUrl . '/api/analyze/image');
 
             if (!$response->successful()) {
-                return response()->json([
-                    'success' => false,
-                    'message' => 'AI service error',
-                    'error' => $response->json()['error'] ?? 'Unknown error',
-                ], $response->status());
+                return $this->aiServiceError($response);
             }
 
             $aiResult = $response->json();
@@ -92,11 +88,7 @@ class DiagnosisController extends Controller
                 ]);
 
             if (!$response->successful()) {
-                return response()->json([
-                    'success' => false,
-                    'message' => 'AI service error',
-                    'error' => $response->json()['error'] ?? 'Unknown error',
-                ], $response->status());
+                return $this->aiServiceError($response);
             }
 
             $aiResult = $response->json();
@@ -154,11 +146,7 @@ class DiagnosisController extends Controller
             ]);
 
             if (!$response->successful()) {
-                return response()->json([
-                    'success' => false,
-                    'message' => 'AI service error',
-                    'error' => $response->json()['error'] ?? 'Unknown error',
-                ], $response->status());
+                return $this->aiServiceError($response);
             }
 
             $aiResult = $response->json();
@@ -195,6 +183,80 @@ class DiagnosisController extends Controller
         }
     }
 
+    /**
+     * Analyze a batch of images (optionally with per-image symptoms)
+     * in a single round trip to the AI service
+     */
+    public function analyzeBatch(Request $request)
+    {
+        try {
+            $request->validate([
+                'images' => 'required|array|max:100',
+                'images.*' => 'image|mimes:jpeg,jpg,png|max:10240',
+                'symptoms' => 'nullable|array',
+            ]);
+
+            // Forward all images to the AI service in one request
+            $http = Http::timeout(300);
+            foreach ($request->file('images') as $image) {
+                $http = $http->attach(
+                    'images',
+                    file_get_contents($image->getRealPath()),
+                    $image->getClientOriginalName()
+                );
+            }
+
+            $payload = [];
+            if ($request->has('symptoms')) {
+                $payload['symptoms'] = json_encode($request->symptoms);
+            }
+
+            $response = $http->post($this->aiServiceUrl . '/api/analyze/batch', $payload);
+
+            if (!$response->successful()) {
+                return $this->aiServiceError($response);
+            }
+
+            $results = $response->json()['results'];
+
+            // Save each successful diagnosis to database if user is authenticated
+            if ($request->user()) {
+                foreach ($results as &$item) {
+                    $item['diagnosis_id'] = null;
+                    if ($item['success']) {
+                        $type = isset($item['diagnosis']['matched_symptoms']) ? 'combined' : 'image';
+                        $item['diagnosis_id'] = $this->saveDiagnosis(
+                            $request->user()->id,
+                            $type,
+                            $item['diagnosis']
+                        )->id;
+                    }
+                }
+                unset($item);
+            }
+
+            return response()->json([
+                'success' => true,
+                'count' => count($results),
+                'results' => $results,
+            ]);
+
+        } catch (\Illuminate\Validation\ValidationException $e) {
+            return response()->json([
+                'success' => false,
+                'message' => 'Validation failed',
+                'errors' => $e->errors(),
+            ], 422);
+        } catch (\Exception $e) {
+            Log::error('Batch analysis error: ' . $e->getMessage());
+            return response()->json([
+                'success' => false,
+                'message' => 'Analysis failed',
+                'error' => $e->getMessage(),
+            ], 500);
+        }
+    }
+
     /**
      * Get diagnosis history for authenticated user
      */
@@ -249,6 +311,24 @@ class DiagnosisController extends Controller
         }
     }
 
+    /**
+     * Relay an AI service error, keeping Retry-After when it is shedding load
+     */
+    private function aiServiceError($response)
+    {
+        $error = response()->json([
+            'success' => false,
+            'message' => 'AI service error',
+            'error' => $response->json()['error'] ?? 'Unknown error',
+        ], $response->status());
+
+        if ($response->header('Retry-After') !== '') {
+            $error->header('Retry-After', $response->header('Retry-After'));
+        }
+
+        return $error;
+    }
+
     /**
      * Helper method to save diagnosis to database
      */
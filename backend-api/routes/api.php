@@ -32,6 +32,7 @@ Route::prefix('v1')->group(function () {
         Route::post('/image', [DiagnosisController::class, 'analyzeImage']);
         Route::post('/symptoms', [DiagnosisController::class, 'analyzeSymptoms']);
         Route::post('/combined', [DiagnosisController::class, 'analyzeCombined']);
+        Route::post('/batch', [DiagnosisController::class, 'analyzeBatch']);
         
         // Protected routes
         Route::middleware('auth:sanctum')->group(function () {
@@ -0,0 +1,89 @@
+import React, { useEffect, useRef } from 'react';
+
+// Approximations of OpenCV's COLORMAP_JET and COLORMAP_HOT (value in [0, 1] -> RGB in [0, 1])
+const clamp = (value) => Math.min(1, Math.max(0, value));
+const COLORMAPS = {
+  jet: (v) => [clamp(1.5 - Math.abs(4 * v - 3)), clamp(1.5 - Math.abs(4 * v - 2)), clamp(1.5 - Math.abs(4 * v - 1))],
+  hot: (v) => [clamp(3 * v), clamp(3 * v - 1), clamp(3 * v - 2)],
+};
+
+// Longest side of the composed canvas
+const MAX_SIDE = 1024;
+
+const decodeGrid = (grid) => {
+  const binary = atob(grid.data);
+  const values = new Uint8Array(binary.length);
+  for (let i = 0; i < binary.length; i += 1) {
+    values[i] = binary.charCodeAt(i);
+  }
+  return values;
+};
+
+/**
+ * Draws an image with an activation grid returned by the AI service
+ * (HEATMAP_MODE=activation) blended on top. The grid is about a kilobyte:
+ * it is colorized here at its own resolution and upsampled by the browser,
+ * so the server never renders, encodes or stores an overlay.
+ */
+const ActivationOverlay = ({ imageUrl, grid, alt, className, onError }) => {
+  const canvasRef = useRef(null);
+  // Callers pass inline callbacks; keep them out of the effect dependencies
+  const onErrorRef = useRef(onError);
+  onErrorRef.current = onError;
+
+  useEffect(() => {
+    if (!grid) return undefined;
+
+    let cancelled = false;
+    const image = new Image();
+
+    image.onload = () => {
+      const canvas = canvasRef.current;
+      if (cancelled || !canvas) return;
+
+      const scale = Math.min(1, MAX_SIDE / Math.max(image.naturalWidth, image.naturalHeight));
+      const width = Math.round(image.naturalWidth * scale);
+      const height = Math.round(image.naturalHeight * scale);
+      canvas.width = width;
+      canvas.height = height;
+
+      const context = canvas.getContext('2d');
+      context.drawImage(image, 0, 0, width, height);
+
+      // Colorize the grid at its own resolution...
+      const gridCanvas = document.createElement('canvas');
+      gridCanvas.width = grid.width;
+      gridCanvas.height = grid.height;
+      const gridContext = gridCanvas.getContext('2d');
+      const pixels = gridContext.createImageData(grid.width, grid.height);
+      const colormap = COLORMAPS[grid.colormap] || COLORMAPS.jet;
+      decodeGrid(grid).forEach((value, index) => {
+        const [red, green, blue] = colormap(value / 255);
+        pixels.data[index * 4] = red * 255;
+        pixels.data[index * 4 + 1] = green * 255;
+        pixels.data[index * 4 + 2] = blue * 255;
+        pixels.data[index * 4 + 3] = 255;
+      });
+      gridContext.putImageData(pixels, 0, 0);
+
+      // ...then let the browser upsample it smoothly while blending
+      context.imageSmoothingEnabled = true;
+      context.imageSmoothingQuality = 'high';
+      context.globalAlpha = grid.alpha;
+      context.drawImage(gridCanvas, 0, 0, width, height);
+      context.globalAlpha = 1;
+    };
+    image.onerror = () => {
+      if (!cancelled && onErrorRef.current) onErrorRef.current();
+    };
+    image.src = imageUrl;
+
+    return () => {
+      cancelled = true;
+    };
+  }, [imageUrl, grid]);
+
+  return <canvas ref={canvasRef} className={className} role="img" aria-label={alt} />;
+};
+
+export default ActivationOverlay;
@@ -6,14 +6,24 @@ import { Doughnut } from 'react-chartjs-2';
 import { FaDownload, FaUserMd, FaExclamationTriangle, FaCheckCircle } from 'react-icons/fa';
 import jsPDF from 'jspdf';
 import html2canvas from 'html2canvas';
+import axios from 'axios';
+import ActivationOverlay from '../components/ActivationOverlay';
 
 ChartJS.register(ArcElement, Tooltip, Legend);
 
+const aiServiceUrl = process.env.REACT_APP_AI_SERVICE_URL || '/api';
+
+// Heatmap polling backs off from 1s to 10s and gives up after ~2.5 minutes
+const HEATMAP_POLL_INITIAL_MS = 1000;
+const HEATMAP_POLL_MAX_MS = 10000;
+const HEATMAP_POLL_ATTEMPTS = 20;
+
 const ResultsDashboard = () => {
   const location = useLocation();
   const navigate = useNavigate();
   const [diagnosis, setDiagnosis] = useState(null);
   const [diagnosisType, setDiagnosisType] = useState('');
+  const [heatmapStatus, setHeatmapStatus] = useState(null);
 
   useEffect(() => {
     if (location.state?.diagnosis) {
@@ -25,6 +35,44 @@ const ResultsDashboard = () => {
     }
   }, [location, navigate]);
 
+  // Heatmaps are rendered in the background; poll until they are ready
+  useEffect(() => {
+    if (!diagnosis?.heatmap_job || diagnosis.heatmap_status !== 'pending') {
+      setHeatmapStatus(diagnosis?.heatmap_status || null);
+      return undefined;
+    }
+
+    let cancelled = false;
+    let timer;
+    let attempts = 0;
+    let delay = HEATMAP_POLL_INITIAL_MS;
+    setHeatmapStatus('pending');
+
+    const poll = async () => {
+      try {
+        const response = await axios.get(`${aiServiceUrl}/heatmaps/${diagnosis.heatmap_job}`);
+        if (cancelled) return;
+        attempts += 1;
+        if (response.data.status === 'pending' && attempts >= HEATMAP_POLL_ATTEMPTS) {
+          setHeatmapStatus('failed');
+        } else if (response.data.status === 'pending') {
+          timer = setTimeout(poll, delay);
+          delay = Math.min(delay * 1.5, HEATMAP_POLL_MAX_MS);
+        } else {
+          setHeatmapStatus(response.data.status);
+        }
+      } catch (error) {
+        if (!cancelled) setHeatmapStatus('failed');
+      }
+    };
+    poll();
+
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [diagnosis]);
+
   if (!diagnosis) {
     return (
       <div className="min-h-screen flex items-center justify-center">
@@ -225,7 +273,7 @@ const ResultsDashboard = () => {
           </div>
 
           {/* Heatmap Display (if available) */}
-          {diagnosis.heatmap_path && (
+          {(diagnosis.heatmap_path || diagnosis.heatmap_grid) && heatmapStatus !== 'failed' && (
             <div className="card mb-8">
               <h3 className="text-2xl font-bold mb-4">Grad-CAM Heatmap Visualization</h3>
               <p className="text-sm text-gray-600 dark:text-gray-400 mb-4">
@@ -248,15 +296,29 @@ const ResultsDashboard = () => {
                 )}
                 <div>
                   <p className="text-sm font-semibold mb-2">Attention Heatmap</p>
-                  <img
-                    src={`${process.env.REACT_APP_AI_SERVICE_URL || '/api'}/media/${diagnosis.heatmap_path}`}
-                    alt="Heatmap"
-                    className="w-full rounded-lg"
-                    onError={(e) => {
-                      e.target.style.display = 'none';
-                      console.error('Failed to load heatmap');
-                    }}
-                  />
+                  {diagnosis.heatmap_grid ? (
+                    <ActivationOverlay
+                      imageUrl={`${aiServiceUrl}/media/${diagnosis.image_path}`}
+                      grid={diagnosis.heatmap_grid}
+                      alt="Heatmap"
+                      className="w-full rounded-lg"
+                      onError={() => setHeatmapStatus('failed')}
+                    />
+                  ) : heatmapStatus === 'pending' ? (
+                    <div className="flex items-center justify-center h-48">
+                      <div className="spinner"></div>
+                    </div>
+                  ) : (
+                    <img
+                      src={`${aiServiceUrl}/media/${diagnosis.heatmap_path}`}
+                      alt="Heatmap"
+                      className="w-full rounded-lg"
+                      onError={(e) => {
+                        e.target.style.display = 'none';
+                        console.error('Failed to load heatmap');
+                      }}
+                    />
+                  )}
                 </div>
               </div>
             </div>